@@ -1,13 +1,33 @@
 import requests
-import time
 import logging
 import os
 import database
+import http_client
+import esi_governor
+import redis_client
+import memory_cache
+import sso
+import universe
+import poll_scheduler
+import redis
 import json
+import orjson
+import zstandard
+import fnmatch
+import threading
+import hashlib
+import re
+import csv
+from urllib.parse import urlsplit
 from datetime import datetime, timezone, timedelta
 from dataclasses import dataclass
 import psycopg2
-from collections import defaultdict
+import psycopg2.pool
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import heapq
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
 import io
 from PIL import Image
@@ -17,6 +37,71 @@ import calendar
 
 grace_period_hours = 1
 
+# Maximum number of concurrent page requests for a single paginated ESI endpoint.
+ESI_PAGE_WORKERS = int(os.getenv("ESI_PAGE_WORKERS", "4"))
+
+# Size budget for the per-process ESI response cache that sits in front of Redis
+# and the esi_cache table.
+ESI_MEMORY_CACHE_BYTES = int(os.getenv("ESI_MEMORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+ESI_REDIS_CACHE_PREFIX = "esi:cache:"
+
+# How long concurrent callers for the same ESI cache key wait on the one request in flight.
+ESI_SINGLE_FLIGHT_TIMEOUT = float(os.getenv("ESI_SINGLE_FLIGHT_TIMEOUT", "45"))
+
+# When enabled, only the response headers the bot actually reads are cached and
+# returned to callers; set to "false" to keep the full header dict.
+ESI_CACHE_MINIMAL_HEADERS = os.getenv("ESI_CACHE_MINIMAL_HEADERS", "true").lower() == "true"
+ESI_CACHED_HEADER_NAMES = {'expires', 'etag', 'x-pages'}
+
+# A request that returns 403 Forbidden is not retried for this many seconds.
+# 403s count against the ESI error limit, so retrying them every poll is costly.
+ESI_FORBIDDEN_TTL = int(os.getenv("ESI_FORBIDDEN_TTL", "3600"))
+ESI_FORBIDDEN_PREFIX = "esi:forbidden:"
+# Endpoints whose 403s are remembered: player structures a character has no
+# docking or market access to. Other 403s (e.g. a revoked scope) are handled
+# like any other failed request.
+ESI_FORBIDDEN_PATTERNS = ["/markets/structures/*/", "/universe/structures/*/"]
+
+# esi_cache rows whose endpoint matches one of these glob patterns store their payload
+# as zstd-compressed JSON bytes instead of JSONB. Set to an empty string to disable.
+ESI_CACHE_COMPRESS_PATTERNS = [
+    pattern.strip() for pattern in
+    os.getenv("ESI_CACHE_COMPRESS_PATTERNS", "*/markets/*/orders/*,*/assets/*,*/contracts/*,*/blueprints/*").split(",")
+    if pattern.strip()
+]
+ESI_CACHE_ZSTD_LEVEL = int(os.getenv("ESI_CACHE_ZSTD_LEVEL", "3"))
+
+# Access tokens are not used within this many seconds of expiry, and are
+# refreshed in the background once they come within ACCESS_TOKEN_REFRESH_AHEAD.
+ACCESS_TOKEN_MIN_TTL = 60
+ACCESS_TOKEN_REFRESH_AHEAD = int(os.getenv("ACCESS_TOKEN_REFRESH_AHEAD", "300"))
+
+# Market books fetched by the per-cycle snapshot are published to Redis for this
+# many seconds, which should cover at least one order-poll cycle.
+MARKET_BOOK_TTL = int(os.getenv("MARKET_BOOK_TTL", "600"))
+MARKET_SNAPSHOT_WORKERS = int(os.getenv("MARKET_SNAPSHOT_WORKERS", "8"))
+# Seconds between market snapshots. Order polls are never scheduled further apart
+# than this, so undercut checks keep pace with the published books.
+MARKET_SNAPSHOT_INTERVAL = int(os.getenv("MARKET_SNAPSHOT_INTERVAL", "300"))
+MARKET_BOOK_PREFIX = "market:book:"
+MARKET_SNAPSHOT_PUBLISHED_KEY = "market:snapshot:published_at"
+
+# Number of best orders kept per side of each published book. Undercut checks
+# only need the best order that isn't the one being checked, so 2 is the minimum.
+MARKET_BOOK_TOP_LEVELS = max(2, int(os.getenv("MARKET_BOOK_TOP_LEVELS", "5")))
+
+# Structures none of our characters can read the market of are skipped for this long.
+MARKET_STRUCTURE_FORBIDDEN_TTL = int(os.getenv("MARKET_STRUCTURE_FORBIDDEN_TTL", "21600"))
+
+# Regions where at least this many distinct types are tracked are ingested as a
+# whole-region order book (all pages) instead of one request per type; 0 disables it.
+MARKET_REGION_BOOK_MIN_TYPES = int(os.getenv("MARKET_REGION_BOOK_MIN_TYPES", "100"))
+MARKET_REGION_BOOK_WORKERS = int(os.getenv("MARKET_REGION_BOOK_WORKERS", "16"))
+
+# Resolved locations kept in each process, and concurrent ESI lookups for uncached ones.
+LOCATION_MEMORY_CACHE_SIZE = int(os.getenv("LOCATION_MEMORY_CACHE_SIZE", "50000"))
+LOCATION_RESOLVE_WORKERS = int(os.getenv("LOCATION_RESOLVE_WORKERS", "8"))
+
 # --- Character Dataclass and Global List ---
 
 @dataclass
@@ -213,12 +298,37 @@ def setup_database():
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS esi_cache (
                     cache_key TEXT PRIMARY KEY,
-                    response JSONB NOT NULL,
+                    response JSONB,
                     etag TEXT,
                     expires TIMESTAMP WITH TIME ZONE NOT NULL,
-                    headers JSONB
+                    headers JSONB,
+                    response_blob BYTEA,
+                    response_encoding TEXT,
+                    character_id INTEGER,
+                    endpoint TEXT
                 )
             """)
+            # Compressed payloads are stored in response_blob, leaving response empty.
+            cursor.execute("""
+                ALTER TABLE esi_cache
+                ADD COLUMN IF NOT EXISTS response_blob BYTEA,
+                ADD COLUMN IF NOT EXISTS response_encoding TEXT,
+                ADD COLUMN IF NOT EXISTS character_id INTEGER,
+                ADD COLUMN IF NOT EXISTS endpoint TEXT,
+                ALTER COLUMN response DROP NOT NULL;
+            """)
+            # Rows written before keys were hashed have no endpoint and can never be hit again.
+            cursor.execute("DELETE FROM esi_cache WHERE endpoint IS NULL")
+            # Whole-region order pages are no longer stored in the database. Their keys are
+            # hashed, so drop every market order row once; per-type rows refill on the next snapshot.
+            cursor.execute(
+                "INSERT INTO bot_state (key, value) VALUES ('esi_cache_region_pages_purged', %s) ON CONFLICT (key) DO NOTHING RETURNING key",
+                (datetime.now(timezone.utc).isoformat(),)
+            )
+            if cursor.fetchone():
+                cursor.execute("DELETE FROM esi_cache WHERE endpoint = '/markets/{id}/orders/'")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_esi_cache_character_id ON esi_cache (character_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_esi_cache_endpoint_expires ON esi_cache (endpoint, expires)")
 
             # New tables for persistent historical data
             cursor.execute("""
@@ -266,6 +376,60 @@ def setup_database():
             )
             """)
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_hist_trans_char_date ON historical_transactions (character_id, date DESC);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_wallet_journal_char_context ON wallet_journal (character_id, context_id);")
+
+            # One row per sale with its FIFO cost and fees, so views don't replay history.
+            # cogs covers only the matched quantity; net_profit is NULL if purchase history is missing.
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS realized_sales (
+                transaction_id BIGINT NOT NULL,
+                character_id INTEGER NOT NULL,
+                type_id INTEGER NOT NULL,
+                date TIMESTAMP WITH TIME ZONE NOT NULL,
+                quantity INTEGER NOT NULL,
+                sale_value DOUBLE PRECISION NOT NULL,
+                cogs DOUBLE PRECISION NOT NULL,
+                unmatched_quantity INTEGER NOT NULL,
+                taxes DOUBLE PRECISION NOT NULL DEFAULT 0,
+                broker_fees DOUBLE PRECISION NOT NULL DEFAULT 0,
+                net_profit DOUBLE PRECISION GENERATED ALWAYS AS (
+                    CASE WHEN unmatched_quantity = 0 THEN sale_value - cogs - taxes - broker_fees END
+                ) STORED,
+                PRIMARY KEY (transaction_id, character_id)
+            )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_realized_sales_char_date ON realized_sales (character_id, date DESC);")
+
+            # Hourly and daily P&L per character and item, refreshed from realized_sales and the
+            # journal. type_id 0 holds the period's journaled fees (see PERIOD_FEE_REF_TYPES).
+            for rollup_table in ('pnl_hourly', 'pnl_daily'):
+                cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {rollup_table} (
+                    character_id INTEGER NOT NULL,
+                    bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+                    type_id INTEGER NOT NULL,
+                    sales_value DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    cogs DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    broker_fees DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    journal_fees DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    item_profit DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    PRIMARY KEY (character_id, bucket, type_id)
+                )
+                """)
+
+            # FIFO consumption scans a character's lots of one type, oldest first.
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchase_lots_char_type_date ON purchase_lots (character_id, type_id, purchase_date);")
+
+            # Snapshots of a character's open FIFO lots at 00:00 UTC, holding the state after every
+            # transaction before that moment. Ledger rebuilds replay from the latest valid one.
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS fifo_checkpoints (
+                character_id INTEGER NOT NULL,
+                checkpoint_at TIMESTAMP WITH TIME ZONE NOT NULL,
+                lots BYTEA NOT NULL,
+                PRIMARY KEY (character_id, checkpoint_at)
+            )
+            """)
 
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS image_cache (
@@ -301,6 +465,12 @@ def setup_database():
                 ALTER TABLE undercut_statuses
                 ADD COLUMN IF NOT EXISTS competitor_volume INTEGER;
             """)
+            # The inputs a status was computed from, so unchanged orders can be skipped
+            cursor.execute("""
+                ALTER TABLE undercut_statuses
+                ADD COLUMN IF NOT EXISTS book_version TEXT,
+                ADD COLUMN IF NOT EXISTS order_price NUMERIC(17, 2);
+            """)
 
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS contracts (
@@ -402,10 +572,9 @@ def add_processed_journal_refs(character_id, ref_ids):
     conn = database.get_db_connection()
     try:
         with conn.cursor() as cursor:
-            data_to_insert = [(ref_id, character_id) for ref_id in ref_ids]
-            cursor.executemany(
-                "INSERT INTO historical_journal (ref_id, character_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                data_to_insert
+            cursor.execute(
+                "INSERT INTO historical_journal (ref_id, character_id) SELECT unnest(%s::bigint[]), %s ON CONFLICT DO NOTHING",
+                (list(ref_ids), character_id)
             )
             conn.commit()
     finally:
@@ -595,6 +764,17 @@ def remove_tracked_market_orders(character_id, order_ids):
         database.release_db_connection(conn)
 
 
+def _insert_purchase_lot(cursor, character_id, type_id, quantity, price, purchase_date):
+    """Inserts a purchase lot using the caller's cursor (and transaction)."""
+    cursor.execute(
+        """
+        INSERT INTO purchase_lots (character_id, type_id, quantity, price, purchase_date)
+        VALUES (%s, %s, %s, %s, %s)
+        """,
+        (character_id, type_id, quantity, price, purchase_date)
+    )
+
+
 def add_purchase_lot(character_id, type_id, quantity, price, purchase_date=None):
     """Adds a new purchase lot to the database, with an optional historical date."""
     conn = database.get_db_connection()
@@ -602,13 +782,7 @@ def add_purchase_lot(character_id, type_id, quantity, price, purchase_date=None)
         purchase_date = datetime.now(timezone.utc).isoformat()
     try:
         with conn.cursor() as cursor:
-            cursor.execute(
-                """
-                INSERT INTO purchase_lots (character_id, type_id, quantity, price, purchase_date)
-                VALUES (%s, %s, %s, %s, %s)
-                """,
-                (character_id, type_id, quantity, price, purchase_date)
-            )
+            _insert_purchase_lot(cursor, character_id, type_id, quantity, price, purchase_date)
             conn.commit()
     finally:
         database.release_db_connection(conn)
@@ -635,28 +809,6 @@ def get_purchase_lots(character_id, type_id):
     return lots
 
 
-def update_purchase_lot_quantity(lot_id, new_quantity):
-    """Updates the remaining quantity of a purchase lot."""
-    conn = database.get_db_connection()
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("UPDATE purchase_lots SET quantity = %s WHERE lot_id = %s", (new_quantity, lot_id))
-            conn.commit()
-    finally:
-        database.release_db_connection(conn)
-
-
-def delete_purchase_lot(lot_id):
-    """Deletes a purchase lot from the database, typically when it's fully consumed."""
-    conn = database.get_db_connection()
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("DELETE FROM purchase_lots WHERE lot_id = %s", (lot_id,))
-            conn.commit()
-    finally:
-        database.release_db_connection(conn)
-
-
 def get_names_from_db(id_list):
     """Retrieves a mapping of id -> name from the local database for the given IDs."""
     if not id_list:
@@ -877,6 +1029,7 @@ def update_character_fee_setting(character_id: int, fee_type: str, value: float)
     finally:
         database.release_db_connection(conn)
     logging.info(f"Updated {column_name} for character {character_id} to {value}%.")
+    refresh_realized_sale_broker_fees(character_id)
 
 
 def update_character_backfill_state(character_id: int, is_backfilling: bool, before_id: int | None):
@@ -1049,16 +1202,18 @@ def get_journal_entry_by_context_id(character_id: int, context_id: int, ref_type
     return entry
 
 
-def get_historical_transactions_from_db(character_id: int) -> list:
-    """Retrieves all historical transactions for a character from the local database."""
+def get_historical_transactions_from_db(character_id: int, since: datetime = None) -> list:
+    """Retrieves all historical transactions for a character (on or after since, if given) from the local database."""
     conn = database.get_db_connection()
     transactions = []
     try:
         with conn.cursor() as cursor:
-            cursor.execute(
-                "SELECT transaction_id, client_id, date, is_buy, is_personal, journal_ref_id, location_id, quantity, type_id, unit_price FROM historical_transactions WHERE character_id = %s",
-                (character_id,)
-            )
+            query = "SELECT transaction_id, client_id, date, is_buy, is_personal, journal_ref_id, location_id, quantity, type_id, unit_price FROM historical_transactions WHERE character_id = %s"
+            params = [character_id]
+            if since is not None:
+                query += " AND date >= %s"
+                params.append(since)
+            cursor.execute(query, params)
             rows = cursor.fetchall()
             # Reconstruct the dictionary to match the ESI response format
             for row in rows:
@@ -1134,6 +1289,10 @@ def delete_character(character_id: int):
                 "trading_fees",
                 "historical_journal",
                 "wallet_journal",
+                "realized_sales",
+                "fifo_checkpoints",
+                "pnl_hourly",
+                "pnl_daily",
                 "chart_cache"
             ]
             for table in tables_to_delete_from:
@@ -1141,15 +1300,18 @@ def delete_character(character_id: int):
                 logging.info(f"Deleted records from {table} for character {character_id}.")
 
             # Clean up ESI cache entries
-            esi_cache_pattern = f"%:{character_id}:%"
-            cursor.execute("DELETE FROM esi_cache WHERE cache_key LIKE %s", (esi_cache_pattern,))
-            logging.info(f"Deleted esi_cache entries for character {character_id}.")
+            cursor.execute("DELETE FROM esi_cache WHERE character_id = %s RETURNING cache_key", (character_id,))
+            deleted_cache_keys = [row[0] for row in cursor.fetchall()]
+            logging.info(f"Deleted {len(deleted_cache_keys)} esi_cache entries for character {character_id}.")
+            purge_esi_cache_keys(deleted_cache_keys)
 
             # Clean up bot_state entries for this character
             keys_to_delete = [
                 f"history_backfilled_{character_id}",
                 f"low_balance_alert_sent_at_{character_id}",
-                f"chart_cache_dirty_{character_id}"
+                f"chart_cache_dirty_{character_id}",
+                f"realized_sales_built_{character_id}",
+                f"pnl_rollups_built_{character_id}"
             ]
             cursor.execute("DELETE FROM bot_state WHERE key = ANY(%s)", (keys_to_delete,))
             logging.info(f"Deleted bot_state entries for character {character_id}.")
@@ -1207,23 +1369,26 @@ def save_chart_to_cache(chart_key: str, character_id: int, chart_data: bytes, ca
 def get_undercut_statuses(character_id: int) -> dict[int, dict]:
     """
     Retrieves the last known undercut status and competitor info for all of a character's orders.
-    Returns a dict mapping order_id to {'is_undercut': bool, 'competitor_price': float|None, 'competitor_location_id': int|None, 'competitor_volume': int|None}.
+    Returns a dict mapping order_id to {'is_undercut': bool, 'competitor_price': float|None, 'competitor_location_id': int|None,
+    'competitor_volume': int|None, 'book_version': str|None, 'order_price': float|None}.
     """
     conn = database.get_db_connection()
     statuses = {}
     try:
         with conn.cursor() as cursor:
             cursor.execute(
-                "SELECT order_id, is_undercut, competitor_price, competitor_location_id, competitor_volume FROM undercut_statuses WHERE character_id = %s",
+                "SELECT order_id, is_undercut, competitor_price, competitor_location_id, competitor_volume, book_version, order_price FROM undercut_statuses WHERE character_id = %s",
                 (character_id,)
             )
             for row in cursor.fetchall():
-                order_id, is_undercut, competitor_price, competitor_location_id, competitor_volume = row
+                order_id, is_undercut, competitor_price, competitor_location_id, competitor_volume, book_version, order_price = row
                 statuses[order_id] = {
                     'is_undercut': is_undercut,
                     'competitor_price': float(competitor_price) if competitor_price is not None else None,
                     'competitor_location_id': competitor_location_id,
-                    'competitor_volume': competitor_volume
+                    'competitor_volume': competitor_volume,
+                    'book_version': book_version,
+                    'order_price': float(order_price) if order_price is not None else None
                 }
     finally:
         database.release_db_connection(conn)
@@ -1236,18 +1401,22 @@ def update_undercut_statuses(character_id: int, statuses: list[dict]):
     conn = database.get_db_connection()
     try:
         with conn.cursor() as cursor:
-            # `statuses` is a list of dicts: [{'order_id': X, 'is_undercut': Y, 'competitor_price': Z, 'competitor_location_id': A, 'competitor_volume': B}, ...]
+            # `statuses` is a list of dicts: [{'order_id': X, 'is_undercut': Y, 'competitor_price': Z, 'competitor_location_id': A, 'competitor_volume': B,
+            #                                  'book_version': C, 'order_price': D}, ...]
             data_to_insert = [
-                (s['order_id'], character_id, s['is_undercut'], s.get('competitor_price'), s.get('competitor_location_id'), s.get('competitor_volume')) for s in statuses
+                (s['order_id'], character_id, s['is_undercut'], s.get('competitor_price'), s.get('competitor_location_id'), s.get('competitor_volume'),
+                 s.get('book_version'), s.get('order_price')) for s in statuses
             ]
             upsert_query = """
-                INSERT INTO undercut_statuses (order_id, character_id, is_undercut, competitor_price, competitor_location_id, competitor_volume)
-                VALUES (%s, %s, %s, %s, %s, %s)
+                INSERT INTO undercut_statuses (order_id, character_id, is_undercut, competitor_price, competitor_location_id, competitor_volume, book_version, order_price)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                 ON CONFLICT (order_id, character_id) DO UPDATE
                 SET is_undercut = EXCLUDED.is_undercut,
                     competitor_price = EXCLUDED.competitor_price,
                     competitor_location_id = EXCLUDED.competitor_location_id,
-                    competitor_volume = EXCLUDED.competitor_volume;
+                    competitor_volume = EXCLUDED.competitor_volume,
+                    book_version = EXCLUDED.book_version,
+                    order_price = EXCLUDED.order_price;
             """
             cursor.executemany(upsert_query, data_to_insert)
             conn.commit()
@@ -1273,28 +1442,35 @@ def remove_stale_undercut_statuses(character_id: int, current_order_ids: list[in
         database.release_db_connection(conn)
 
 
-def get_location_from_cache(location_id: int) -> dict | None:
-    """Retrieves a location's region and system from the local cache."""
+def get_locations_from_cache(location_ids: list) -> dict:
+    """Retrieves the region and system of several locations from the local cache in one query."""
+    if not location_ids:
+        return {}
     conn = database.get_db_connection()
-    location_info = None
+    locations = {}
     try:
         with conn.cursor() as cursor:
-            cursor.execute("SELECT system_id, region_id FROM location_cache WHERE location_id = %s", (location_id,))
-            row = cursor.fetchone()
-            if row:
-                location_info = {'system_id': row[0], 'region_id': row[1]}
+            cursor.execute(
+                "SELECT location_id, system_id, region_id FROM location_cache WHERE location_id = ANY(%s)",
+                (list(location_ids),)
+            )
+            for location_id, system_id, region_id in cursor.fetchall():
+                locations[location_id] = {'system_id': system_id, 'region_id': region_id}
     finally:
         database.release_db_connection(conn)
-    return location_info
+    return locations
+
 
-def save_location_to_cache(location_id: int, system_id: int, region_id: int):
-    """Saves a location's resolved system and region to the cache."""
+def save_locations_to_cache(locations: dict):
+    """Saves several resolved locations ({location_id: {'system_id', 'region_id'}}) to the cache."""
+    if not locations:
+        return
     conn = database.get_db_connection()
     try:
         with conn.cursor() as cursor:
-            cursor.execute(
+            cursor.executemany(
                 "INSERT INTO location_cache (location_id, system_id, region_id) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
-                (location_id, system_id, region_id)
+                [(location_id, loc['system_id'], loc['region_id']) for location_id, loc in locations.items()]
             )
             conn.commit()
     finally:
@@ -1338,20 +1514,144 @@ def save_jump_distance_to_db(origin_system_id: int, destination_system_id: int,
         database.release_db_connection(conn)
 
 
+def seed_jump_distances_from_universe():
+    """
+    Pre-populates jump_distances with the distance from every trade hub to every
+    system, using the static map data. Runs once per map data version.
+    """
+    version = universe.get_data_version()
+    if version is None or get_bot_state('jump_distances_seed_version') == version:
+        return
+
+    rows = []
+    for hub_id, system_id, jumps in universe.iter_hub_distances():
+        rows.append((hub_id, system_id, jumps))
+        rows.append((system_id, hub_id, jumps))
+
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.executemany(
+                """
+                INSERT INTO jump_distances (origin_system_id, destination_system_id, jumps)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (origin_system_id, destination_system_id) DO NOTHING
+                """,
+                rows
+            )
+            conn.commit()
+    finally:
+        database.release_db_connection(conn)
+    set_bot_state('jump_distances_seed_version', version)
+    logging.info(f"Seeded {len(rows)} hub jump distances from universe data version {version}.")
+
+
+def seed_location_cache_from_universe():
+    """
+    Loads every NPC station's system and region from the static map data into
+    location_cache. Runs once per map data version.
+    """
+    version = universe.get_data_version()
+    if version is None or get_bot_state('location_cache_seed_version') == version:
+        return
+
+    rows = list(universe.iter_station_locations())
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.executemany(
+                """
+                INSERT INTO location_cache (location_id, system_id, region_id) VALUES (%s, %s, %s)
+                ON CONFLICT (location_id) DO UPDATE SET system_id = EXCLUDED.system_id, region_id = EXCLUDED.region_id
+                """,
+                rows
+            )
+            conn.commit()
+    finally:
+        database.release_db_connection(conn)
+    set_bot_state('location_cache_seed_version', version)
+    logging.info(f"Seeded {len(rows)} station locations from universe data version {version}.")
+
+
 # --- ESI API Functions ---
 
+def build_esi_cache_key(url, character_id=None, params=None, data=None) -> str:
+    """
+    Returns the fixed-width esi_cache key for a request. The request is
+    canonicalized first, so param ordering does not produce different keys.
+    """
+    if isinstance(data, list):
+        data = sorted(data)
+    canonical = json.dumps(
+        {'url': url, 'character_id': character_id, 'params': params or None, 'data': data or None},
+        sort_keys=True, separators=(',', ':'), default=str
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def get_esi_endpoint(url) -> str:
+    """
+    Returns the ESI route for a URL with IDs and the version prefix removed,
+    e.g. '/markets/{id}/orders/'. Used to group esi_cache rows by endpoint.
+    """
+    segments = urlsplit(url).path.split('/')
+    if len(segments) > 1 and re.fullmatch(r'v\d+|latest|legacy|dev', segments[1]):
+        del segments[1]
+    return '/'.join('{id}' if segment.isdigit() else segment for segment in segments)
+
+
+_zstd_local = threading.local()
+
+
+def _zstd_compress(raw: bytes) -> bytes:
+    """Compresses bytes with a per-thread zstd compressor."""
+    if not hasattr(_zstd_local, 'compressor'):
+        _zstd_local.compressor = zstandard.ZstdCompressor(level=ESI_CACHE_ZSTD_LEVEL)
+    return _zstd_local.compressor.compress(raw)
+
+
+def _zstd_decompress(blob: bytes) -> bytes:
+    """Decompresses bytes with a per-thread zstd decompressor."""
+    if not hasattr(_zstd_local, 'decompressor'):
+        _zstd_local.decompressor = zstandard.ZstdDecompressor()
+    return _zstd_local.decompressor.decompress(blob)
+
+
+def _globs_to_like_patterns(patterns) -> list:
+    """Converts fnmatch-style globs to SQL LIKE patterns."""
+    return [
+        pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').replace('*', '%').replace('?', '_')
+        for pattern in patterns
+    ]
+
+
+def _should_compress_esi_cache(endpoint) -> bool:
+    """Returns True if the endpoint matches one of ESI_CACHE_COMPRESS_PATTERNS."""
+    return bool(endpoint) and any(fnmatch.fnmatchcase(endpoint, pattern) for pattern in ESI_CACHE_COMPRESS_PATTERNS)
+
+
+def _decode_esi_cache_response(response_json, response_blob, response_encoding):
+    """Returns the payload of an esi_cache row, whichever column it is stored in."""
+    if response_encoding == 'zstd':
+        return orjson.loads(_zstd_decompress(bytes(response_blob)))
+    return response_json  # Already parsed as dict by psycopg2
+
+
 def get_esi_cache_from_db(cache_key):
     """Retrieves a cached ESI response from the database."""
     conn = database.get_db_connection()
     cached_item = None
     try:
         with conn.cursor() as cursor:
-            cursor.execute("SELECT response, etag, expires, headers FROM esi_cache WHERE cache_key = %s", (cache_key,))
+            cursor.execute(
+                "SELECT response, response_blob, response_encoding, etag, expires, headers FROM esi_cache WHERE cache_key = %s",
+                (cache_key,)
+            )
             row = cursor.fetchone()
             if row:
-                response_json, etag, expires_dt, headers_json = row
+                response_json, response_blob, response_encoding, etag, expires_dt, headers_json = row
                 cached_item = {
-                    'data': response_json,  # Already parsed as dict by psycopg2
+                    'data': _decode_esi_cache_response(response_json, response_blob, response_encoding),
                     'etag': etag,
                     'expires': expires_dt, # Already a datetime object
                     'headers': headers_json # Already parsed as dict by psycopg2
@@ -1361,6 +1661,25 @@ def get_esi_cache_from_db(cache_key):
     return cached_item
 
 
+def update_esi_cache_metadata_in_db(cache_key, etag, expires_dt, headers) -> bool:
+    """
+    Updates only the ETag, expiry and headers of a cached ESI response, leaving the
+    stored payload untouched. Returns False if there was no row to update.
+    """
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "UPDATE esi_cache SET etag = %s, expires = %s, headers = %s WHERE cache_key = %s",
+                (etag, expires_dt, json.dumps(headers) if headers else None, cache_key)
+            )
+            updated = cursor.rowcount > 0
+            conn.commit()
+    finally:
+        database.release_db_connection(conn)
+    return updated
+
+
 def get_last_known_wallet_balance(character: Character) -> float | None:
     """
     Retrieves the most recent wallet balance for a character from the local DB cache.
@@ -1370,8 +1689,8 @@ def get_last_known_wallet_balance(character: Character) -> float | None:
         return None
     url = f"https://esi.evetech.net/v1/characters/{character.id}/wallet/"
     # Construct the cache key exactly as make_esi_request would for this endpoint
-    cache_key = f"{url}:{character.id}:None:"
-    cached_response = get_esi_cache_from_db(cache_key)
+    cache_key = build_esi_cache_key(url, character.id)
+    cached_response = get_esi_cache(cache_key)
     if cached_response and 'data' in cached_response:
         # The balance is stored directly as the JSON response
         return float(cached_response['data'])
@@ -1379,16 +1698,26 @@ def get_last_known_wallet_balance(character: Character) -> float | None:
     return None
 
 
-def save_esi_cache_to_db(cache_key, data, etag, expires_dt, headers):
-    """Saves an ESI response to the database cache."""
+def save_esi_cache_to_db(cache_key, data, etag, expires_dt, headers, character_id=None, endpoint=None):
+    """
+    Saves an ESI response to the database cache. Payloads for endpoints matching
+    ESI_CACHE_COMPRESS_PATTERNS are stored zstd-compressed instead of as JSONB.
+    """
+    if _should_compress_esi_cache(endpoint):
+        response_json, response_blob, response_encoding = None, _zstd_compress(orjson.dumps(data)), 'zstd'
+    else:
+        response_json, response_blob, response_encoding = json.dumps(data), None, None
+
     conn = database.get_db_connection()
     try:
         with conn.cursor() as cursor:
             upsert_query = """
-                INSERT INTO esi_cache (cache_key, response, etag, expires, headers)
-                VALUES (%s, %s, %s, %s, %s)
+                INSERT INTO esi_cache (cache_key, response, response_blob, response_encoding, etag, expires, headers, character_id, endpoint)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
                 ON CONFLICT (cache_key) DO UPDATE SET
                     response = EXCLUDED.response,
+                    response_blob = EXCLUDED.response_blob,
+                    response_encoding = EXCLUDED.response_encoding,
                     etag = EXCLUDED.etag,
                     expires = EXCLUDED.expires,
                     headers = EXCLUDED.headers;
@@ -1397,10 +1726,14 @@ def save_esi_cache_to_db(cache_key, data, etag, expires_dt, headers):
                 upsert_query,
                 (
                     cache_key,
-                    json.dumps(data),
+                    response_json,
+                    psycopg2.Binary(response_blob) if response_blob is not None else None,
+                    response_encoding,
                     etag,
                     expires_dt, # No need for isoformat, psycopg2 handles datetime
-                    json.dumps(headers) if headers else None
+                    json.dumps(headers) if headers else None,
+                    character_id,
+                    endpoint
                 )
             )
             conn.commit()
@@ -1408,23 +1741,234 @@ def save_esi_cache_to_db(cache_key, data, etag, expires_dt, headers):
         database.release_db_connection(conn)
 
 
-def make_esi_request(url, character=None, params=None, data=None, return_headers=False, force_revalidate=False):
+def compress_esi_cache_rows(batch_size: int = 200) -> int:
+    """
+    Migrates existing esi_cache rows that match ESI_CACHE_COMPRESS_PATTERNS from
+    JSONB to compressed storage, in batches. Safe to run repeatedly; returns the
+    number of rows converted.
+    """
+    if not ESI_CACHE_COMPRESS_PATTERNS:
+        return 0
+    like_patterns = _globs_to_like_patterns(ESI_CACHE_COMPRESS_PATTERNS)
+    converted = 0
+    conn = database.get_db_connection()
+    try:
+        while True:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT cache_key, response FROM esi_cache
+                    WHERE response_encoding IS NULL AND response IS NOT NULL AND endpoint LIKE ANY(%s)
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                    """,
+                    (like_patterns, batch_size)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                updates = [
+                    (psycopg2.Binary(_zstd_compress(orjson.dumps(response))), cache_key)
+                    for cache_key, response in rows
+                ]
+                cursor.executemany(
+                    "UPDATE esi_cache SET response = NULL, response_blob = %s, response_encoding = 'zstd' WHERE cache_key = %s",
+                    updates
+                )
+            conn.commit()
+            converted += len(rows)
+    finally:
+        database.release_db_connection(conn)
+    if converted:
+        logging.info(f"Compressed {converted} existing esi_cache rows.")
+    return converted
+
+
+# --- Layered ESI Response Cache ---
+# Lookups check the in-process LRU first, then Redis (entries live until their
+# Expires time), and only then the esi_cache table, which remains the durable
+# copy that survives restarts. Writes go through to all three tiers.
+
+_esi_memory_cache = memory_cache.ByteBudgetLRU(ESI_MEMORY_CACHE_BYTES, name="esi")
+
+
+def _is_esi_cache_fresh(cached_item) -> bool:
+    """Returns True if a cached ESI response has not yet passed its Expires time."""
+    return bool(cached_item) and cached_item['expires'] > datetime.now(timezone.utc)
+
+
+def _serialize_esi_cache_entry(data, etag, expires_dt, headers) -> bytes:
+    """Encodes a cached ESI response for storage in Redis."""
+    return orjson.dumps({
+        'data': data,
+        'etag': etag,
+        'expires': expires_dt.timestamp(),
+        'headers': headers
+    })
+
+
+def _deserialize_esi_cache_entry(raw: bytes):
+    """Decodes a cached ESI response read from Redis."""
+    entry = orjson.loads(raw)
+    entry['expires'] = datetime.fromtimestamp(entry['expires'], tz=timezone.utc)
+    return entry
+
+
+def _save_esi_cache_to_redis(cache_key, payload: bytes, expires_dt):
+    """Stores an encoded ESI response in Redis until it expires. Failures are logged and ignored."""
+    ttl = int((expires_dt - datetime.now(timezone.utc)).total_seconds())
+    if ttl <= 0:
+        return
+    try:
+        redis_client.get_redis().set(ESI_REDIS_CACHE_PREFIX + cache_key, payload, ex=ttl)
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Could not write ESI cache entry to Redis: {e}")
+
+
+def get_esi_cache(cache_key, persist_to_db=True):
+    """
+    Retrieves a cached ESI response, checking memory, then Redis, then the database.
+    A fresh entry is returned from the first tier that has one; otherwise the most
+    recent stale entry is returned so its ETag can be used for revalidation.
+    The memory tier holds encoded bytes so every caller gets its own copy of the data.
+    The database is not read if persist_to_db is False.
+    """
+    memory_raw = _esi_memory_cache.get(cache_key)
+    memory_item = _deserialize_esi_cache_entry(memory_raw) if memory_raw else None
+    if _is_esi_cache_fresh(memory_item):
+        return memory_item
+
+    try:
+        raw = redis_client.get_redis().get(ESI_REDIS_CACHE_PREFIX + cache_key)
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Could not read ESI cache entry from Redis: {e}")
+        raw = None
+    if raw:
+        _esi_memory_cache.put(cache_key, raw, len(raw))
+        return _deserialize_esi_cache_entry(raw)
+
+    if not persist_to_db:
+        return memory_item
+    try:
+        cached_item = get_esi_cache_from_db(cache_key)
+    except psycopg2.pool.PoolError as e:
+        # Every pooled connection is busy; treat it as a miss rather than fail the request.
+        logging.warning(f"Could not read ESI cache entry from the database: {e}")
+        cached_item = None
+    if not cached_item:
+        return memory_item
+
+    payload = _serialize_esi_cache_entry(cached_item['data'], cached_item['etag'], cached_item['expires'], cached_item['headers'])
+    _esi_memory_cache.put(cache_key, payload, len(payload))
+    if _is_esi_cache_fresh(cached_item):
+        _save_esi_cache_to_redis(cache_key, payload, cached_item['expires'])
+    return cached_item
+
+
+def save_esi_cache(cache_key, data, etag, expires_dt, headers, character_id=None, endpoint=None, persist_to_db=True):
+    """Saves an ESI response to every cache tier (but the database if persist_to_db is False)."""
+    payload = _serialize_esi_cache_entry(data, etag, expires_dt, headers)
+    _esi_memory_cache.put(cache_key, payload, len(payload))
+    _save_esi_cache_to_redis(cache_key, payload, expires_dt)
+    if not persist_to_db:
+        return
+    try:
+        save_esi_cache_to_db(cache_key, data, etag, expires_dt, headers, character_id, endpoint)
+    except psycopg2.pool.PoolError as e:
+        logging.warning(f"Could not write ESI cache entry to the database: {e}")
+
+
+def refresh_esi_cache_expiry(cache_key, cached_response, etag, expires_dt, headers, character_id=None, endpoint=None, persist_to_db=True):
+    """
+    Extends a cached ESI response after a 304 Not Modified. The memory and Redis
+    tiers are rewritten, but the database only has its metadata columns updated.
+    """
+    payload = _serialize_esi_cache_entry(cached_response['data'], etag, expires_dt, headers)
+    _esi_memory_cache.put(cache_key, payload, len(payload))
+    _save_esi_cache_to_redis(cache_key, payload, expires_dt)
+    if not persist_to_db:
+        return
+    try:
+        if not update_esi_cache_metadata_in_db(cache_key, etag, expires_dt, headers):
+            save_esi_cache_to_db(cache_key, cached_response['data'], etag, expires_dt, headers, character_id, endpoint)
+    except psycopg2.pool.PoolError as e:
+        logging.warning(f"Could not update ESI cache entry in the database: {e}")
+
+
+def _filter_esi_headers(headers):
+    """Reduces a response's headers to the ones worth caching, if minimal headers are enabled."""
+    if not ESI_CACHE_MINIMAL_HEADERS or not headers:
+        return headers
+    return {name: value for name, value in headers.items() if name.lower() in ESI_CACHED_HEADER_NAMES}
+
+
+def _merge_esi_headers(cached_headers, new_headers):
+    """Overlays new response headers onto cached ones, matching names case-insensitively."""
+    updated = {name.lower() for name in new_headers}
+    merged = {name: value for name, value in (cached_headers or {}).items() if name.lower() not in updated}
+    merged.update(new_headers)
+    return merged
+
+
+def purge_esi_cache_keys(cache_keys):
+    """Removes ESI responses from this process's memory cache and from Redis."""
+    if not cache_keys:
+        return
+    for cache_key in cache_keys:
+        _esi_memory_cache.pop(cache_key)
+    try:
+        client = redis_client.get_redis()
+        for i in range(0, len(cache_keys), 500):
+            client.delete(*[ESI_REDIS_CACHE_PREFIX + cache_key for cache_key in cache_keys[i:i + 500]])
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Could not purge {len(cache_keys)} ESI cache entries from Redis: {e}")
+
+
+def _is_esi_forbidden_tracked(endpoint) -> bool:
+    """Returns True if 403 responses of the endpoint are remembered (see ESI_FORBIDDEN_PATTERNS)."""
+    return bool(endpoint) and any(fnmatch.fnmatchcase(endpoint, pattern) for pattern in ESI_FORBIDDEN_PATTERNS)
+
+
+def is_esi_forbidden(url, character=None, params=None, data=None) -> bool:
+    """Returns True if this exact structure request recently returned 403 Forbidden."""
+    if not _is_esi_forbidden_tracked(get_esi_endpoint(url)):
+        return False
+    cache_key = build_esi_cache_key(url, character.id if character else None, params, data)
+    try:
+        return bool(redis_client.get_redis().exists(ESI_FORBIDDEN_PREFIX + cache_key))
+    except redis.exceptions.RedisError:
+        return False
+
+
+def _mark_esi_forbidden(cache_key):
+    """Records that a request returned 403 Forbidden so it isn't retried for ESI_FORBIDDEN_TTL."""
+    try:
+        redis_client.get_redis().set(ESI_FORBIDDEN_PREFIX + cache_key, 1, ex=ESI_FORBIDDEN_TTL)
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Could not record ESI 403 response: {e}")
+
+
+def make_esi_request(url, character=None, params=None, data=None, return_headers=False, force_revalidate=False, persist_to_db=True):
     """
     Makes a request to the ESI API, handling caching via ETag and Expires headers.
     If force_revalidate is True, it will ignore the time-based cache and use an ETag.
+    If persist_to_db is False, the response is cached in memory and Redis only.
     Returns the JSON response and optionally the response headers.
     """
-    data_key_part = ""
-    if data:
-        if isinstance(data, list):
-            data_key_part = str(sorted(data))
-        else:
-            data_key_part = str(data)
-    cache_key = f"{url}:{character.id if character else 'public'}:{str(params)}:{data_key_part}"
+    character_id = character.id if character else None
+    cache_key = build_esi_cache_key(url, character_id, params, data)
 
-    cached_response = get_esi_cache_from_db(cache_key)
+    cached_response = get_esi_cache(cache_key, persist_to_db)
     headers = {"Accept": "application/json"}
 
+    if not force_revalidate and cached_response and cached_response.get('expires', datetime.min.replace(tzinfo=timezone.utc)) > datetime.now(timezone.utc):
+        logging.debug(f"Returning cached data for {url}")
+        return (cached_response['data'], cached_response['headers']) if return_headers else cached_response['data']
+
+    if is_esi_forbidden(url, character, params, data):
+        logging.debug(f"Skipping {url}: it returned 403 Forbidden recently.")
+        return (None, None) if return_headers else None
+
     if character:
         access_token = get_access_token(character.id, character.refresh_token)
         if not access_token:
@@ -1432,28 +1976,48 @@ def make_esi_request(url, character=None, params=None, data=None, return_headers
             return (None, None) if return_headers else None
         headers["Authorization"] = f"Bearer {access_token}"
 
-    if not force_revalidate and cached_response and cached_response.get('expires', datetime.min.replace(tzinfo=timezone.utc)) > datetime.now(timezone.utc):
-        logging.debug(f"Returning DB-cached data for {url}")
-        return (cached_response['data'], cached_response['headers']) if return_headers else cached_response['data']
+    # Coalesce identical requests across workers: one caller fetches, the rest
+    # wait for it and then read the shared cache.
+    with redis_client.single_flight(f"esi:{cache_key}", lock_timeout=ESI_SINGLE_FLIGHT_TIMEOUT, wait_timeout=ESI_SINGLE_FLIGHT_TIMEOUT) as is_leader:
+        if not is_leader:
+            shared_response = get_esi_cache(cache_key, persist_to_db)
+            if _is_esi_cache_fresh(shared_response):
+                logging.debug(f"Returning data fetched by a concurrent request for {url}")
+                return (shared_response['data'], shared_response['headers']) if return_headers else shared_response['data']
+            cached_response = shared_response or cached_response
+        return _fetch_esi_response(url, cache_key, cached_response, headers, params, data, return_headers, character_id, persist_to_db)
+
 
+def _fetch_esi_response(url, cache_key, cached_response, headers, params, data, return_headers, character_id=None, persist_to_db=True):
+    """
+    Sends a request to ESI, revalidating cached_response via its ETag if present,
+    and stores the result in the ESI cache. Falls back to cached_response on failure.
+    """
+    endpoint = get_esi_endpoint(url)
     if cached_response and 'etag' in cached_response:
         headers['If-None-Match'] = cached_response['etag']
 
     try:
+        # Wait for the cluster-wide rate governor before touching ESI.
+        esi_governor.acquire()
+
         if data:
             headers["Content-Type"] = "application/json"
-            response = requests.post(url, headers=headers, json=data)
+            response = http_client.post(url, headers=headers, json=data)
         else:
-            response = requests.get(url, headers=headers, params=params)
+            response = http_client.get(url, headers=headers, params=params)
 
         log_esi_request(response.status_code)
+        esi_governor.record_response(response.status_code, response.headers)
 
         if response.status_code == 304:
-            logging.debug(f"304 Not Modified for {url}. Using DB-cached data.")
+            logging.debug(f"304 Not Modified for {url}. Using cached data.")
             new_expires_dt = datetime.strptime(response.headers['Expires'], '%a, %d %b %Y %H:%M:%S GMT').replace(tzinfo=timezone.utc)
-            # Update the expiry time in the cache for the existing data
-            save_esi_cache_to_db(cache_key, cached_response['data'], cached_response['etag'], new_expires_dt, dict(response.headers))
-            return (cached_response['data'], cached_response['headers']) if return_headers else cached_response['data']
+            new_etag = response.headers.get('ETag') or cached_response['etag']
+            merged_headers = _merge_esi_headers(cached_response['headers'], _filter_esi_headers(dict(response.headers)))
+            # The payload is unchanged, so only the cache metadata needs to be written.
+            refresh_esi_cache_expiry(cache_key, cached_response, new_etag, new_expires_dt, merged_headers, character_id, endpoint, persist_to_db)
+            return (cached_response['data'], merged_headers) if return_headers else cached_response['data']
 
         response.raise_for_status()
 
@@ -1464,22 +2028,95 @@ def make_esi_request(url, character=None, params=None, data=None, return_headers
             expires_dt = datetime.now(timezone.utc) + timedelta(seconds=60)
 
         new_data = response.json()
-        response_headers = dict(response.headers)
-        new_etag = response_headers.get('ETag')
+        new_etag = response.headers.get('ETag')
+        response_headers = _filter_esi_headers(dict(response.headers))
 
-        save_esi_cache_to_db(cache_key, new_data, new_etag, expires_dt, response_headers)
-        logging.debug(f"Cached new data for {url} to DB. Expires at {expires_dt}")
+        save_esi_cache(cache_key, new_data, new_etag, expires_dt, response_headers, character_id, endpoint, persist_to_db)
+        logging.debug(f"Cached new data for {url}. Expires at {expires_dt}")
 
         return (new_data, response_headers) if return_headers else new_data
 
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, esi_governor.ESIBudgetExhausted) as e:
         logging.error(f"Error making ESI request to {url}: {e}")
+        if (isinstance(e, requests.exceptions.HTTPError) and e.response is not None and e.response.status_code == 403
+                and _is_esi_forbidden_tracked(endpoint)):
+            # Access to the structure has been lost, so the cached copy can no longer be trusted either.
+            _mark_esi_forbidden(cache_key)
+            return (None, None) if return_headers else None
         if cached_response:
             logging.warning(f"Returning stale DB-cached data for {url} due to request failure.")
             return (cached_response['data'], cached_response['headers']) if return_headers else cached_response['data']
         return (None, None) if return_headers else None
 
 
+def get_header(headers, name):
+    """Case-insensitive lookup of a response header in a plain headers dict."""
+    if not headers:
+        return None
+    if name in headers:
+        return headers[name]
+    lowered = name.lower()
+    for key, value in headers.items():
+        if key.lower() == lowered:
+            return value
+    return None
+
+
+def fetch_all_pages(url, character=None, params=None, force_revalidate=False, item_filter=None, max_workers=None, persist_to_db=True):
+    """
+    Fetches every page of a paginated ESI endpoint.
+    Page 1 is fetched first to read the X-Pages header, then the remaining pages
+    are fetched concurrently with at most max_workers (default ESI_PAGE_WORKERS)
+    requests in flight. If item_filter is given, only items it accepts are kept,
+    which bounds memory use on very large endpoints.
+    Only page 1 honours force_revalidate; later pages use the normal cache rules.
+    persist_to_db is passed through to make_esi_request for every page.
+    Returns (items, first_page_headers) with items in page order, or (None, None)
+    if any page fails, so callers never act on a partial result.
+    """
+    def page_params(page):
+        merged = {"datasource": "tranquility", "page": page}
+        merged.update(params or {})
+        return merged
+
+    first_page, first_page_headers = make_esi_request(
+        url, character=character, params=page_params(1), return_headers=True, force_revalidate=force_revalidate,
+        persist_to_db=persist_to_db
+    )
+    if first_page is None:
+        logging.error(f"Failed to fetch page 1 of {url}.")
+        return None, None
+
+    all_items = [item for item in first_page if item_filter(item)] if item_filter else list(first_page)
+    try:
+        total_pages = int(get_header(first_page_headers, 'X-Pages') or 1)
+    except (ValueError, TypeError):
+        total_pages = 1
+
+    if not first_page or total_pages <= 1:
+        return all_items, first_page_headers
+
+    def fetch_page(page):
+        data = make_esi_request(url, character=character, params=page_params(page), persist_to_db=persist_to_db)
+        if data is not None and item_filter:
+            return [item for item in data if item_filter(item)]
+        return data
+
+    remaining_pages = range(2, total_pages + 1)
+    with ThreadPoolExecutor(max_workers=min(max_workers or ESI_PAGE_WORKERS, len(remaining_pages))) as executor:
+        # executor.map yields results in submission order, preserving page order.
+        results = list(executor.map(fetch_page, remaining_pages))
+
+    for page, data in zip(remaining_pages, results):
+        if data is None:
+            logging.error(f"Failed to fetch page {page} of {total_pages} for {url}.")
+            return None, None
+        all_items.extend(data)
+
+    logging.debug(f"Fetched {total_pages} pages ({len(all_items)} items) from {url}.")
+    return all_items, first_page_headers
+
+
 # --- ESI Access Token Caching ---
 def get_token_from_db(character_id: int):
     """Retrieves a token from the database for a given character ID."""
@@ -1518,60 +2155,129 @@ def save_token_to_db(character_id: int, access_token: str, expires_at: datetime)
         database.release_db_connection(conn)
 
 
-def get_access_token(character_id, refresh_token):
-    """
-    Retrieves a valid access token for a character, using a database cache
-    to avoid redundant requests and support multiple workers.
-    """
-    # 1. Check DB for a valid token
-    token_info = get_token_from_db(character_id)
-    if token_info and token_info['expires_at'] > datetime.now(timezone.utc) + timedelta(seconds=60):
-        logging.debug(f"Returning DB-cached access token for character {character_id}")
-        return token_info['access_token']
+# Per-process copy of access tokens, so authenticated requests don't need a DB
+# round-trip. Entries are only trusted until ACCESS_TOKEN_MIN_TTL before expiry.
+_access_token_cache = {}
+_access_token_cache_lock = threading.Lock()
 
-    # 2. If no valid token, request a new one
-    logging.info(f"No valid cached token in DB for character {character_id}. Requesting a new one.")
-    url = "https://login.eveonline.com/v2/oauth/token"
-    headers = {"Content-Type": "application/x-www-form-urlencoded", "Host": "login.eveonline.com"}
-    data = {
-        "grant_type": "refresh_token",
-        "refresh_token": refresh_token,
-        "client_id": os.getenv("ESI_CLIENT_ID"),
-        "client_secret": os.getenv("ESI_SECRET_KEY")
-    }
-    try:
-        response = requests.post(url, headers=headers, data=data)
-        response.raise_for_status()
-        token_data = response.json()
-        access_token = token_data.get("access_token")
-        expires_in = token_data.get("expires_in", 1200)  # Default to 20 minutes
 
-        # 3. Save the new token to DB
-        expires_at = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
-        save_token_to_db(character_id, access_token, expires_at)
+def _cache_access_token(character_id, access_token, expires_at):
+    """Stores an access token in the in-process cache."""
+    with _access_token_cache_lock:
+        _access_token_cache[character_id] = {'access_token': access_token, 'expires_at': expires_at}
 
-        logging.info(f"Successfully obtained and cached new access token in DB for character {character_id}")
-        return access_token
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error refreshing access token for character {character_id}: {e}")
-        # As a fallback, try to use the (likely expired) token from the DB if one exists.
-        # This might allow some requests to succeed if the token is only just expired.
-        if token_info:
-            logging.warning(f"Returning stale access token for character {character_id} due to refresh failure.")
-            return token_info['access_token']
-        return None
 
-def get_character_details_from_token(access_token):
-    url = "https://login.eveonline.com/oauth/verify"
-    headers = {"Authorization": f"Bearer {access_token}"}
+def _get_valid_token(token_info):
+    """Returns the token from token_info if it is valid for at least ACCESS_TOKEN_MIN_TTL seconds."""
+    if token_info and token_info['expires_at'] > datetime.now(timezone.utc) + timedelta(seconds=ACCESS_TOKEN_MIN_TTL):
+        return token_info['access_token']
+    return None
+
+
+def refresh_access_token(character_id, refresh_token):
+    """
+    Exchanges a refresh token for a new access token and caches it in memory and
+    the database. A Redis lock ensures only one process refreshes a given
+    character's token; the others wait and pick up its result from the database.
+    Returns the new access token, or None on failure.
+    """
+    with redis_client.single_flight(f"sso:token:{character_id}") as is_leader:
+        # Another process may have refreshed the token while we were waiting.
+        token_info = get_token_from_db(character_id)
+        access_token = _get_valid_token(token_info)
+        if access_token:
+            _cache_access_token(character_id, access_token, token_info['expires_at'])
+            if not is_leader or token_info['expires_at'] > datetime.now(timezone.utc) + timedelta(seconds=ACCESS_TOKEN_REFRESH_AHEAD):
+                return access_token
+
+        url = "https://login.eveonline.com/v2/oauth/token"
+        headers = {"Content-Type": "application/x-www-form-urlencoded", "Host": "login.eveonline.com"}
+        data = {
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+            "client_id": os.getenv("ESI_CLIENT_ID"),
+            "client_secret": os.getenv("ESI_SECRET_KEY")
+        }
+        try:
+            response = http_client.post(url, headers=headers, data=data)
+            response.raise_for_status()
+            token_data = response.json()
+            access_token = token_data.get("access_token")
+            expires_in = token_data.get("expires_in", 1200)  # Default to 20 minutes
+
+            expires_at = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+            save_token_to_db(character_id, access_token, expires_at)
+            _cache_access_token(character_id, access_token, expires_at)
+
+            logging.info(f"Successfully obtained and cached new access token for character {character_id}")
+            return access_token
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error refreshing access token for character {character_id}: {e}")
+            return None
+
+
+def get_access_token(character_id, refresh_token):
+    """
+    Retrieves a valid access token for a character. Tokens are served from an
+    in-process cache, then the database, and only refreshed via SSO when both
+    are missing or about to expire.
+    """
+    # 1. Check the in-process cache
+    with _access_token_cache_lock:
+        token_info = _access_token_cache.get(character_id)
+    access_token = _get_valid_token(token_info)
+    if access_token:
+        return access_token
+
+    # 2. Check DB for a valid token, which another process may have refreshed
+    token_info = get_token_from_db(character_id)
+    access_token = _get_valid_token(token_info)
+    if access_token:
+        logging.debug(f"Returning DB-cached access token for character {character_id}")
+        _cache_access_token(character_id, access_token, token_info['expires_at'])
+        return access_token
+
+    # 3. If no valid token, request a new one
+    logging.info(f"No valid cached token for character {character_id}. Requesting a new one.")
+    access_token = refresh_access_token(character_id, refresh_token)
+    if access_token:
+        return access_token
+
+    # As a fallback, try to use the (likely expired) token from the DB if one exists.
+    # This might allow some requests to succeed if the token is only just expired.
+    if token_info:
+        logging.warning(f"Returning stale access token for character {character_id} due to refresh failure.")
+        return token_info['access_token']
+    return None
+
+
+def get_characters_with_expiring_tokens() -> list[tuple[int, str]]:
+    """
+    Returns (character_id, refresh_token) for active characters whose cached access
+    token is still valid but expires within ACCESS_TOKEN_REFRESH_AHEAD seconds.
+    """
+    conn = database.get_db_connection()
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        return data.get("CharacterID"), data.get("CharacterName")
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error getting character details: {e}")
-        return None, None
+        with conn.cursor() as cursor:
+            now = datetime.now(timezone.utc)
+            cursor.execute(
+                """
+                SELECT c.character_id, c.refresh_token
+                FROM characters c
+                JOIN access_tokens t ON t.character_id = c.character_id
+                WHERE c.deletion_scheduled_at IS NULL
+                  AND t.expires_at > %s AND t.expires_at <= %s
+                """,
+                (now, now + timedelta(seconds=ACCESS_TOKEN_REFRESH_AHEAD))
+            )
+            return cursor.fetchall()
+    finally:
+        database.release_db_connection(conn)
+
+
+def get_character_details_from_token(access_token):
+    """Returns (character_id, character_name) for an access token, validated locally as a JWT."""
+    return sso.get_character_details_from_token(access_token)
 
 def get_wallet_journal(character, fetch_all=False, return_headers=False):
     """
@@ -1582,36 +2288,17 @@ def get_wallet_journal(character, fetch_all=False, return_headers=False):
     if not character:
         return (None, None) if return_headers else None
 
-    all_entries, page = [], 1
     url = f"https://esi.evetech.net/v6/characters/{character.id}/wallet/journal/"
-    first_page_headers = None
-
-    while True:
-        params = {"datasource": "tranquility", "page": page}
-        revalidate_this_page = (not fetch_all) or (page == 1)
-        data, headers = make_esi_request(url, character=character, params=params, return_headers=True, force_revalidate=revalidate_this_page)
-
-        if data is None: # Explicitly check for API failure
-            logging.error(f"Failed to fetch page {page} of wallet journal for {character.name}.")
-            return (None, None) if return_headers else None
-
-        if page == 1:
-            first_page_headers = headers
-
-        if not data: # Empty list means no more pages
-            break
 
-        all_entries.extend(data)
-
-        if not fetch_all:
-            break
-
-        pages_header = headers.get('x-pages') if headers else None
-        if not pages_header or int(pages_header) <= page:
-            break
+    if fetch_all:
+        all_entries, first_page_headers = fetch_all_pages(url, character=character, force_revalidate=True)
+    else:
+        params = {"datasource": "tranquility", "page": 1}
+        all_entries, first_page_headers = make_esi_request(url, character=character, params=params, return_headers=True, force_revalidate=True)
 
-        page += 1
-        time.sleep(0.1)
+    if all_entries is None: # Explicitly check for API failure
+        logging.error(f"Failed to fetch wallet journal for {character.name}.")
+        return (None, None) if return_headers else None
 
     if return_headers:
         return all_entries, first_page_headers
@@ -1655,34 +2342,12 @@ def get_character_assets(character, return_headers=False, force_revalidate=False
     if not character:
         return (None, None) if return_headers else None
 
-    all_assets = []
-    page = 1
     url = f"https://esi.evetech.net/v5/characters/{character.id}/assets/"
-    first_page_headers = None
-
-    while True:
-        params = {"datasource": "tranquility", "page": page}
-        revalidate_this_page = force_revalidate and page == 1
-        data, headers = make_esi_request(url, character=character, params=params, return_headers=True, force_revalidate=revalidate_this_page)
-
-        if data is None:
-            logging.error(f"Failed to fetch page {page} of assets for {character.name}.")
-            return (None, None) if return_headers else None
+    all_assets, first_page_headers = fetch_all_pages(url, character=character, force_revalidate=force_revalidate)
 
-        if page == 1:
-            first_page_headers = headers
-
-        if not data:
-            break
-
-        all_assets.extend(data)
-
-        pages_header = headers.get('x-pages') if headers else None
-        if not pages_header or int(pages_header) <= page:
-            break
-
-        page += 1
-        time.sleep(0.1)
+    if all_assets is None: # Explicitly check for API failure
+        logging.error(f"Failed to fetch assets for {character.name}.")
+        return (None, None) if return_headers else None
 
     if return_headers:
         return all_assets, first_page_headers
@@ -1694,34 +2359,12 @@ def get_character_blueprints(character, return_headers=False, force_revalidate=F
     if not character:
         return (None, None) if return_headers else None
 
-    all_blueprints = []
-    page = 1
     url = f"https://esi.evetech.net/v3/characters/{character.id}/blueprints/"
-    first_page_headers = None
-
-    while True:
-        params = {"datasource": "tranquility", "page": page}
-        revalidate_this_page = force_revalidate and page == 1
-        data, headers = make_esi_request(url, character=character, params=params, return_headers=True, force_revalidate=revalidate_this_page)
-
-        if data is None:
-            logging.error(f"Failed to fetch page {page} of blueprints for {character.name}.")
-            return (None, None) if return_headers else None
-
-        if page == 1:
-            first_page_headers = headers
-
-        if not data:
-            break
+    all_blueprints, first_page_headers = fetch_all_pages(url, character=character, force_revalidate=force_revalidate)
 
-        all_blueprints.extend(data)
-
-        pages_header = headers.get('x-pages') if headers else None
-        if not pages_header or int(pages_header) <= page:
-            break
-
-        page += 1
-        time.sleep(0.1)
+    if all_blueprints is None: # Explicitly check for API failure
+        logging.error(f"Failed to fetch blueprints for {character.name}.")
+        return (None, None) if return_headers else None
 
     if return_headers:
         return all_blueprints, first_page_headers
@@ -1797,34 +2440,12 @@ def get_contracts(character, return_headers=False, force_revalidate=False):
     if not character:
         return (None, None) if return_headers else None
 
-    all_contracts = []
-    page = 1
     url = f"https://esi.evetech.net/v1/characters/{character.id}/contracts/"
-    first_page_headers = None
-
-    while True:
-        params = {"datasource": "tranquility", "page": page}
-        revalidate_this_page = force_revalidate and page == 1
-        data, headers = make_esi_request(url, character=character, params=params, return_headers=True, force_revalidate=revalidate_this_page)
+    all_contracts, first_page_headers = fetch_all_pages(url, character=character, force_revalidate=force_revalidate)
 
-        if data is None: # Explicitly check for API failure
-            logging.error(f"Failed to fetch page {page} of contracts for {character.name}.")
-            return (None, None) if return_headers else None
-
-        if page == 1:
-            first_page_headers = headers
-
-        if not data: # Empty list means no more pages
-            break
-
-        all_contracts.extend(data)
-
-        pages_header = headers.get('x-pages') if headers else None
-        if not pages_header or int(pages_header) <= page:
-            break
-
-        page += 1
-        time.sleep(0.1)
+    if all_contracts is None: # Explicitly check for API failure
+        logging.error(f"Failed to fetch contracts for {character.name}.")
+        return (None, None) if return_headers else None
 
     if return_headers:
         return all_contracts, first_page_headers
@@ -1839,34 +2460,12 @@ def get_market_orders_history(character, return_headers=False, force_revalidate=
     if not character:
         return (None, None) if return_headers else None
 
-    all_orders = []
-    page = 1
     url = f"https://esi.evetech.net/v2/characters/{character.id}/orders/history/"
-    first_page_headers = None
-
-    while True:
-        params = {"datasource": "tranquility", "page": page}
-        revalidate_this_page = force_revalidate and page == 1
-        data, headers = make_esi_request(url, character=character, params=params, return_headers=True, force_revalidate=revalidate_this_page)
+    all_orders, first_page_headers = fetch_all_pages(url, character=character, force_revalidate=force_revalidate)
 
-        if data is None: # Explicitly check for API failure
-            logging.error(f"Failed to fetch page {page} of order history for {character.name}.")
-            return (None, None) if return_headers else None
-
-        if page == 1:
-            first_page_headers = headers
-
-        if not data: # Empty list means no more pages
-            break
-
-        all_orders.extend(data)
-
-        pages_header = headers.get('x-pages') if headers else None
-        if not pages_header or int(pages_header) <= page:
-            break
-
-        page += 1
-        time.sleep(0.1)
+    if all_orders is None: # Explicitly check for API failure
+        logging.error(f"Failed to fetch order history for {character.name}.")
+        return (None, None) if return_headers else None
 
     if return_headers:
         return all_orders, first_page_headers
@@ -1881,69 +2480,349 @@ def get_structure_market_orders(character: Character, structure_id: int, force_r
     if not character:
         return None
 
-    all_orders = []
-    page = 1
     url = f"https://esi.evetech.net/v1/markets/structures/{structure_id}/"
+    all_orders, _ = fetch_all_pages(url, character=character, force_revalidate=force_revalidate)
 
-    while True:
-        params = {"datasource": "tranquility", "page": page}
-        # Only force revalidation on the first page.
-        revalidate_this_page = force_revalidate and page == 1
-        data, headers = make_esi_request(
-            url,
-            character=character,
-            params=params,
-            return_headers=True,
-            force_revalidate=revalidate_this_page
-        )
-
-        if data is None: # A None response indicates an error, not just an empty page
-            logging.error(f"Failed to fetch market orders for structure {structure_id} on page {page}.")
-            # Return None to indicate failure, as partial data could be misleading.
-            return None
+    if all_orders is None: # A None response indicates an error, not just an empty page
+        logging.error(f"Failed to fetch market orders for structure {structure_id}.")
+        # Return None to indicate failure, as partial data could be misleading.
+        return None
 
-        if not data: # An empty list means we've reached the last page
-            break
+    return all_orders
 
-        all_orders.extend(data)
 
-        pages_header = headers.get('x-pages') if headers else None
-        if not pages_header or int(pages_header) <= page:
-            break
+def get_region_market_orders(region_id, type_id, force_revalidate=False):
+    """
+    Fetches all pages of market orders for a specific type in a region from ESI.
+    Returns an empty list if any page fails, as partial data could be misleading.
+    """
+    url = f"https://esi.evetech.net/v1/markets/{region_id}/orders/"
+    all_orders, _ = fetch_all_pages(url, params={"type_id": type_id}, force_revalidate=force_revalidate)
 
-        page += 1
-        time.sleep(0.1) # Be nice to ESI
+    if all_orders is None:
+        logging.error(f"Failed to fetch market orders for type {type_id} in region {region_id}.")
+        return []
 
     return all_orders
 
 
-def get_region_market_orders(region_id, type_id, force_revalidate=False):
+# --- Shared Market Books ---
+# Order books are fetched once per poll cycle by refresh_market_snapshot() and
+# published to Redis, so every character's undercut check reads the same copy
+# instead of fetching the book again. Each published book is a top-of-book
+# index: only the MARKET_BOOK_TOP_LEVELS best orders per side are kept.
+
+MARKET_BOOK_FIELDS = ('order_id', 'price', 'location_id', 'volume_remain', 'issued')
+
+
+def _build_market_book(orders, etag=None) -> dict:
     """
-    Fetches all pages of market orders for a specific type in a region from ESI.
+    Builds the top-of-book index for a list of ESI market orders: the best
+    MARKET_BOOK_TOP_LEVELS sell (lowest) and buy (highest) orders, best first,
+    with only the fields undercut checks use.
+    """
+    sell = [o for o in orders if not o.get('is_buy_order')]
+    buy = [o for o in orders if o.get('is_buy_order')]
+    best_sell = heapq.nsmallest(MARKET_BOOK_TOP_LEVELS, sell, key=lambda o: o['price'])
+    best_buy = heapq.nlargest(MARKET_BOOK_TOP_LEVELS, buy, key=lambda o: o['price'])
+    book = {
+        'sell': [{field: o.get(field) for field in MARKET_BOOK_FIELDS} for o in best_sell],
+        'buy': [{field: o.get(field) for field in MARKET_BOOK_FIELDS} for o in best_buy],
+        'etag': etag
+    }
+    # Undercut results depend only on these levels, so a digest of them is an exact
+    # book version even when the ESI ETag covers just the first page of a large book.
+    book['version'] = hashlib.sha1(orjson.dumps([book['sell'], book['buy']])).hexdigest()
+    return book
+
+
+def evaluate_undercuts(orders, books, previous_statuses, previous_prices):
+    """
+    Evaluates a batch of orders against their top-of-book indexes in one vectorized pass.
+    For each order, the competitor is the best order on the same side of its book
+    other than the order itself, if that order beats its price.
+    Returns (competitors, transitions): competitors[i] is the competing order or None,
+    and transitions[i] is 'undercut' if orders[i] has just been undercut or outbid,
+    'back_on_top' if it is on top again at an unchanged price, or None.
+    """
+    n = len(orders)
+    if n == 0:
+        return [], []
+
+    # One row per order, one column per book level; missing levels are NaN / -1.
+    levels = [
+        ((book or {}).get('buy' if order.get('is_buy_order') else 'sell') or [])[:MARKET_BOOK_TOP_LEVELS]
+        for order, book in zip(orders, books)
+    ]
+    padding = [MARKET_BOOK_TOP_LEVELS - len(row) for row in levels]
+    level_prices = np.array([[level['price'] for level in row] + [np.nan] * pad for row, pad in zip(levels, padding)], dtype=float)
+    level_ids = np.array([[level['order_id'] for level in row] + [-1] * pad for row, pad in zip(levels, padding)], dtype=np.int64)
+
+    order_ids = np.array([o['order_id'] for o in orders], dtype=np.int64)
+    order_prices = np.array([o['price'] for o in orders], dtype=float)
+    is_buy = np.array([bool(o.get('is_buy_order')) for o in orders])
+    was_undercut = np.array([previous_statuses.get(o['order_id'], {}).get('is_undercut', False) for o in orders], dtype=bool)
+    previous_price = np.array([previous_prices.get(o['order_id'], np.nan) for o in orders], dtype=float)
+
+    # The first valid level that isn't the order itself is its best competitor.
+    candidates = ~np.isnan(level_prices) & (level_ids != order_ids[:, None])
+    has_candidate = candidates.any(axis=1)
+    best_level = candidates.argmax(axis=1)
+    best_price = level_prices[np.arange(n), best_level]
+    is_undercut = has_candidate & np.where(is_buy, best_price > order_prices, best_price < order_prices)
+
+    newly_undercut = is_undercut & ~was_undercut
+    back_on_top = ~is_undercut & was_undercut & (order_prices == previous_price)
+
+    competitors = [levels[i][best_level[i]] if is_undercut[i] else None for i in range(n)]
+    transitions = [
+        'undercut' if newly_undercut[i] else 'back_on_top' if back_on_top[i] else None
+        for i in range(n)
+    ]
+    return competitors, transitions
+
+
+def publish_market_books(scope, books: dict):
+    """
+    Publishes market books, given as {type_id: book}, to Redis for other workers to read.
+    The scope is a region ID, or "structure:<id>" for a player structure's market.
+    """
+    if not books:
+        return
+    try:
+        pipe = redis_client.get_redis().pipeline(transaction=False)
+        for type_id, book in books.items():
+            pipe.set(f"{MARKET_BOOK_PREFIX}{scope}:{type_id}", orjson.dumps(book), ex=MARKET_BOOK_TTL)
+        pipe.set(MARKET_SNAPSHOT_PUBLISHED_KEY, datetime.now(timezone.utc).isoformat())
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Could not publish {len(books)} market books for {scope}: {e}")
+
+
+def publish_market_book(scope, type_id, book):
+    """Publishes a single market book to Redis for other workers to read."""
+    publish_market_books(scope, {type_id: book})
+
+
+def get_published_market_book(scope, type_id) -> dict | None:
+    """Returns the market book published for this cycle, or None if there isn't one."""
+    try:
+        raw = redis_client.get_redis().get(f"{MARKET_BOOK_PREFIX}{scope}:{type_id}")
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Could not read market book for type {type_id} in {scope}: {e}")
+        return None
+    return orjson.loads(raw) if raw else None
+
+
+def fetch_region_market_book(region_id, type_id) -> dict | None:
+    """Fetches a region's order book for one type from ESI and publishes it. Returns None on failure."""
+    url = f"https://esi.evetech.net/v1/markets/{region_id}/orders/"
+    orders, headers = fetch_all_pages(url, params={"type_id": type_id}, force_revalidate=True)
+    if orders is None:
+        logging.error(f"Failed to fetch market orders for type {type_id} in region {region_id}.")
+        return None
+    book = _build_market_book(orders, get_header(headers, 'ETag'))
+    publish_market_book(region_id, type_id, book)
+    return book
+
+
+def fetch_whole_region_books(region_id, type_ids) -> bool:
+    """
+    Ingests a region's complete order book, fetching all pages concurrently, and
+    publishes a book for each of the given types (empty if the type has no orders).
+    Orders for other types are dropped as each page arrives. The pages are re-fetched
+    every snapshot, so they are cached in memory and Redis but not in the database.
+    Returns False if any page failed, in which case nothing is published.
     """
-    all_orders = []
-    page = 1
+    wanted = set(type_ids)
     url = f"https://esi.evetech.net/v1/markets/{region_id}/orders/"
+    orders, headers = fetch_all_pages(
+        url, params={"order_type": "all"}, force_revalidate=True,
+        item_filter=lambda o: o['type_id'] in wanted, max_workers=MARKET_REGION_BOOK_WORKERS,
+        persist_to_db=False
+    )
+    if orders is None:
+        logging.error(f"Failed to ingest the whole order book for region {region_id}.")
+        return False
+
+    orders_by_type = defaultdict(list)
+    for order in orders:
+        orders_by_type[order['type_id']].append(order)
+    etag = get_header(headers, 'ETag')
+    publish_market_books(region_id, {type_id: _build_market_book(orders_by_type.get(type_id, []), etag) for type_id in wanted})
+    logging.info(f"Ingested whole order book for region {region_id}: {len(orders)} orders across {len(wanted)} tracked types.")
+    return True
 
-    while True:
-        params = {"datasource": "tranquility", "page": page, "type_id": type_id}
-        # Only force revalidation on the first page.
-        revalidate_this_page = force_revalidate and page == 1
-        data, headers = make_esi_request(url, params=params, return_headers=True, force_revalidate=revalidate_this_page)
 
-        if not data:
-            break
+def get_market_book(region_id, type_id) -> dict | None:
+    """
+    Returns the order book for a type in a region, preferring the copy published by
+    this cycle's snapshot and fetching it directly only if none is available.
+    """
+    book = get_published_market_book(region_id, type_id)
+    if book is not None:
+        return book
+    return fetch_region_market_book(region_id, type_id)
 
-        all_orders.extend(data)
 
-        pages_header = headers.get('x-pages') if headers else None
-        if not pages_header or int(pages_header) <= page:
-            break
+def _structure_market_state(structure_id) -> str | None:
+    """Returns 'fetched' if the structure's book was published this cycle, 'forbidden' if it is inaccessible, else None."""
+    try:
+        client = redis_client.get_redis()
+        if client.exists(f"market:structure:{structure_id}:forbidden"):
+            return 'forbidden'
+        if client.exists(f"market:structure:{structure_id}:fetched"):
+            return 'fetched'
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Could not read market state for structure {structure_id}: {e}")
+    return None
 
-        page += 1
-        time.sleep(0.1) # Be nice to ESI
 
-    return all_orders
+def get_structure_market_candidates(structure_id) -> list[int]:
+    """Returns the IDs of active characters with open orders in a structure, who can likely read its market."""
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT DISTINCT mo.character_id
+                FROM market_orders mo
+                JOIN characters c ON c.character_id = mo.character_id
+                WHERE (mo.order_data->>'location_id')::BIGINT = %s AND c.deletion_scheduled_at IS NULL
+            """, (structure_id,))
+            return [row[0] for row in cursor.fetchall()]
+    finally:
+        database.release_db_connection(conn)
+
+
+def fetch_structure_market_books(structure_id, preferred_character_id=None) -> bool:
+    """
+    Fetches a player structure's whole market once and publishes a book for every
+    type in it. Characters with orders in the structure are tried in turn, skipping
+    any that recently got 403 Forbidden. If none have access, the structure is
+    skipped for MARKET_STRUCTURE_FORBIDDEN_TTL. Concurrent callers share one fetch.
+    Returns True if the structure's books are available for this cycle.
+    """
+    with redis_client.single_flight(f"market:structure:{structure_id}", lock_timeout=120, wait_timeout=120) as is_leader:
+        state = _structure_market_state(structure_id)
+        if state is not None or not is_leader:
+            return state == 'fetched'
+
+        url = f"https://esi.evetech.net/v1/markets/structures/{structure_id}/"
+        first_page_params = {"datasource": "tranquility", "page": 1}
+        candidate_ids = get_structure_market_candidates(structure_id)
+        if preferred_character_id is not None:
+            candidate_ids = [preferred_character_id] + [c for c in candidate_ids if c != preferred_character_id]
+
+        for character_id in candidate_ids:
+            character = get_character_by_id(character_id)
+            if not character or is_esi_forbidden(url, character, first_page_params):
+                continue
+            orders = get_structure_market_orders(character, structure_id, force_revalidate=True)
+            if orders is None:
+                if is_esi_forbidden(url, character, first_page_params):
+                    logging.info(f"Character {character.name} cannot read the market of structure {structure_id}.")
+                    continue
+                return False  # A transient failure; try again next cycle.
+
+            orders_by_type = defaultdict(list)
+            for order in orders:
+                orders_by_type[order['type_id']].append(order)
+            publish_market_books(f"structure:{structure_id}", {type_id: _build_market_book(type_orders) for type_id, type_orders in orders_by_type.items()})
+            try:
+                redis_client.get_redis().set(f"market:structure:{structure_id}:fetched", 1, ex=MARKET_BOOK_TTL)
+            except redis.exceptions.RedisError as e:
+                logging.warning(f"Could not mark market of structure {structure_id} as fetched: {e}")
+            logging.info(f"Fetched market of structure {structure_id} with {character.name}: {len(orders)} orders across {len(orders_by_type)} types.")
+            return True
+
+        logging.warning(f"No character can read the market of structure {structure_id}. Skipping it for {MARKET_STRUCTURE_FORBIDDEN_TTL}s.")
+        try:
+            redis_client.get_redis().set(f"market:structure:{structure_id}:forbidden", 1, ex=MARKET_STRUCTURE_FORBIDDEN_TTL)
+        except redis.exceptions.RedisError as e:
+            logging.warning(f"Could not mark structure {structure_id} as inaccessible: {e}")
+        return False
+
+
+def get_structure_market_book(structure_id, type_id, character_id=None) -> dict | None:
+    """
+    Returns the order book for a type in a player structure, fetching the structure's
+    market if it hasn't been fetched this cycle. Returns None if it is inaccessible.
+    """
+    scope = f"structure:{structure_id}"
+    book = get_published_market_book(scope, type_id)
+    if book is not None:
+        return book
+    if not fetch_structure_market_books(structure_id, character_id):
+        return None
+    # The structure was fetched, so a type without a published book has no orders there.
+    return get_published_market_book(scope, type_id) or _build_market_book([])
+
+
+def get_tracked_structure_ids() -> set[int]:
+    """Returns the IDs of player structures where any character has open orders."""
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT DISTINCT (order_data->>'location_id')::BIGINT
+                FROM market_orders
+                WHERE (order_data->>'location_id')::BIGINT > 10000000000
+            """)
+            return {row[0] for row in cursor.fetchall()}
+    finally:
+        database.release_db_connection(conn)
+
+
+def get_tracked_region_type_pairs() -> set[tuple[int, int]]:
+    """Returns the distinct (region_id, type_id) pairs across every character's open orders."""
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT DISTINCT (order_data->>'region_id')::INTEGER, (order_data->>'type_id')::INTEGER
+                FROM market_orders
+                WHERE order_data ? 'region_id'
+            """)
+            return set(cursor.fetchall())
+    finally:
+        database.release_db_connection(conn)
+
+
+def refresh_market_snapshot():
+    """
+    Fetches every order book tracked by any character once and publishes it.
+    Runs at the start of each order-poll cycle, before the per-character polls.
+    """
+    structure_ids = get_tracked_structure_ids()
+    if structure_ids:
+        logging.info(f"Refreshing market snapshot for {len(structure_ids)} structures.")
+        with ThreadPoolExecutor(max_workers=MARKET_SNAPSHOT_WORKERS) as executor:
+            list(executor.map(fetch_structure_market_books, structure_ids))
+
+    pairs = get_tracked_region_type_pairs()
+    if not pairs:
+        return
+    logging.info(f"Refreshing market snapshot for {len(pairs)} region/type pairs.")
+
+    types_by_region = defaultdict(set)
+    for region_id, type_id in pairs:
+        types_by_region[region_id].add(type_id)
+
+    # Busy regions are cheaper to pull whole; everything else is fetched per type.
+    per_type_pairs = []
+    for region_id, type_ids in types_by_region.items():
+        if MARKET_REGION_BOOK_MIN_TYPES and len(type_ids) >= MARKET_REGION_BOOK_MIN_TYPES:
+            if fetch_whole_region_books(region_id, type_ids):
+                continue
+            logging.warning(f"Falling back to per-type book fetches for region {region_id}.")
+        per_type_pairs.extend((region_id, type_id) for type_id in type_ids)
+
+    if not per_type_pairs:
+        return
+    with ThreadPoolExecutor(max_workers=MARKET_SNAPSHOT_WORKERS) as executor:
+        results = list(executor.map(lambda pair: fetch_region_market_book(*pair), per_type_pairs))
+    failed = sum(1 for book in results if book is None)
+    logging.info(f"Market snapshot refreshed: {len(per_type_pairs) - failed} per-type books published, {failed} failed.")
 
 
 def get_market_history(type_id, region_id, force_revalidate=False):
@@ -2064,7 +2943,7 @@ def get_cached_image(url: str, force_revalidate: bool = False) -> bytes | None:
         headers['If-None-Match'] = cached['etag']
 
     try:
-        res = requests.get(url, headers=headers, timeout=10)
+        res = http_client.get(url, headers=headers, timeout=10)
         if res.status_code == 304:  # Not Modified
             logging.debug(f"Returning cached image for {url} (304 Not Modified).")
             return bytes(cached['data'])  # Return the stored binary data
@@ -2087,204 +2966,904 @@ def get_cached_image(url: str, force_revalidate: bool = False) -> bytes | None:
         return None
 
 
-def get_names_from_ids(id_list, character: Character = None):
+def get_names_from_ids(id_list, character: Character = None):
+    """
+    Resolves a list of IDs to names, using a local database cache and authenticated
+    calls for private structures if a character is provided.
+    """
+    if not id_list:
+        return {}
+
+    unique_ids = list(set(int(i) for i in id_list if isinstance(i, int) and i > 0))
+    if not unique_ids:
+        return {}
+
+    logging.debug(f"get_names_from_ids called for {len(unique_ids)} unique IDs.")
+    all_resolved_names = get_names_from_db(unique_ids)
+    missing_ids = [id for id in unique_ids if id not in all_resolved_names]
+
+    if not missing_ids:
+        return all_resolved_names
+
+    # ESI's /universe/names/ endpoint can resolve most public IDs.
+    # It has a limit of 1000 IDs per request.
+    public_ids_to_fetch = [id for id in missing_ids if id < 10000000000]
+    if public_ids_to_fetch:
+        logging.info(f"Resolving {len(public_ids_to_fetch)} public names from ESI.")
+        url = "https://esi.evetech.net/v3/universe/names/"
+        for i in range(0, len(public_ids_to_fetch), 1000):
+            chunk = public_ids_to_fetch[i:i+1000]
+            name_data = make_esi_request(url, data=chunk)
+            if name_data:
+                for item in name_data:
+                    all_resolved_names[item['id']] = item['name']
+
+    # Structure IDs are private and require an authenticated endpoint.
+    # These must be fetched one by one.
+    structure_ids_to_fetch = [id for id in missing_ids if id >= 10000000000]
+    if structure_ids_to_fetch and character:
+        logging.info(f"Resolving {len(structure_ids_to_fetch)} structure names for {character.name}.")
+        for struct_id in structure_ids_to_fetch:
+            # Check if we already resolved it via the public endpoint by chance
+            if struct_id in all_resolved_names:
+                continue
+            url = f"https://esi.evetech.net/v2/universe/structures/{struct_id}/"
+            # Allow structure names to be cached, as they rarely change.
+            struct_data = make_esi_request(url, character=character)
+            if struct_data and 'name' in struct_data:
+                logging.debug(f"Resolved structure {struct_id} to name '{struct_data['name']}'.")
+                all_resolved_names[struct_id] = struct_data['name']
+            else:
+                logging.warning(f"Could not resolve structure name for ID {struct_id} with character {character.name}.")
+                all_resolved_names[struct_id] = f"Structure ID {struct_id}" # Fallback name
+
+    # Save all newly found names (both public and structure) to the DB for future use.
+    newly_resolved_names = {id: name for id, name in all_resolved_names.items() if id in missing_ids}
+    if newly_resolved_names:
+        save_names_to_db(newly_resolved_names)
+
+    logging.info(f"get_names_from_ids resolved a total of {len(all_resolved_names)}/{len(unique_ids)} names.")
+    return all_resolved_names
+
+# Consumes %(quantity)s from a character's lots of one type, oldest first, in a single
+# statement: the lots are locked, a running total decides how much each one gives up,
+# fully used lots are deleted and the last partially used one is reduced.
+_CONSUME_PURCHASE_LOTS_SQL = """
+WITH lots AS (
+    SELECT lot_id, quantity, price, purchase_date
+    FROM purchase_lots
+    WHERE character_id = %(character_id)s AND type_id = %(type_id)s
+    FOR UPDATE
+),
+running AS (
+    SELECT lot_id, quantity, price,
+           SUM(quantity) OVER (ORDER BY purchase_date, lot_id) - quantity AS consumed_before
+    FROM lots
+),
+taken AS (
+    SELECT lot_id, quantity, price, LEAST(quantity, %(quantity)s - consumed_before) AS take
+    FROM running
+    WHERE consumed_before < %(quantity)s
+),
+deleted AS (
+    DELETE FROM purchase_lots p USING taken
+    WHERE p.lot_id = taken.lot_id AND taken.take = taken.quantity
+),
+reduced AS (
+    UPDATE purchase_lots p SET quantity = p.quantity - taken.take
+    FROM taken
+    WHERE p.lot_id = taken.lot_id AND taken.take < taken.quantity
+)
+SELECT COALESCE(SUM(take * price), 0), COALESCE(SUM(take), 0) FROM taken
+"""
+
+
+def _consume_purchase_lots(cursor, character_id, type_id, quantity_sold):
+    """Consumes lots for a sale using the caller's cursor (and transaction). Returns (cogs, unmatched_quantity)."""
+    cursor.execute(
+        _CONSUME_PURCHASE_LOTS_SQL,
+        {'character_id': character_id, 'type_id': type_id, 'quantity': quantity_sold}
+    )
+    cogs, matched = cursor.fetchone()
+    remaining_to_sell = quantity_sold - int(matched)
+
+    if remaining_to_sell > 0:
+        # This can happen if the user sells items they acquired before the bot started tracking
+        logging.debug(
+            f"Could not find enough purchase history for char {character_id} to account for sale of {quantity_sold} of type {type_id}. "
+            f"Profit calculation may be incomplete for this sale."
+        )
+    return float(cogs), remaining_to_sell
+
+
+def get_next_run_delay(headers):
+    """Calculates the delay in seconds until the cache expires, with a small buffer."""
+    expires_header = get_header(headers, 'Expires')
+    if not expires_header:
+        return 60  # Default to 60s if no header
+    try:
+        expires_dt = datetime.strptime(expires_header, '%a, %d %b %Y %H:%M:%S GMT').replace(tzinfo=timezone.utc)
+        delay = (expires_dt - datetime.now(timezone.utc)).total_seconds()
+        return max(delay, 0) + 5  # Add 5s buffer
+    except (ValueError, TypeError):
+        return 60
+
+
+def record_poll_expiry(character_id: int, kind: str, headers):
+    """
+    Schedules a character's next poll of the given kind for when the ESI response it just fetched expires.
+    Order polls are capped at MARKET_SNAPSHOT_INTERVAL so each snapshot is checked for undercuts.
+    """
+    if headers:
+        delay = get_next_run_delay(headers)
+        if kind == 'orders':
+            delay = min(delay, MARKET_SNAPSHOT_INTERVAL)
+        poll_scheduler.schedule(character_id, kind, delay)
+
+def get_ids_from_db(table_name: str, id_column: str, character_id: int, ids_to_check: list) -> set:
+    """Checks a table for which of the given IDs already exist for a character."""
+    if not ids_to_check:
+        return set()
+    conn = database.get_db_connection()
+    existing_ids = set()
+    try:
+        with conn.cursor() as cursor:
+            placeholders = ','.join(['%s'] * len(ids_to_check))
+            query = f"SELECT {id_column} FROM {table_name} WHERE character_id = %s AND {id_column} IN ({placeholders})"
+            # Note: The character_id must be passed as a tuple/list element
+            cursor.execute(query, [character_id] + ids_to_check)
+            existing_ids = {row[0] for row in cursor.fetchall()}
+    finally:
+        database.release_db_connection(conn)
+    return existing_ids
+
+def _copy_to_staging_table(cursor, staging_table: str, like_table: str, columns: list, rows):
+    """
+    Creates a temporary table shaped like like_table (dropped at commit) and streams
+    rows into it with a single COPY, so bulk inserts don't cost one statement per row.
+    """
+    cursor.execute(f"CREATE TEMP TABLE {staging_table} (LIKE {like_table}) ON COMMIT DROP")
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['\\N' if value is None else value for value in row])
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY {staging_table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+        buffer
+    )
+
+
+_HISTORICAL_TRANSACTION_COLUMNS = [
+    'transaction_id', 'character_id', 'client_id', 'date', 'is_buy', 'is_personal',
+    'journal_ref_id', 'location_id', 'quantity', 'type_id', 'unit_price'
+]
+
+
+def add_historical_transactions_to_db(character_id: int, transactions: list) -> set:
+    """
+    Adds a list of transaction records to the historical_transactions table.
+    Returns the IDs of the transactions that were new.
+    """
+    if not transactions:
+        return set()
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            data_to_insert = [
+                (
+                    tx['transaction_id'], character_id, tx['client_id'], tx['date'],
+                    tx['is_buy'], tx['is_personal'], tx['journal_ref_id'],
+                    tx['location_id'], tx['quantity'], tx['type_id'], tx['unit_price']
+                ) for tx in transactions
+            ]
+            _copy_to_staging_table(cursor, 'staged_transactions', 'historical_transactions', _HISTORICAL_TRANSACTION_COLUMNS, data_to_insert)
+            columns = ', '.join(_HISTORICAL_TRANSACTION_COLUMNS)
+            cursor.execute(
+                f"""
+                INSERT INTO historical_transactions ({columns})
+                SELECT DISTINCT ON (transaction_id) {columns} FROM staged_transactions
+                ON CONFLICT (transaction_id, character_id) DO NOTHING
+                RETURNING transaction_id
+                """
+            )
+            inserted_ids = {row[0] for row in cursor.fetchall()}
+            conn.commit()
+            logging.info(f"Inserted {len(inserted_ids)}/{len(data_to_insert)} records into historical_transactions for char {character_id}.")
+    finally:
+        database.release_db_connection(conn)
+    return inserted_ids
+
+
+_WALLET_JOURNAL_COLUMNS = [
+    'id', 'character_id', 'amount', 'balance', 'context_id', 'context_id_type',
+    'date', 'description', 'first_party_id', 'reason', 'ref_type',
+    'second_party_id', 'tax', 'tax_receiver_id'
+]
+
+
+def add_wallet_journal_entries_to_db(character_id: int, journal_entries: list) -> set:
+    """Adds a list of wallet journal entries to the wallet_journal table. Returns the IDs of the entries that were new."""
+    if not journal_entries:
+        return set()
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            data_to_insert = []
+            for entry in journal_entries:
+                # ESI response can have missing optional keys, so we use .get()
+                data_tuple = (
+                    entry['id'],
+                    character_id,
+                    entry.get('amount'),
+                    entry.get('balance'),
+                    entry.get('context_id'),
+                    entry.get('context_id_type'),
+                    entry['date'],
+                    entry['description'],
+                    entry.get('first_party_id'),
+                    entry.get('reason'),
+                    entry['ref_type'],
+                    entry.get('second_party_id'),
+                    entry.get('tax'),
+                    entry.get('tax_receiver_id')
+                )
+                data_to_insert.append(data_tuple)
+
+            _copy_to_staging_table(cursor, 'staged_journal', 'wallet_journal', _WALLET_JOURNAL_COLUMNS, data_to_insert)
+            columns = ', '.join(_WALLET_JOURNAL_COLUMNS)
+            cursor.execute(
+                f"""
+                INSERT INTO wallet_journal ({columns})
+                SELECT DISTINCT ON (id) {columns} FROM staged_journal
+                ON CONFLICT (id, character_id) DO NOTHING
+                RETURNING id
+                """
+            )
+            inserted_ids = {row[0] for row in cursor.fetchall()}
+            conn.commit()
+            logging.info(f"Inserted {len(inserted_ids)}/{len(data_to_insert)} records into wallet_journal for char {character_id}.")
+    finally:
+        database.release_db_connection(conn)
+    return inserted_ids
+
+
+# --- Realized P&L Ledger ---
+# Every sale is recorded once in realized_sales with its FIFO cost of goods, the
+# transaction tax matched from the journal and the estimated broker fees, so the
+# overview, charts and sales history read precomputed rows instead of replaying
+# the character's whole transaction history on every request.
+
+# Journal fees counted against a period's profit. Broker fees are estimated per sale instead.
+PERIOD_FEE_REF_TYPES = ['transaction_tax', 'market_provider_tax']
+# Namespace of the advisory lock that serializes ledger and lot updates per character.
+REALIZED_SALES_LOCK_NAMESPACE = 7315
+
+
+def _parse_esi_date(value) -> datetime:
+    """Returns an ESI timestamp string (or datetime) as an aware datetime."""
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+@contextmanager
+def _realized_sales_lock(character_id: int):
+    """Holds a Postgres advisory lock so only one process updates a character's ledger and lots at a time."""
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s, %s)", (REALIZED_SALES_LOCK_NAMESPACE, character_id))
+        conn.commit()
+        yield
+    finally:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s, %s)", (REALIZED_SALES_LOCK_NAMESPACE, character_id))
+            conn.commit()
+        finally:
+            database.release_db_connection(conn)
+
+
+def _consume_fifo(lots: deque, quantity: int):
+    """
+    Consumes quantity from an in-memory deque of [quantity, price, date] lots, oldest first.
+    Returns (cogs, unmatched_quantity).
+    """
+    cogs = 0
+    remaining = quantity
+    while remaining > 0 and lots:
+        lot = lots[0]
+        take = min(remaining, lot[0])
+        cogs += take * lot[1]
+        remaining -= take
+        lot[0] -= take
+        if lot[0] == 0:
+            lots.popleft()
+    return cogs, remaining
+
+
+def _realized_sale_row(character: Character, tx: dict, cogs: float, unmatched_quantity: int) -> tuple:
+    """Builds a realized_sales row for a sale transaction."""
+    sale_value = tx['quantity'] * tx['unit_price']
+    broker_fees = _calculate_estimated_broker_fees(character, cogs, sale_value) if cogs > 0 else 0
+    return (
+        tx['transaction_id'], character.id, tx['type_id'], tx['date'], tx['quantity'],
+        sale_value, cogs, unmatched_quantity, broker_fees
+    )
+
+
+def _insert_realized_sales(cursor, rows: list):
+    """Inserts realized_sales rows built by _realized_sale_row."""
+    cursor.executemany(
+        """
+        INSERT INTO realized_sales (
+            transaction_id, character_id, type_id, date, quantity,
+            sale_value, cogs, unmatched_quantity, broker_fees
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (transaction_id, character_id) DO NOTHING
+        """,
+        rows
+    )
+
+
+def _apply_journal_taxes(cursor, character_id: int, transaction_ids: list):
+    """Sets each sale's taxes to the transaction tax journaled at the same moment as its market transaction."""
+    if not transaction_ids:
+        return
+    cursor.execute(
+        """
+        UPDATE realized_sales rs SET taxes = matched.taxes
+        FROM (
+            SELECT j.context_id AS transaction_id, SUM(ABS(t.amount)) AS taxes
+            FROM wallet_journal j
+            JOIN wallet_journal t
+              ON t.character_id = j.character_id AND t.date = j.date AND t.ref_type = 'transaction_tax'
+            WHERE j.character_id = %s AND j.ref_type = 'market_transaction' AND j.context_id = ANY(%s)
+            GROUP BY j.context_id
+        ) matched
+        WHERE rs.character_id = %s AND rs.transaction_id = matched.transaction_id
+        """,
+        (character_id, list(transaction_ids), character_id)
+    )
+
+
+def refresh_realized_sale_taxes(character_id: int, journal_entries: list):
+    """Re-matches taxes for the sales referenced by newly stored market_transaction journal entries."""
+    transaction_ids = [e['context_id'] for e in journal_entries if e.get('ref_type') == 'market_transaction' and e.get('context_id')]
+    if not transaction_ids:
+        return
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            _apply_journal_taxes(cursor, character_id, transaction_ids)
+            conn.commit()
+    finally:
+        database.release_db_connection(conn)
+
+
+def refresh_realized_sale_broker_fees(character_id: int):
+    """Recomputes the estimated broker fees of every recorded sale after a fee setting changes."""
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            # Mirrors _calculate_estimated_broker_fees, including the 100 ISK minimum per side.
+            cursor.execute(
+                """
+                UPDATE realized_sales rs SET broker_fees = CASE WHEN rs.cogs > 0
+                    THEN GREATEST(100, rs.cogs * c.buy_broker_fee::float8 / 100)
+                       + GREATEST(100, rs.sale_value * c.sell_broker_fee::float8 / 100)
+                    ELSE 0 END
+                FROM characters c
+                WHERE c.character_id = rs.character_id AND rs.character_id = %s
+                """,
+                (character_id,)
+            )
+            conn.commit()
+    finally:
+        database.release_db_connection(conn)
+    refresh_pnl_rollups(character_id)
+
+
+def is_realized_sales_built(character_id: int) -> bool:
+    """Returns True once a character's ledger has been built from their full history."""
+    return bool(get_bot_state(f"realized_sales_built_{character_id}"))
+
+
+def _utc_midnight(value: datetime) -> datetime:
+    """Returns 00:00 UTC of the day a timestamp falls on."""
+    return value.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _last_day_start(now: datetime) -> datetime:
+    """Returns the start of the last-24-hours window: the 24 clock hours ending with the current one."""
+    return now.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=23)
+
+
+def _encode_fifo_lots(inventory: dict) -> bytes:
+    """Serializes {type_id: [[quantity, price, date], ...]} open lots for a checkpoint."""
+    return _zstd_compress(orjson.dumps({
+        str(type_id): [[quantity, float(price), _parse_esi_date(date).isoformat()] for quantity, price, date in lots]
+        for type_id, lots in inventory.items() if lots
+    }))
+
+
+def _decode_fifo_lots(blob: bytes) -> defaultdict:
+    """Restores checkpointed lots as {type_id: deque of [quantity, price, date]}."""
+    inventory = defaultdict(deque)
+    for type_id, lots in orjson.loads(_zstd_decompress(bytes(blob))).items():
+        inventory[int(type_id)] = deque(list(lot) for lot in lots)
+    return inventory
+
+
+def _save_fifo_checkpoint(cursor, character_id: int, checkpoint_at: datetime, inventory: dict):
+    """Stores (or replaces) a character's open lots as of checkpoint_at."""
+    cursor.execute(
+        """
+        INSERT INTO fifo_checkpoints (character_id, checkpoint_at, lots) VALUES (%s, %s, %s)
+        ON CONFLICT (character_id, checkpoint_at) DO UPDATE SET lots = EXCLUDED.lots
+        """,
+        (character_id, checkpoint_at, psycopg2.Binary(_encode_fifo_lots(inventory)))
+    )
+
+
+def _load_purchase_lots(cursor, character_id: int) -> defaultdict:
+    """Returns a character's current purchase_lots as {type_id: deque of [quantity, price, date]}, oldest first."""
+    cursor.execute(
+        "SELECT type_id, quantity, price, purchase_date FROM purchase_lots WHERE character_id = %s ORDER BY purchase_date, lot_id",
+        (character_id,)
+    )
+    inventory = defaultdict(deque)
+    for type_id, quantity, price, purchase_date in cursor.fetchall():
+        inventory[type_id].append([quantity, price, purchase_date])
+    return inventory
+
+
+def invalidate_fifo_checkpoints(character_id: int, since):
+    """
+    Drops the checkpoints taken after since, e.g. because transactions dated since
+    have just been stored. Earlier checkpoints stay valid and bound the next rebuild.
+    """
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM fifo_checkpoints WHERE character_id = %s AND checkpoint_at > %s",
+                (character_id, _parse_esi_date(since))
+            )
+            if cursor.rowcount:
+                logging.info(f"Invalidated {cursor.rowcount} FIFO checkpoints after {since} for character {character_id}.")
+            conn.commit()
+    finally:
+        database.release_db_connection(conn)
+
+
+def _get_latest_fifo_checkpoint(cursor, character_id: int):
+    """Returns (checkpoint_at, lots blob) of the character's newest checkpoint, or None."""
+    cursor.execute(
+        "SELECT checkpoint_at, lots FROM fifo_checkpoints WHERE character_id = %s ORDER BY checkpoint_at DESC LIMIT 1",
+        (character_id,)
+    )
+    return cursor.fetchone()
+
+
+def _get_ledger_watermark(cursor, character_id: int):
+    """Returns the date of the newest transaction applied to the ledger and lots, or None."""
+    cursor.execute(
+        """
+        SELECT GREATEST(
+            (SELECT MAX(date) FROM realized_sales WHERE character_id = %s),
+            (SELECT MAX(purchase_date) FROM purchase_lots WHERE character_id = %s)
+        )
+        """,
+        (character_id, character_id)
+    )
+    return cursor.fetchone()[0]
+
+
+def _rebuild_realized_sales_locked(character: Character):
+    """
+    Replays a character's history into realized_sales and purchase_lots, starting from
+    the latest FIFO checkpoint (or the beginning) and writing a checkpoint at each
+    00:00 UTC the replay crosses. Caller holds the ledger lock.
+    """
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            checkpoint = _get_latest_fifo_checkpoint(cursor, character.id) if is_realized_sales_built(character.id) else None
+    finally:
+        database.release_db_connection(conn)
+    if checkpoint:
+        replay_from, blob = checkpoint
+        inventory = _decode_fifo_lots(blob)
+    else:
+        replay_from, inventory = None, defaultdict(deque)
+
+    transactions = get_historical_transactions_from_db(character.id, since=replay_from)
+    transactions.sort(key=lambda tx: (_parse_esi_date(tx['date']), tx['transaction_id']))
+
+    rows = []
+    checkpoints = []
+    last_checkpoint_at = replay_from
+    for tx in transactions:
+        midnight = _utc_midnight(_parse_esi_date(tx['date']))
+        if last_checkpoint_at is None or midnight > last_checkpoint_at:
+            checkpoints.append((midnight, _encode_fifo_lots(inventory)))
+            last_checkpoint_at = midnight
+        if tx['is_buy']:
+            inventory[tx['type_id']].append([tx['quantity'], tx['unit_price'], tx['date']])
+        else:
+            cogs, unmatched = _consume_fifo(inventory[tx['type_id']], tx['quantity'])
+            rows.append(_realized_sale_row(character, tx, cogs, unmatched))
+    remaining_lots = [
+        (character.id, type_id, quantity, price, date)
+        for type_id, lots in inventory.items() for quantity, price, date in lots
+    ]
+
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            if replay_from is None:
+                cursor.execute("DELETE FROM realized_sales WHERE character_id = %s", (character.id,))
+                cursor.execute("DELETE FROM fifo_checkpoints WHERE character_id = %s", (character.id,))
+            else:
+                cursor.execute("DELETE FROM realized_sales WHERE character_id = %s AND date >= %s", (character.id, replay_from))
+                cursor.execute("DELETE FROM fifo_checkpoints WHERE character_id = %s AND checkpoint_at > %s", (character.id, replay_from))
+            _insert_realized_sales(cursor, rows)
+            _apply_journal_taxes(cursor, character.id, [row[0] for row in rows])
+            cursor.execute("DELETE FROM purchase_lots WHERE character_id = %s", (character.id,))
+            cursor.executemany(
+                "INSERT INTO purchase_lots (character_id, type_id, quantity, price, purchase_date) VALUES (%s, %s, %s, %s, %s)",
+                remaining_lots
+            )
+            cursor.executemany(
+                "INSERT INTO fifo_checkpoints (character_id, checkpoint_at, lots) VALUES (%s, %s, %s) ON CONFLICT (character_id, checkpoint_at) DO UPDATE SET lots = EXCLUDED.lots",
+                [(character.id, checkpoint_at, psycopg2.Binary(blob)) for checkpoint_at, blob in checkpoints]
+            )
+            conn.commit()
+    finally:
+        database.release_db_connection(conn)
+    set_bot_state(f"realized_sales_built_{character.id}", datetime.now(timezone.utc).isoformat())
+    refresh_pnl_rollups(character.id, replay_from)
+    logging.info(
+        f"Rebuilt realized sales ledger for {character.name} from {replay_from or 'the beginning'}: "
+        f"{len(rows)} sales, {len(remaining_lots)} open lots, {len(checkpoints)} new checkpoints."
+    )
+
+
+def rebuild_realized_sales(character: Character):
+    """
+    Rebuilds a character's realized_sales ledger and purchase_lots by replaying their
+    transaction history in date order from the latest valid FIFO checkpoint.
+    Used once history backfill completes.
+    """
+    with _realized_sales_lock(character.id):
+        _rebuild_realized_sales_locked(character)
+
+
+def ensure_realized_sales(character: Character):
+    """Builds the character's ledger and P&L rollups if they have never been built."""
+    if not is_realized_sales_built(character.id):
+        rebuild_realized_sales(character)
+    elif not get_bot_state(f"pnl_rollups_built_{character.id}"):
+        refresh_pnl_rollups(character.id)
+
+
+def record_realized_sales(character: Character, transactions: list) -> list[dict]:
+    """
+    Applies newly stored transactions to the character's FIFO purchase lots in date
+    order and records each sale in the ledger. If the ledger hasn't been built yet,
+    it is built from the full history instead (which includes these transactions).
+    Returns the ledger rows of the sales among the transactions.
+    """
+    if not transactions:
+        return []
+    sale_ids = [tx['transaction_id'] for tx in transactions if not tx['is_buy']]
+
+    with _realized_sales_lock(character.id):
+        if not is_realized_sales_built(character.id):
+            _rebuild_realized_sales_locked(character)
+            return get_realized_sales(character.id, transaction_ids=sale_ids)
+
+        transactions = sorted(transactions, key=lambda t: (_parse_esi_date(t['date']), t['transaction_id']))
+        earliest = _parse_esi_date(transactions[0]['date'])
+        conn = database.get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                watermark = _get_ledger_watermark(cursor, character.id)
+                latest_checkpoint = _get_latest_fifo_checkpoint(cursor, character.id)
+        finally:
+            database.release_db_connection(conn)
+
+        if watermark is not None and earliest < watermark:
+            # Older than what the lots already reflect: replay from the checkpoint before it.
+            logging.info(f"Out-of-order transactions from {earliest} for {character.name}. Rebuilding ledger from checkpoint.")
+            invalidate_fifo_checkpoints(character.id, earliest)
+            _rebuild_realized_sales_locked(character)
+            return get_realized_sales(character.id, transaction_ids=sale_ids)
+
+        # Lots, checkpoints and ledger rows change together in one transaction.
+        last_checkpoint_at = latest_checkpoint[0] if latest_checkpoint else None
+        rows = []
+        conn = database.get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                for tx in transactions:
+                    midnight = _utc_midnight(_parse_esi_date(tx['date']))
+                    if (last_checkpoint_at is None or midnight > last_checkpoint_at) and (watermark is None or midnight > watermark):
+                        # Every applied transaction is before this midnight, so the current lots are its state.
+                        _save_fifo_checkpoint(cursor, character.id, midnight, _load_purchase_lots(cursor, character.id))
+                        last_checkpoint_at = midnight
+                    watermark = _parse_esi_date(tx['date'])
+                    if tx['is_buy']:
+                        _insert_purchase_lot(cursor, character.id, tx['type_id'], tx['quantity'], tx['unit_price'], tx['date'])
+                    else:
+                        cogs, unmatched = _consume_purchase_lots(cursor, character.id, tx['type_id'], tx['quantity'])
+                        rows.append(_realized_sale_row(character, tx, cogs, unmatched))
+                if rows:
+                    _insert_realized_sales(cursor, rows)
+                    _apply_journal_taxes(cursor, character.id, sale_ids)
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            database.release_db_connection(conn)
+        refresh_pnl_rollups(character.id, earliest)
+
+    return get_realized_sales(character.id, transaction_ids=sale_ids) if sale_ids else []
+
+
+_REALIZED_SALE_COLUMNS = [
+    'transaction_id', 'type_id', 'date', 'quantity', 'sale_value', 'cogs',
+    'unmatched_quantity', 'taxes', 'broker_fees', 'net_profit'
+]
+
+
+def get_realized_sales(character_id: int, transaction_ids: list = None, start_date: datetime = None) -> list[dict]:
+    """Returns ledger rows for a character, optionally limited to some sales or to sales on or after start_date."""
+    if transaction_ids is not None and not transaction_ids:
+        return []
+    query = f"SELECT {', '.join(_REALIZED_SALE_COLUMNS)} FROM realized_sales WHERE character_id = %s"
+    params = [character_id]
+    if transaction_ids is not None:
+        query += " AND transaction_id = ANY(%s)"
+        params.append(list(transaction_ids))
+    if start_date is not None:
+        query += " AND date >= %s"
+        params.append(start_date)
+    query += " ORDER BY date ASC, transaction_id ASC"
+
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(query, params)
+            return [dict(zip(_REALIZED_SALE_COLUMNS, row)) for row in cursor.fetchall()]
+    finally:
+        database.release_db_connection(conn)
+
+
+# Sales shown in the historical sales view: ledger rows whose sale has its
+# market_transaction journal entry, newest first.
+_JOURNALED_REALIZED_SALES_FROM = """
+    FROM realized_sales rs
+    JOIN historical_transactions ht ON ht.character_id = rs.character_id AND ht.transaction_id = rs.transaction_id
+    WHERE rs.character_id = %s AND EXISTS (
+        SELECT 1 FROM wallet_journal wj
+        WHERE wj.character_id = rs.character_id AND wj.context_id = rs.transaction_id
+          AND wj.ref_type = 'market_transaction' AND wj.amount > 0
+    )
+"""
+
+
+def count_journaled_realized_sales(character_id: int) -> int:
+    """Returns how many sales the historical sales view can list for a character."""
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) {_JOURNALED_REALIZED_SALES_FROM}", (character_id,))
+            return cursor.fetchone()[0]
+    finally:
+        database.release_db_connection(conn)
+
+
+def get_journaled_realized_sales_page(character_id: int, limit: int, offset: int) -> list[dict]:
     """
-    Resolves a list of IDs to names, using a local database cache and authenticated
-    calls for private structures if a character is provided.
+    Returns one page of the historical sales view, newest first. Each row has the
+    sale's location_id and unit_price, its ledger values, 'total_fees' and a 'cogs'
+    and 'net_profit' of None if the sale had no full purchase history.
     """
-    if not id_list:
-        return {}
-
-    unique_ids = list(set(int(i) for i in id_list if isinstance(i, int) and i > 0))
-    if not unique_ids:
-        return {}
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT rs.transaction_id, rs.type_id, rs.date, rs.quantity, ht.unit_price, ht.location_id,
+                       rs.sale_value, rs.cogs, rs.unmatched_quantity, rs.taxes, rs.broker_fees, rs.net_profit
+                {_JOURNALED_REALIZED_SALES_FROM}
+                ORDER BY rs.date DESC, rs.transaction_id DESC
+                LIMIT %s OFFSET %s
+                """,
+                (character_id, limit, offset)
+            )
+            rows = cursor.fetchall()
+    finally:
+        database.release_db_connection(conn)
 
-    logging.debug(f"get_names_from_ids called for {len(unique_ids)} unique IDs.")
-    all_resolved_names = get_names_from_db(unique_ids)
-    missing_ids = [id for id in unique_ids if id not in all_resolved_names]
+    sales = []
+    for (transaction_id, type_id, date, quantity, unit_price, location_id,
+         sale_value, cogs, unmatched_quantity, taxes, broker_fees, net_profit) in rows:
+        sales.append({
+            'transaction_id': transaction_id, 'type_id': type_id, 'date': date,
+            'quantity': quantity, 'unit_price': unit_price, 'location_id': location_id,
+            'sale_value': sale_value, 'cogs': cogs if unmatched_quantity == 0 else None,
+            'taxes': taxes, 'total_fees': taxes + broker_fees, 'net_profit': net_profit
+        })
+    return sales
 
-    if not missing_ids:
-        return all_resolved_names
 
-    # ESI's /universe/names/ endpoint can resolve most public IDs.
-    # It has a limit of 1000 IDs per request.
-    public_ids_to_fetch = [id for id in missing_ids if id < 10000000000]
-    if public_ids_to_fetch:
-        logging.info(f"Resolving {len(public_ids_to_fetch)} public names from ESI.")
-        url = "https://esi.evetech.net/v3/universe/names/"
-        for i in range(0, len(public_ids_to_fetch), 1000):
-            chunk = public_ids_to_fetch[i:i+1000]
-            name_data = make_esi_request(url, data=chunk)
-            if name_data:
-                for item in name_data:
-                    all_resolved_names[item['id']] = item['name']
+def get_journal_fee_total(character_id: int, ref_type: str, start_date: datetime, end_date: datetime) -> float:
+    """Returns the total (absolute) amount of a character's journal entries of one ref_type between two dates."""
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT COALESCE(SUM(ABS(amount)), 0) FROM wallet_journal WHERE character_id = %s AND ref_type = %s AND date BETWEEN %s AND %s",
+                (character_id, ref_type, start_date, end_date)
+            )
+            return cursor.fetchone()[0]
+    finally:
+        database.release_db_connection(conn)
 
-    # Structure IDs are private and require an authenticated endpoint.
-    # These must be fetched one by one.
-    structure_ids_to_fetch = [id for id in missing_ids if id >= 10000000000]
-    if structure_ids_to_fetch and character:
-        logging.info(f"Resolving {len(structure_ids_to_fetch)} structure names for {character.name}.")
-        for struct_id in structure_ids_to_fetch:
-            # Check if we already resolved it via the public endpoint by chance
-            if struct_id in all_resolved_names:
-                continue
-            url = f"https://esi.evetech.net/v2/universe/structures/{struct_id}/"
-            # Allow structure names to be cached, as they rarely change.
-            struct_data = make_esi_request(url, character=character)
-            if struct_data and 'name' in struct_data:
-                logging.debug(f"Resolved structure {struct_id} to name '{struct_data['name']}'.")
-                all_resolved_names[struct_id] = struct_data['name']
-            else:
-                logging.warning(f"Could not resolve structure name for ID {struct_id} with character {character.name}.")
-                all_resolved_names[struct_id] = f"Structure ID {struct_id}" # Fallback name
 
-    # Save all newly found names (both public and structure) to the DB for future use.
-    newly_resolved_names = {id: name for id, name in all_resolved_names.items() if id in missing_ids}
-    if newly_resolved_names:
-        save_names_to_db(newly_resolved_names)
+def get_transaction_years(character_id: int) -> list[int]:
+    """Returns the sorted list of years in which a character has transactions."""
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT DISTINCT EXTRACT(YEAR FROM date AT TIME ZONE 'UTC')::int FROM historical_transactions WHERE character_id = %s ORDER BY 1",
+                (character_id,)
+            )
+            return [row[0] for row in cursor.fetchall()]
+    finally:
+        database.release_db_connection(conn)
 
-    logging.info(f"get_names_from_ids resolved a total of {len(all_resolved_names)}/{len(unique_ids)} names.")
-    return all_resolved_names
 
-def calculate_cogs_and_update_lots(character_id, type_id, quantity_sold):
-    """
-    Calculates the Cost of Goods Sold (COGS) for a sale using FIFO and updates the database.
-    Returns the total COGS for the quantity sold.
-    """
-    lots = get_purchase_lots(character_id, type_id)
-    if not lots:
-        return None  # Indicates no purchase history
+# --- P&L Rollups ---
+# pnl_hourly and pnl_daily hold per-bucket, per-item sums of the ledger plus the
+# journaled fees, so the overview, charts and top items are range scans.
 
-    cogs = 0
-    remaining_to_sell = quantity_sold
+# Rollup table and bucket unit for each granularity.
+PNL_ROLLUP_TABLES = {'hour': 'pnl_hourly', 'day': 'pnl_daily'}
+# Namespace of the transaction-scoped advisory lock that serializes rollup refreshes per
+# character. It is separate from the ledger lock, which some callers already hold.
+PNL_ROLLUP_LOCK_NAMESPACE = 7316
 
-    for lot in lots:
-        if remaining_to_sell <= 0:
-            break
 
-        quantity_from_lot = min(remaining_to_sell, lot['quantity'])
-        cogs += quantity_from_lot * lot['price']
-        remaining_to_sell -= quantity_from_lot
+def refresh_pnl_rollups(character_id: int, since: datetime = None):
+    """
+    Recomputes a character's rollup buckets from the one containing since onwards
+    (all of them if since is None) from realized_sales and the wallet journal.
+    """
+    start = _parse_esi_date(since) if since is not None else datetime.min.replace(tzinfo=timezone.utc)
+    conn = database.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", (PNL_ROLLUP_LOCK_NAMESPACE, character_id))
+            for unit, table in PNL_ROLLUP_TABLES.items():
+                cursor.execute(
+                    f"DELETE FROM {table} WHERE character_id = %s AND bucket >= date_trunc('{unit}', %s::timestamptz, 'UTC')",
+                    (character_id, start)
+                )
+                cursor.execute(
+                    f"""
+                    INSERT INTO {table} (character_id, bucket, type_id, sales_value, cogs, broker_fees, journal_fees, item_profit)
+                    SELECT %(character_id)s, date_trunc('{unit}', date, 'UTC'), type_id,
+                           SUM(sale_value), SUM(cogs), SUM(broker_fees), 0,
+                           SUM(CASE WHEN unmatched_quantity = 0 THEN sale_value - cogs ELSE sale_value END)
+                    FROM realized_sales
+                    WHERE character_id = %(character_id)s AND date >= date_trunc('{unit}', %(start)s::timestamptz, 'UTC')
+                    GROUP BY 2, 3
+                    UNION ALL
+                    SELECT %(character_id)s, date_trunc('{unit}', date, 'UTC'), 0, 0, 0, 0, SUM(ABS(amount)), 0
+                    FROM wallet_journal
+                    WHERE character_id = %(character_id)s AND ref_type = ANY(%(fee_ref_types)s)
+                      AND date >= date_trunc('{unit}', %(start)s::timestamptz, 'UTC')
+                    GROUP BY 2
+                    ON CONFLICT (character_id, bucket, type_id) DO UPDATE SET
+                        sales_value = EXCLUDED.sales_value,
+                        cogs = EXCLUDED.cogs,
+                        broker_fees = EXCLUDED.broker_fees,
+                        journal_fees = EXCLUDED.journal_fees,
+                        item_profit = EXCLUDED.item_profit
+                    """,
+                    {'character_id': character_id, 'start': start, 'fee_ref_types': PERIOD_FEE_REF_TYPES}
+                )
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        database.release_db_connection(conn)
+    if since is None:
+        set_bot_state(f"pnl_rollups_built_{character_id}", datetime.now(timezone.utc).isoformat())
 
-        if quantity_from_lot < lot['quantity']:
-            # Lot partially consumed
-            new_quantity = lot['quantity'] - quantity_from_lot
-            update_purchase_lot_quantity(lot['lot_id'], new_quantity)
-            logging.debug(f"Partially consumed lot {lot['lot_id']}. New quantity: {new_quantity}")
-        else:
-            # Lot fully consumed
-            delete_purchase_lot(lot['lot_id'])
-            logging.debug(f"Fully consumed and deleted lot {lot['lot_id']}.")
 
-    if remaining_to_sell > 0:
-        # This can happen if the user sells items they acquired before the bot started tracking
-        logging.debug(
-            f"Could not find enough purchase history for char {character_id} to account for sale of {quantity_sold} of type {type_id}. "
-            f"Profit calculation may be incomplete for this sale."
-        )
+def refresh_pnl_rollups_for_journal(character_id: int, journal_entries: list):
+    """Refreshes the rollups from the earliest newly stored fee journal entry, if any."""
+    fee_dates = [_parse_esi_date(e['date']) for e in journal_entries if e.get('ref_type') in PERIOD_FEE_REF_TYPES]
+    if fee_dates:
+        refresh_pnl_rollups(character_id, min(fee_dates))
 
-    return cogs
 
+def _pnl_rollup_table(start_date: datetime) -> str:
+    """Returns the coarsest rollup table whose buckets line up with start_date."""
+    return PNL_ROLLUP_TABLES['day'] if start_date == _utc_midnight(start_date) else PNL_ROLLUP_TABLES['hour']
 
-def get_next_run_delay(headers):
-    """Calculates the delay in seconds until the cache expires, with a small buffer."""
-    if not headers or 'Expires' not in headers:
-        return 60  # Default to 60s if no header
-    try:
-        expires_dt = datetime.strptime(headers['Expires'], '%a, %d %b %Y %H:%M:%S GMT').replace(tzinfo=timezone.utc)
-        delay = (expires_dt - datetime.now(timezone.utc)).total_seconds()
-        return max(delay, 0) + 5  # Add 5s buffer
-    except (ValueError, TypeError):
-        return 60
 
-def get_ids_from_db(table_name: str, id_column: str, character_id: int, ids_to_check: list) -> set:
-    """Checks a table for which of the given IDs already exist for a character."""
-    if not ids_to_check:
-        return set()
+def get_period_profit(character_id: int, start_date: datetime):
+    """
+    Returns (profit, sales_value, total_fees) for the rollup buckets from start_date on.
+    start_date must fall on an hour boundary. Profit is sales minus FIFO cost,
+    estimated broker fees and journaled taxes.
+    """
     conn = database.get_db_connection()
-    existing_ids = set()
     try:
         with conn.cursor() as cursor:
-            placeholders = ','.join(['%s'] * len(ids_to_check))
-            query = f"SELECT {id_column} FROM {table_name} WHERE character_id = %s AND {id_column} IN ({placeholders})"
-            # Note: The character_id must be passed as a tuple/list element
-            cursor.execute(query, [character_id] + ids_to_check)
-            existing_ids = {row[0] for row in cursor.fetchall()}
+            cursor.execute(
+                f"""
+                SELECT COALESCE(SUM(sales_value - cogs - broker_fees - journal_fees), 0),
+                       COALESCE(SUM(sales_value), 0), COALESCE(SUM(broker_fees + journal_fees), 0)
+                FROM {_pnl_rollup_table(start_date)} WHERE character_id = %s AND bucket >= %s
+                """,
+                (character_id, start_date)
+            )
+            return cursor.fetchone()
     finally:
         database.release_db_connection(conn)
-    return existing_ids
 
-def add_historical_transactions_to_db(character_id: int, transactions: list):
-    """Adds a list of transaction records to the historical_transactions table."""
-    if not transactions:
-        return
+
+def get_pnl_series(character_id: int, start_date: datetime, unit: str) -> dict:
+    """
+    Returns {period_start: (sales_value, fees, profit)} for each 'hour', 'day' or 'month'
+    from start_date on that has any activity.
+    """
+    table = PNL_ROLLUP_TABLES['hour'] if unit == 'hour' else PNL_ROLLUP_TABLES['day']
     conn = database.get_db_connection()
     try:
         with conn.cursor() as cursor:
-            data_to_insert = [
-                (
-                    tx['transaction_id'], character_id, tx['client_id'], tx['date'],
-                    tx['is_buy'], tx['is_personal'], tx['journal_ref_id'],
-                    tx['location_id'], tx['quantity'], tx['type_id'], tx['unit_price']
-                ) for tx in transactions
-            ]
-            cursor.executemany(
-                """
-                INSERT INTO historical_transactions (
-                    transaction_id, character_id, client_id, date, is_buy, is_personal,
-                    journal_ref_id, location_id, quantity, type_id, unit_price
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (transaction_id, character_id) DO NOTHING
+            cursor.execute(
+                f"""
+                SELECT date_trunc('{unit}', bucket, 'UTC') AS period, SUM(sales_value),
+                       SUM(broker_fees + journal_fees), SUM(sales_value - cogs - broker_fees - journal_fees)
+                FROM {table} WHERE character_id = %s AND bucket >= %s
+                GROUP BY 1 ORDER BY 1
                 """,
-                data_to_insert
+                (character_id, start_date)
             )
-            conn.commit()
-            logging.info(f"Inserted/updated {len(data_to_insert)} records into historical_transactions for char {character_id}.")
+            return {row[0]: (row[1], row[2], row[3]) for row in cursor.fetchall()}
     finally:
         database.release_db_connection(conn)
 
 
-def add_wallet_journal_entries_to_db(character_id: int, journal_entries: list):
-    """Adds a list of wallet journal entries to the wallet_journal table."""
-    if not journal_entries:
-        return
+def get_top_profitable_items(character_id: int, start_date: datetime, limit: int = 5) -> list:
+    """
+    Returns [(type_id, profit), ...] for the most profitable items sold from start_date on.
+    A sale without full purchase history counts its whole value as profit.
+    """
     conn = database.get_db_connection()
     try:
         with conn.cursor() as cursor:
-            data_to_insert = []
-            for entry in journal_entries:
-                # ESI response can have missing optional keys, so we use .get()
-                data_tuple = (
-                    entry['id'],
-                    character_id,
-                    entry.get('amount'),
-                    entry.get('balance'),
-                    entry.get('context_id'),
-                    entry.get('context_id_type'),
-                    entry['date'],
-                    entry['description'],
-                    entry.get('first_party_id'),
-                    entry.get('reason'),
-                    entry['ref_type'],
-                    entry.get('second_party_id'),
-                    entry.get('tax'),
-                    entry.get('tax_receiver_id')
-                )
-                data_to_insert.append(data_tuple)
-
-            cursor.executemany(
-                """
-                INSERT INTO wallet_journal (
-                    id, character_id, amount, balance, context_id, context_id_type,
-                    date, description, first_party_id, reason, ref_type,
-                    second_party_id, tax, tax_receiver_id
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (id, character_id) DO NOTHING
+            cursor.execute(
+                f"""
+                SELECT type_id, SUM(item_profit) AS profit
+                FROM {_pnl_rollup_table(start_date)} WHERE character_id = %s AND bucket >= %s AND type_id <> 0
+                GROUP BY type_id ORDER BY profit DESC LIMIT %s
                 """,
-                data_to_insert
+                (character_id, start_date, limit)
             )
-            conn.commit()
-            logging.info(f"Inserted {len(data_to_insert)} records into wallet_journal for char {character_id}.")
+            return cursor.fetchall()
     finally:
         database.release_db_connection(conn)
 
@@ -2311,6 +3890,8 @@ def backfill_character_journal_history(character: Character) -> bool:
     journal_ref_ids = [j['id'] for j in all_journal_entries]
     add_processed_journal_refs(character.id, journal_ref_ids)
     logging.info(f"Stored {len(journal_ref_ids)} journal entries and marked them as processed for {character.name}.")
+    if get_bot_state(f"pnl_rollups_built_{character.id}"):
+        refresh_pnl_rollups_for_journal(character.id, all_journal_entries)
 
     set_bot_state(state_key, datetime.now(timezone.utc).isoformat())
     logging.warning(f"Wallet journal backfill for {character.name} is complete.")
@@ -2343,12 +3924,8 @@ def backfill_all_character_history(character: Character) -> bool:
         logging.info(f"No transaction history found for {character.name}. Marking backfill as complete.")
         set_bot_state(state_key, datetime.now(timezone.utc).isoformat())
     else:
+        # Purchase lots are created by the ledger rebuild once the backfill completes.
         add_historical_transactions_to_db(character.id, initial_transactions)
-        buy_transactions = [tx for tx in initial_transactions if tx.get('is_buy')]
-        if buy_transactions:
-            for tx in buy_transactions:
-                add_purchase_lot(character.id, tx['type_id'], tx['quantity'], tx['unit_price'], purchase_date=tx['date'])
-            logging.info(f"Seeded {len(buy_transactions)} initial buy transactions for FIFO tracking for {character.name}.")
 
         oldest_tx_id = min(tx['transaction_id'] for tx in initial_transactions)
         logging.info(f"Oldest transaction ID from initial sync is {oldest_tx_id}. Kicking off background backfill.")
@@ -2412,17 +3989,12 @@ def get_contracts_from_db(character_id: int) -> list:
         database.release_db_connection(conn)
     return contracts
 
-def _resolve_location(location_id: int, character: Character) -> dict | None:
-    """
-    Resolves a location_id (station or structure) to its constituent parts (system_id, region_id).
-    Uses the database cache first, then falls back to ESI. Returns a dict.
-    """
-    # 1. Check our own location_cache first
-    cached_location = get_location_from_cache(location_id)
-    if cached_location and cached_location.get('system_id') and cached_location.get('region_id'):
-        return cached_location
+# Each resolved location counts as one unit of the LRU's budget, so its size is an entry count.
+_location_memory_cache = memory_cache.ByteBudgetLRU(LOCATION_MEMORY_CACHE_SIZE, name="locations")
 
-    # 2. If not in cache, resolve via ESI
+
+def _resolve_location_via_esi(location_id: int, character: Character) -> dict | None:
+    """Resolves a station or structure to its system and region through ESI."""
     system_id = None
     region_id = None
 
@@ -2439,6 +4011,8 @@ def _resolve_location(location_id: int, character: Character) -> dict | None:
 
     # Get region from system to fully populate the cache item
     if system_id:
+        region_id = universe.get_region_id(system_id)
+    if system_id and not region_id:
         system_info = get_system_info(system_id)
         if system_info:
             constellation_id = system_info.get('constellation_id')
@@ -2447,14 +4021,63 @@ def _resolve_location(location_id: int, character: Character) -> dict | None:
                 if constellation_info:
                     region_id = constellation_info.get('region_id')
 
-    # 3. Save to cache if we successfully resolved everything
-    if location_id and system_id and region_id:
-        save_location_to_cache(location_id, system_id, region_id)
+    if system_id and region_id:
         return {'system_id': system_id, 'region_id': region_id}
-
     return None
 
 
+def resolve_locations(location_ids, character: Character) -> dict:
+    """
+    Resolves many location_ids (stations or structures) to {location_id: {'system_id', 'region_id'}}.
+    NPC stations come from the static map data, then the per-process LRU is checked,
+    then the location_cache table in one query. Whatever is left is resolved through
+    ESI concurrently and written back to the table in one batch.
+    Locations that cannot be resolved are left out of the result.
+    """
+    resolved = {}
+    misses = []
+    for location_id in set(location_ids):
+        if not location_id:
+            continue
+        if location_id <= 10000000000:
+            static_location = universe.resolve_location(location_id)
+            if static_location:
+                resolved[location_id] = static_location
+                continue
+        cached = _location_memory_cache.get(location_id)
+        if cached:
+            resolved[location_id] = {'system_id': cached[0], 'region_id': cached[1]}
+        else:
+            misses.append(location_id)
+
+    if misses:
+        from_db = {
+            location_id: location for location_id, location in get_locations_from_cache(misses).items()
+            if location.get('system_id') and location.get('region_id')
+        }
+        from_esi = {}
+        unresolved = [location_id for location_id in misses if location_id not in from_db]
+        if unresolved:
+            with ThreadPoolExecutor(max_workers=max(1, min(LOCATION_RESOLVE_WORKERS, len(unresolved)))) as executor:
+                results = executor.map(lambda location_id: _resolve_location_via_esi(location_id, character), unresolved)
+                from_esi = {location_id: location for location_id, location in zip(unresolved, results) if location}
+            save_locations_to_cache(from_esi)
+
+        for location_id, location in {**from_db, **from_esi}.items():
+            _location_memory_cache.put(location_id, (location['system_id'], location['region_id']), 1)
+            resolved[location_id] = location
+
+    return resolved
+
+
+def _resolve_location(location_id: int, character: Character) -> dict | None:
+    """
+    Resolves a location_id (station or structure) to its constituent parts (system_id, region_id).
+    Returns a dict, or None if it cannot be resolved.
+    """
+    return resolve_locations([location_id], character).get(location_id)
+
+
 def _resolve_location_to_system_id(location_id: int, character: Character) -> int | None:
     """Wrapper around _resolve_location to get just the system_id."""
     location_details = _resolve_location(location_id, character)
@@ -2470,7 +4093,8 @@ def _resolve_location_to_region_id(location_id: int, character: Character) -> in
 def get_jump_distance(origin_location_id: int, destination_location_id: int, character: Character) -> int | None:
     """
     Calculates the jump distance between two locations (stations or structures).
-    Uses a database cache to store and retrieve system-to-system jump counts.
+    Uses the local stargate graph when the static map data is available, and
+    otherwise a database cache backed by ESI's route endpoint.
     """
     # Step 1: Resolve both locations to their solar system IDs
     origin_system_id = _resolve_location_to_system_id(origin_location_id, character)
@@ -2483,13 +4107,18 @@ def get_jump_distance(origin_location_id: int, destination_location_id: int, cha
     if origin_system_id == destination_system_id:
         return 0
 
-    # Step 2: Check the database cache for the jump distance
+    # Step 2: Route on the local stargate graph if the static map data is available
+    jumps = universe.get_jump_distance(origin_system_id, destination_system_id)
+    if jumps is not None:
+        return jumps
+
+    # Step 3: Check the database cache for the jump distance
     cached_jumps = get_jump_distance_from_db(origin_system_id, destination_system_id)
     if cached_jumps is not None:
         logging.debug(f"Found cached jump distance from {origin_system_id} to {destination_system_id}: {cached_jumps} jumps.")
         return cached_jumps
 
-    # Step 3: If not cached, calculate it via ESI
+    # Step 4: If not cached, calculate it via ESI
     logging.info(f"No cached jump distance found. Calculating route from {origin_system_id} to {destination_system_id} via ESI.")
     route = get_route(origin_system_id, destination_system_id)
 
@@ -2500,7 +4129,7 @@ def get_jump_distance(origin_location_id: int, destination_location_id: int, cha
     # ESI returns a list of system IDs in the route. Number of jumps is len - 1.
     jumps = len(route) - 1
 
-    # Step 4: Save the newly calculated distance to the cache for future use
+    # Step 5: Save the newly calculated distance to the cache for future use
     save_jump_distance_to_db(origin_system_id, destination_system_id, jumps)
     logging.info(f"Calculated and cached {jumps} jumps from {origin_system_id} to {destination_system_id}.")
 
@@ -2515,22 +4144,21 @@ def _trigger_regional_market_data_fetch(character: Character, open_orders: list)
     if not open_orders:
         return
 
+    locations = resolve_locations([order['location_id'] for order in open_orders], character)
     unique_region_types = set()
     for order in open_orders:
-        region_id = _resolve_location_to_region_id(order['location_id'], character)
-        if region_id:
-            unique_region_types.add((region_id, order['type_id']))
+        location = locations.get(order['location_id'])
+        if location:
+            unique_region_types.add((location['region_id'], order['type_id']))
 
     if not unique_region_types:
         return
 
     logging.info(f"Warming up regional market data cache for {len(unique_region_types)} region/type pairs for character {character.name}.")
     for region_id, type_id in unique_region_types:
-        # We call this function for its side effect: caching the data.
-        # We force revalidation to ensure the data is fresh.
-        get_region_market_orders(region_id, type_id, force_revalidate=True)
-        # Small sleep to be polite to ESI, although caching should handle most of this.
-        time.sleep(0.1)
+        # We call this function for its side effect: publishing the book.
+        # Pacing is handled by the ESI rate governor.
+        fetch_region_market_book(region_id, type_id)
     logging.info(f"Regional market data cache warmup complete for character {character.name}.")
 
 
@@ -2681,11 +4309,6 @@ def get_bot_statistics():
             last_reg = cursor.fetchone()[0]
             stats['last_character_registration'] = last_reg.strftime('%Y-%m-%d %H:%M:%S UTC') if last_reg else "N/A"
 
-            # Last market price update
-            cursor.execute("SELECT MAX(expires) FROM esi_cache WHERE cache_key LIKE '%/markets/%/orders/%'")
-            last_market_update = cursor.fetchone()[0]
-            stats['last_market_price_update'] = last_market_update.strftime('%Y-%m-%d %H:%M:%S UTC') if last_market_update else "N/A"
-
             # DB Size
             cursor.execute("SELECT pg_size_pretty(pg_database_size(current_database()))")
             stats['db_size'] = cursor.fetchone()[0]
@@ -2735,6 +4358,26 @@ def get_bot_statistics():
     finally:
         database.release_db_connection(conn)
 
+    # Last market price update, as recorded by the market snapshot
+    try:
+        published_at = redis_client.get_redis().get(MARKET_SNAPSHOT_PUBLISHED_KEY)
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Could not read the market snapshot time from Redis: {e}")
+        published_at = None
+    if published_at:
+        published_at = datetime.fromisoformat(published_at.decode() if isinstance(published_at, bytes) else published_at)
+        stats['last_market_price_update'] = published_at.strftime('%Y-%m-%d %H:%M:%S UTC')
+    else:
+        stats['last_market_price_update'] = "N/A"
+
+    # ESI rate governor state (shared across all workers via Redis)
+    governor_state = esi_governor.get_state()
+    stats['esi_governor_status'] = governor_state['status']
+    stats['esi_error_limit_remain'] = governor_state['error_limit_remain']
+    stats['esi_error_limit_reset'] = governor_state['error_limit_reset']
+    stats['esi_rate_tokens'] = governor_state['rate_tokens']
+    stats['esi_rate_limit'] = governor_state['rate_limit']
+
     try:
         # The git_hash.txt file is created by the Dockerfile during build.
         with open('/app/git_hash.txt', 'r') as f:
@@ -2856,13 +4499,13 @@ def process_character_wallet(character_id: int) -> list[dict]:
             if (datetime.now(timezone.utc) - history_backfilled_at) > timedelta(hours=grace_period_hours):
                 recent_journal, headers = get_wallet_journal(character, return_headers=True)
                 if recent_journal:
-                    journal_ref_ids = [j['id'] for j in recent_journal]
-                    existing_ref_ids = get_ids_from_db('historical_journal', 'ref_id', character.id, journal_ref_ids)
-                    new_journal_ref_ids = set(journal_ref_ids) - existing_ref_ids
+                    # The insert skips entries already stored and returns the ones that were new.
+                    new_journal_ref_ids = add_wallet_journal_entries_to_db(character.id, recent_journal)
                     if new_journal_ref_ids:
                         new_entries = [j for j in recent_journal if j['id'] in new_journal_ref_ids]
-                        add_wallet_journal_entries_to_db(character.id, new_entries)
                         add_processed_journal_refs(character.id, list(new_journal_ref_ids))
+                        refresh_realized_sale_taxes(character.id, new_entries)
+                        refresh_pnl_rollups_for_journal(character.id, new_entries)
                         logging.info(f"Processed {len(new_entries)} new journal entries for {character.name}.")
         except (ValueError, TypeError):
             pass  # Handle legacy or malformed timestamps
@@ -2878,39 +4521,31 @@ def process_character_wallet(character_id: int) -> list[dict]:
         return []
 
     recent_tx, headers = get_wallet_transactions(character, return_headers=True)
+    record_poll_expiry(character.id, 'wallet', headers)
     if not recent_tx:
         return []
 
-    tx_ids_from_esi = [tx['transaction_id'] for tx in recent_tx]
-    existing_tx_ids = get_ids_from_db('historical_transactions', 'transaction_id', character.id, tx_ids_from_esi)
-    new_tx_ids = set(tx_ids_from_esi) - existing_tx_ids
-
+    candidate_tx = [
+        tx for tx in recent_tx
+        if datetime.fromisoformat(tx['date'].replace('Z', '+00:00')) > character.created_at
+    ]
+    # The insert skips transactions already stored and returns the ones that were new.
+    new_tx_ids = add_historical_transactions_to_db(character.id, candidate_tx)
     if not new_tx_ids:
         return []
 
     set_bot_state(f"chart_cache_dirty_{character.id}", "true")
-    new_transactions = [
-        tx for tx in recent_tx
-        if tx['transaction_id'] in new_tx_ids and datetime.fromisoformat(tx['date'].replace('Z', '+00:00')) > character.created_at
-    ]
-    add_historical_transactions_to_db(character.id, new_transactions)
+    new_transactions = [tx for tx in candidate_tx if tx['transaction_id'] in new_tx_ids]
 
     sales, buys = defaultdict(list), defaultdict(list)
     for tx in new_transactions:
         (buys if tx['is_buy'] else sales)[tx['type_id']].append(tx)
 
     # --- Essential Data Processing (Always Run) ---
-    # Process buys to update purchase lots for COGS tracking
-    for type_id, tx_group in buys.items():
-        for tx in tx_group:
-            add_purchase_lot(character.id, type_id, tx['quantity'], tx['unit_price'], purchase_date=tx['date'])
-
-    # Process sales to consume purchase lots for COGS tracking and store the result
-    sales_cogs = {}
-    for type_id, tx_group in sales.items():
-        total_quantity_sold = sum(t['quantity'] for t in tx_group)
-        cogs = calculate_cogs_and_update_lots(character.id, type_id, total_quantity_sold)
-        sales_cogs[type_id] = cogs
+    # Apply the transactions to the FIFO purchase lots and record each sale in the ledger
+    realized_by_type = defaultdict(list)
+    for row in record_realized_sales(character, new_transactions):
+        realized_by_type[row['type_id']].append(row)
 
 
     # --- Notification Generation (Run only if enabled) ---
@@ -2926,12 +4561,6 @@ def process_character_wallet(character_id: int) -> list[dict]:
     all_loc_ids = [t['location_id'] for txs in list(sales.values()) + list(buys.values()) for t in txs]
     id_to_name = get_names_from_ids(list(set(all_type_ids + all_loc_ids)), character=character)
     wallet_balance = get_wallet_balance(character, force_revalidate=True)
-    full_journal = get_full_wallet_journal_from_db(character.id)
-    tx_id_to_journal_map = {entry['context_id']: entry for entry in full_journal if entry.get('ref_type') == 'market_transaction'}
-    fee_journal_by_timestamp = defaultdict(list)
-    for entry in full_journal:
-        if entry['ref_type'] == 'transaction_tax':
-            fee_journal_by_timestamp[entry['date']].append(entry)
 
 
     # Low Balance Alert
@@ -2971,20 +4600,14 @@ def process_character_wallet(character_id: int) -> list[dict]:
         for type_id, tx_group in sales.items():
             total_quantity = sum(t['quantity'] for t in tx_group)
             total_value = sum(t['quantity'] * t['unit_price'] for t in tx_group)
-            cogs = sales_cogs.get(type_id)
-
-            # Get actual taxes from the journal
-            journal_taxes = sum(
-                abs(fee['amount'])
-                for tx in tx_group
-                if tx_id_to_journal_map.get(tx['transaction_id'])
-                for fee in fee_journal_by_timestamp.get(tx_id_to_journal_map[tx['transaction_id']]['date'], [])
-            )
+            realized = realized_by_type.get(type_id, [])
+            # COGS is unknown only if no purchase lot covered any of these sales
+            has_purchase_history = any(r['unmatched_quantity'] < r['quantity'] for r in realized)
+            cogs = sum(r['cogs'] for r in realized) if has_purchase_history else None
 
-            estimated_broker_fees = 0
-            if cogs is not None:
-                # Estimate broker fees based on user settings
-                estimated_broker_fees = _calculate_estimated_broker_fees(character, cogs, total_value)
+            # Actual taxes from the journal and broker fees estimated from user settings
+            journal_taxes = sum(r['taxes'] for r in realized)
+            estimated_broker_fees = sum(r['broker_fees'] for r in realized) if cogs is not None else 0
 
             total_fees = journal_taxes + estimated_broker_fees
             net_profit = total_value - cogs - total_fees if cogs is not None else None
@@ -3059,6 +4682,7 @@ def process_character_orders(character_id: int) -> list[dict]:
 
     # --- Open Orders & Undercut Check ---
     open_orders, headers = get_market_orders(character, return_headers=True, force_revalidate=True)
+    record_poll_expiry(character.id, 'orders', headers)
     if open_orders is None:
         return notifications
 
@@ -3079,63 +4703,67 @@ def process_character_orders(character_id: int) -> list[dict]:
         remove_stale_undercut_statuses(character.id, list(esi_order_ids))
         previous_statuses = get_undercut_statuses(character.id)
         new_statuses, notifications_to_send = [], []
+        orders_to_evaluate, books_to_evaluate = [], []
         market_data_cache = {}
         cached_orders_map = {o['order_id']: o for o in cached_orders}
+        locations = resolve_locations([order['location_id'] for order in open_orders], character)
 
         for order in open_orders:
-            region_id = _resolve_location_to_region_id(order['location_id'], character)
-            if not region_id:
-                logging.warning(f"Could not resolve region for location {order['location_id']} on order {order['order_id']}. Skipping undercut check for this order.")
+            # Orders in player structures compete in that structure's own market.
+            # If none of our characters can read it, fall back to the region book.
+            book = None
+            if order['location_id'] > 10000000000:
+                book_key = ('structure', order['location_id'], order['type_id'])
+                if book_key not in market_data_cache:
+                    market_data_cache[book_key] = get_structure_market_book(order['location_id'], order['type_id'], character.id)
+                book = market_data_cache[book_key]
+
+            if book is None:
+                region_id = locations.get(order['location_id'], {}).get('region_id')
+                if not region_id:
+                    logging.warning(f"Could not resolve region for location {order['location_id']} on order {order['order_id']}. Skipping undercut check for this order.")
+                    continue
+                book_key = ('region', region_id, order['type_id'])
+                if book_key not in market_data_cache:
+                    # Books are normally already published by this cycle's market snapshot.
+                    market_data_cache[book_key] = get_market_book(region_id, order['type_id'])
+                book = market_data_cache[book_key]
+
+            book_version = book.get('version') if book else None
+
+            # If neither the book nor this order's price has moved since the last
+            # evaluation, its status is unchanged and there is nothing to notify.
+            previous_status_info = previous_statuses.get(order['order_id'])
+            if (book_version is not None and previous_status_info
+                    and previous_status_info['book_version'] == book_version
+                    and previous_status_info['order_price'] == order['price']):
                 continue
 
-            if region_id not in market_data_cache: market_data_cache[region_id] = {}
-            if order['type_id'] not in market_data_cache[region_id]:
-                regional_orders = get_region_market_orders(region_id, order['type_id'], force_revalidate=True)
-                if regional_orders:
-                    sell_orders = sorted([o for o in regional_orders if not o.get('is_buy_order')], key=lambda x: x['price'])
-                    buy_orders = sorted([o for o in regional_orders if o.get('is_buy_order')], key=lambda x: x['price'], reverse=True)
-                    market_data_cache[region_id][order['type_id']] = {'sell': sell_orders, 'buy': buy_orders}
-
-            is_outbid_or_undercut, competitor = False, None
-            regional_market_orders = market_data_cache.get(region_id, {}).get(order['type_id'])
-
-            if regional_market_orders:
-                if order.get('is_buy_order'):
-                    buy_orders = regional_market_orders.get('buy', [])
-                    for best_buy in buy_orders:
-                        if best_buy['order_id'] != order['order_id']:
-                            if best_buy['price'] > order['price']:
-                                is_outbid_or_undercut, competitor = True, best_buy
-                            break
-                else:
-                    sell_orders = regional_market_orders.get('sell', [])
-                    for best_sell in sell_orders:
-                        if best_sell['order_id'] != order['order_id']:
-                            if best_sell['price'] < order['price']:
-                                is_outbid_or_undercut, competitor = True, best_sell
-                            break
+            orders_to_evaluate.append(order)
+            books_to_evaluate.append(book)
 
+        # Evaluate every remaining order in one vectorized pass
+        previous_prices = {order_id: o['price'] for order_id, o in cached_orders_map.items()}
+        competitors, transitions = evaluate_undercuts(orders_to_evaluate, books_to_evaluate, previous_statuses, previous_prices)
+
+        for order, book, competitor, transition in zip(orders_to_evaluate, books_to_evaluate, competitors, transitions):
             new_statuses.append({
                 'order_id': order['order_id'],
-                'is_undercut': is_outbid_or_undercut,
+                'is_undercut': competitor is not None,
                 'competitor_price': competitor['price'] if competitor else None,
                 'competitor_location_id': competitor['location_id'] if competitor else None,
-                'competitor_volume': competitor.get('volume_remain') if competitor else None
+                'competitor_volume': competitor.get('volume_remain') if competitor else None,
+                'book_version': book.get('version') if book else None,
+                'order_price': order['price']
             })
 
             # Only check for notification conditions if the user has them enabled
             if character.enable_undercut_notifications:
-                previous_status_info = previous_statuses.get(order['order_id'], {})
-                was_undercut = previous_status_info.get('is_undercut', False)
-                cached_order = cached_orders_map.get(order['order_id'])
-                previous_price = cached_order['price'] if cached_order else None
-
-                if is_outbid_or_undercut and not was_undercut:
-                    if competitor and 'issued' in competitor and datetime.fromisoformat(competitor['issued'].replace('Z', '+00:00')) > character.created_at:
+                if transition == 'undercut':
+                    if competitor.get('issued') and datetime.fromisoformat(competitor['issued'].replace('Z', '+00:00')) > character.created_at:
                         notifications_to_send.append({'type': 'undercut', 'my_order': order, 'competitor': competitor})
-                elif not is_outbid_or_undercut and was_undercut:
-                    if previous_price is not None and order['price'] == previous_price:
-                        notifications_to_send.append({'type': 'back_on_top', 'my_order': order})
+                elif transition == 'back_on_top':
+                    notifications_to_send.append({'type': 'back_on_top', 'my_order': order})
 
         if new_statuses:
             update_undercut_statuses(character.id, new_statuses)
@@ -3145,6 +4773,8 @@ def process_character_orders(character_id: int) -> list[dict]:
                       {n['my_order']['location_id'] for n in notifications_to_send} | \
                       {n['competitor']['location_id'] for n in notifications_to_send if n.get('competitor')}
             id_to_name = get_names_from_ids(list(all_ids), character)
+            # Resolve competitor locations in one batch before the per-notification jump lookups.
+            resolve_locations([n['competitor']['location_id'] for n in notifications_to_send if n.get('competitor')], character)
             for notif in notifications_to_send:
                 my_order = notif['my_order']
                 if notif['type'] == 'undercut':
@@ -3206,6 +4836,7 @@ def process_character_contracts(character_id: int) -> list[dict]:
         pass
 
     contracts, headers = get_contracts(character, return_headers=True, force_revalidate=True)
+    record_poll_expiry(character.id, 'contracts', headers)
     if contracts is None:
         return []
 
@@ -3244,51 +4875,6 @@ def process_character_contracts(character_id: int) -> list[dict]:
     return notifications
 
 
-def _prepare_chart_data(character_id, start_of_period):
-    """
-    Prepares all data needed for chart generation.
-    1. Fetches all historical financial events.
-    2. Builds the inventory state up to the start of the chart period.
-    3. Returns the initial inventory state and all events within the period.
-    """
-    all_transactions = get_historical_transactions_from_db(character_id)
-    full_journal = get_full_wallet_journal_from_db(character_id)
-    # Use exact transaction and market provider taxes from the journal.
-    # Broker's fee will be estimated based on user settings, so we exclude it here.
-    fee_ref_types = {'transaction_tax', 'market_provider_tax'}
-
-    all_events = []
-    for tx in all_transactions:
-        all_events.append({'type': 'tx', 'data': tx, 'date': datetime.fromisoformat(tx['date'].replace('Z', '+00:00'))})
-    for entry in full_journal:
-        if entry['ref_type'] in fee_ref_types:
-            all_events.append({'type': 'fee', 'data': entry, 'date': entry['date']})
-    all_events.sort(key=lambda x: x['date'])
-
-    inventory = defaultdict(list)
-    events_before_period = [e for e in all_events if e['date'] < start_of_period]
-
-    for event in events_before_period:
-        if event['type'] == 'tx':
-            tx = event['data']
-            if tx.get('is_buy'):
-                inventory[tx['type_id']].append({'quantity': tx['quantity'], 'price': tx['unit_price']})
-            else: # Sale
-                remaining_to_sell = tx['quantity']
-                lots = inventory.get(tx['type_id'], [])
-                if lots:
-                    consumed_count = 0
-                    for lot in lots:
-                        if remaining_to_sell <= 0: break
-                        take = min(remaining_to_sell, lot['quantity'])
-                        remaining_to_sell -= take
-                        lot['quantity'] -= take
-                        if lot['quantity'] == 0: consumed_count += 1
-                    inventory[tx['type_id']] = lots[consumed_count:]
-
-    events_in_period = [e for e in all_events if e['date'] >= start_of_period]
-    return inventory, events_in_period
-
 def get_character_net_worth(character: Character, force_revalidate: bool = False) -> float | None:
     """
     Calculates a character's total net worth, using a 1-hour cache stored in the database.
@@ -3416,87 +5002,14 @@ def _calculate_overview_data(character: Character) -> dict:
 
     now = datetime.now(timezone.utc)
     # Use a consistent time window definition across the app
-    one_day_ago = now - timedelta(days=1)
+    one_day_ago = _last_day_start(now)
     # The 30-day chart shows the last 30 calendar days including today.
     thirty_days_ago = (now - timedelta(days=29)).replace(hour=0, minute=0, second=0, microsecond=0)
 
-    # Fetch data once to be used by all subsequent calculations
-    all_transactions = get_historical_transactions_from_db(character.id)
-    full_journal = get_full_wallet_journal_from_db(character.id)
-
-    # Combine and sort all financial events chronologically
-    all_events = []
-    fee_ref_types = {'transaction_tax', 'market_provider_tax'}
-    for tx in all_transactions:
-        all_events.append({'type': 'tx', 'data': tx, 'date': datetime.fromisoformat(tx['date'].replace('Z', '+00:00'))})
-    for entry in full_journal:
-        if entry['ref_type'] in fee_ref_types:
-            all_events.append({'type': 'fee', 'data': entry, 'date': entry['date']})
-    all_events.sort(key=lambda x: x['date'])
-
-
-    # --- Profit/Loss Calculation Helper ---
-    def calculate_profit(start_date, all_events):
-        # Determine initial inventory state at the beginning of the period
-        inventory = defaultdict(list)
-        events_before_period = [e for e in all_events if e['date'] < start_date]
-        for event in events_before_period:
-            if event['type'] == 'tx' and event['data'].get('is_buy'):
-                tx = event['data']
-                inventory[tx['type_id']].append({'quantity': tx['quantity'], 'price': tx['unit_price']})
-            elif event['type'] == 'tx' and not event['data'].get('is_buy'): # Sale
-                tx = event['data']
-                remaining_to_sell = tx['quantity']
-                lots = inventory.get(tx['type_id'], [])
-                if lots:
-                    consumed_count = 0
-                    for lot in lots:
-                        if remaining_to_sell <= 0: break
-                        take = min(remaining_to_sell, lot['quantity'])
-                        remaining_to_sell -= take
-                        lot['quantity'] -= take
-                        if lot['quantity'] == 0: consumed_count += 1
-                    inventory[tx['type_id']] = lots[consumed_count:]
-
-        # Process events within the period to calculate profit
-        profit = 0
-        sales_value = 0
-        events_in_period = [e for e in all_events if e['date'] >= start_date]
-        journaled_fees_value = sum(abs(e['data']['amount']) for e in events_in_period if e['type'] == 'fee')
-        estimated_broker_fees = 0
-
-        for event in events_in_period:
-            if event['type'] == 'tx':
-                tx = event['data']
-                if tx.get('is_buy'):
-                    inventory[tx['type_id']].append({'quantity': tx['quantity'], 'price': tx['unit_price']})
-                else: # Sale
-                    sale_value = tx['quantity'] * tx['unit_price']
-                    sales_value += sale_value
-                    cogs = 0
-                    remaining_to_sell = tx['quantity']
-                    lots = inventory.get(tx['type_id'], [])
-                    if lots:
-                        consumed_count = 0
-                        for lot in lots:
-                            if remaining_to_sell <= 0: break
-                            take = min(remaining_to_sell, lot['quantity'])
-                            cogs += take * lot['price']
-                            remaining_to_sell -= take
-                            lot['quantity'] -= take
-                            if lot['quantity'] == 0: consumed_count += 1
-                        inventory[tx['type_id']] = lots[consumed_count:]
-                    if cogs > 0:
-                        estimated_broker_fees += _calculate_estimated_broker_fees(character, cogs, sale_value)
-                    profit += sale_value - cogs
-
-        total_fees = journaled_fees_value + estimated_broker_fees
-        profit -= total_fees
-
-        return profit, sales_value, total_fees
-
-    profit_24h, total_sales_24h, total_fees_24h = calculate_profit(one_day_ago, all_events)
-    profit_30_days, total_sales_30_days, total_fees_30_days = calculate_profit(thirty_days_ago, all_events)
+    # Profit comes from the realized sales ledger, built from the full history on first use
+    ensure_realized_sales(character)
+    profit_24h, total_sales_24h, total_fees_24h = get_period_profit(character.id, one_day_ago)
+    profit_30_days, total_sales_30_days, total_fees_30_days = get_period_profit(character.id, thirty_days_ago)
 
     # Calculate profit margins, handling division by zero
     profit_margin_24h = (profit_24h / total_sales_24h) * 100 if total_sales_24h > 0 else 0.0
@@ -3504,7 +5017,7 @@ def _calculate_overview_data(character: Character) -> dict:
 
     wallet_balance = get_last_known_wallet_balance(character)
     net_worth = get_character_net_worth(character)
-    available_years = sorted(list(set(tx['date'].year for tx in all_events if tx['type'] == 'tx'))) if all_events else []
+    available_years = get_transaction_years(character.id)
 
 
     return {
@@ -3618,72 +5131,25 @@ def format_isk(value):
     return f"{value:.2f}"
 
 
-def _calculate_top_profitable_items(events_in_period: list, initial_inventory: dict, character_id: int) -> str:
+def _calculate_top_profitable_items(character_id: int, start_of_period: datetime) -> str:
     """
-    Calculates the top 5 most profitable items from a list of events and returns a formatted string.
+    Returns a formatted string listing the top 5 most profitable items sold since start_of_period.
     This helper function is designed to be called by the various chart generation functions.
     """
-    inventory = initial_inventory.copy()
-    item_profits = defaultdict(lambda: {'profit': 0, 'sales_value': 0})
-
-    # First, process all buys in the period to update the inventory
-    for event in events_in_period:
-        if event['type'] == 'tx' and event['data'].get('is_buy'):
-            tx = event['data']
-            inventory[tx['type_id']].append({'quantity': tx['quantity'], 'price': tx['unit_price']})
-
-    # Then, process all sales and fees
-    for event in events_in_period:
-        if event['type'] == 'tx' and not event['data'].get('is_buy'):
-            tx = event['data']
-            sale_value = tx['quantity'] * tx['unit_price']
-
-            cogs = 0
-            remaining_to_sell = tx['quantity']
-            lots = inventory.get(tx['type_id'], [])
-            if lots:
-                consumed_count = 0
-                for lot in lots:
-                    if remaining_to_sell <= 0: break
-                    take = min(remaining_to_sell, lot['quantity'])
-                    cogs += take * lot['price']
-                    remaining_to_sell -= take
-                    lot['quantity'] -= take
-                    if lot['quantity'] == 0: consumed_count += 1
-                inventory[tx['type_id']] = lots[consumed_count:]
-
-            # If COGS could be fully determined, calculate net profit.
-            # Otherwise, if purchase history is missing, consider the sale value as the profit.
-            if remaining_to_sell == 0:
-                net_profit = sale_value - cogs
-            else:
-                net_profit = sale_value
-
-            item_profits[tx['type_id']]['profit'] += net_profit
-            item_profits[tx['type_id']]['sales_value'] += sale_value
-
-    if not item_profits:
-        return ""
-
-    # Sort items by profit in descending order
-    sorted_items = sorted(item_profits.items(), key=lambda item: item[1]['profit'], reverse=True)
-
-    # Get the top 5
-    top_5_items = sorted_items[:5]
-
+    top_5_items = get_top_profitable_items(character_id, start_of_period, limit=5)
     if not top_5_items:
         return ""
 
     # Resolve names for the top 5 items
-    type_ids = [item_id for item_id, data in top_5_items]
+    type_ids = [item_id for item_id, profit in top_5_items]
     character = get_character_by_id(character_id)
     id_to_name = get_names_from_ids(type_ids, character)
 
     # Format the output string
     lines = ["\n\n*Top 5 Profitable Items (Net Profit):*"]
-    for item_id, data in top_5_items:
+    for item_id, profit in top_5_items:
         name = id_to_name.get(item_id, f"Unknown Item ID: {item_id}")
-        profit_in_millions = data['profit'] / 1_000_000
+        profit_in_millions = profit / 1_000_000
         lines.append(f"  - `{name}`: `{profit_in_millions:,.2f}m ISK`")
 
     return "\n".join(lines)
@@ -3691,7 +5157,7 @@ def _calculate_top_profitable_items(events_in_period: list, initial_inventory: d
 
 def generate_last_day_chart(character_id: int):
     """
-    Generates a chart for the last 24 hours, processing events chronologically to ensure accuracy.
+    Generates an hourly chart for the last 24 clock hours from the P&L rollups.
     Also calculates the top 5 profitable items for the period.
     Returns a tuple: (BytesIO buffer, caption_suffix_string) or None.
     """
@@ -3702,22 +5168,18 @@ def generate_last_day_chart(character_id: int):
     if not character: return None, None
 
     now = datetime.now(timezone.utc)
-    start_of_period = now - timedelta(days=1)
+    start_of_period = _last_day_start(now)
 
-    # Get initial inventory state and all events within the period, sorted chronologically.
-    inventory, events_in_period = _prepare_chart_data(character_id, start_of_period)
+    # Get the hourly sales, fees and profit of the period from the rollups.
+    ensure_realized_sales(character)
+    hourly_pnl = get_pnl_series(character_id, start_of_period, 'hour')
 
-    # If there are no events, there's nothing to chart.
-    if not any(e['type'] == 'tx' and not e['data'].get('is_buy') for e in events_in_period) and \
-       not any(e['type'] == 'fee' for e in events_in_period):
+    # If there is no activity, there's nothing to chart.
+    if not hourly_pnl:
         return None, None
 
     # --- Top Items Calculation ---
-    # Create a deep copy of the inventory for the profit calculation to not interfere with the chart calculation
-    inventory_for_profit_calc = defaultdict(list)
-    for type_id, lots in inventory.items():
-        inventory_for_profit_calc[type_id] = [lot.copy() for lot in lots]
-    caption_suffix = _calculate_top_profitable_items(events_in_period, inventory_for_profit_calc, character_id)
+    caption_suffix = _calculate_top_profitable_items(character_id, start_of_period)
 
 
     # --- Data Preparation for Chart ---
@@ -3727,57 +5189,17 @@ def generate_last_day_chart(character_id: int):
 
     hourly_cumulative_profit = []
     accumulated_profit = 0
-    event_idx = 0
 
-    # --- Chronological Event Processing for Chart ---
+    # --- Hourly Accumulation for Chart ---
     total_sales_value = 0
     for i in range(24):
         hour_start = start_of_period + timedelta(hours=i)
-        hour_end = hour_start + timedelta(hours=1)
         hour_label = hour_start.strftime('%H')
-
-        # Process all events that fall within this hour, in order.
-        while event_idx < len(events_in_period) and events_in_period[event_idx]['date'] < hour_end:
-            event = events_in_period[event_idx]
-            event_type = event['type']
-            data = event['data']
-
-            if event_type == 'tx':
-                if data.get('is_buy'):
-                    inventory[data['type_id']].append({'quantity': data['quantity'], 'price': data['unit_price']})
-                else:  # Sale
-                    sale_value = data['quantity'] * data['unit_price']
-                    hourly_sales[hour_label] += sale_value
-                    total_sales_value += sale_value
-
-                    cogs = 0
-                    remaining_to_sell = data['quantity']
-                    lots = inventory.get(data['type_id'], [])
-                    if lots:
-                        consumed_count = 0
-                        for lot in lots:
-                            if remaining_to_sell <= 0: break
-                            take = min(remaining_to_sell, lot['quantity'])
-                            cogs += take * lot['price']
-                            remaining_to_sell -= take
-                            lot['quantity'] -= take
-                            if lot['quantity'] == 0: consumed_count += 1
-                        inventory[data['type_id']] = lots[consumed_count:]
-                    # Estimate broker fees for this sale
-                    estimated_broker_fee = 0
-                    if cogs > 0:
-                        estimated_broker_fee = _calculate_estimated_broker_fees(character, cogs, sale_value)
-
-                    hourly_fees[hour_label] += estimated_broker_fee
-                    accumulated_profit += sale_value - cogs - estimated_broker_fee
-
-            elif event_type == 'fee':
-                fee_amount = abs(data['amount'])
-                hourly_fees[hour_label] += fee_amount
-                accumulated_profit -= fee_amount
-
-            event_idx += 1
-
+        sales, fees, profit = hourly_pnl.get(hour_start, (0, 0, 0))
+        hourly_sales[hour_label] += sales
+        hourly_fees[hour_label] += fees
+        total_sales_value += sales
+        accumulated_profit += profit
         hourly_cumulative_profit.append(accumulated_profit)
 
     # Calculate profit margin
@@ -3838,17 +5260,14 @@ def _generate_daily_breakdown_chart(character_id: int, days_to_show: int):
     now = datetime.now(timezone.utc)
     start_of_period = (now - timedelta(days=days_to_show-1)).replace(hour=0, minute=0, second=0, microsecond=0)
 
-    inventory, events_in_period = _prepare_chart_data(character_id, start_of_period)
+    ensure_realized_sales(character)
+    daily_pnl = get_pnl_series(character_id, start_of_period, 'day')
 
-    if not any(e['type'] == 'tx' and not e['data'].get('is_buy') for e in events_in_period) and \
-       not any(e['type'] == 'fee' for e in events_in_period):
+    if not daily_pnl:
         return None, None
 
     # --- Top Items Calculation ---
-    inventory_for_profit_calc = defaultdict(list)
-    for type_id, lots in inventory.items():
-        inventory_for_profit_calc[type_id] = [lot.copy() for lot in lots]
-    caption_suffix = _calculate_top_profitable_items(events_in_period, inventory_for_profit_calc, character_id)
+    caption_suffix = _calculate_top_profitable_items(character_id, start_of_period)
 
     # --- Data Preparation for Chart ---
     days = [(start_of_period + timedelta(days=i)) for i in range(days_to_show)]
@@ -3859,54 +5278,16 @@ def _generate_daily_breakdown_chart(character_id: int, days_to_show: int):
 
     daily_cumulative_profit = []
     accumulated_profit = 0
-    event_idx = 0
 
-    # --- Chronological Event Processing for Chart ---
+    # --- Daily Accumulation for Chart ---
     total_sales_value = 0
     for day_start in days:
-        day_end = day_start + timedelta(days=1)
         day_label = day_start.strftime(label_format)
-
-        while event_idx < len(events_in_period) and events_in_period[event_idx]['date'] < day_end:
-            event = events_in_period[event_idx]
-            event_type = event['type']
-            data = event['data']
-
-            if event_type == 'tx':
-                if data.get('is_buy'):
-                    inventory[data['type_id']].append({'quantity': data['quantity'], 'price': data['unit_price']})
-                else:  # Sale
-                    sale_value = data['quantity'] * data['unit_price']
-                    daily_sales[day_label] += sale_value
-                    total_sales_value += sale_value
-                    cogs = 0
-                    remaining_to_sell = data['quantity']
-                    lots = inventory.get(data['type_id'], [])
-                    if lots:
-                        consumed_count = 0
-                        for lot in lots:
-                            if remaining_to_sell <= 0: break
-                            take = min(remaining_to_sell, lot['quantity'])
-                            cogs += take * lot['price']
-                            remaining_to_sell -= take
-                            lot['quantity'] -= take
-                            if lot['quantity'] == 0: consumed_count += 1
-                        inventory[data['type_id']] = lots[consumed_count:]
-                    # Estimate broker fees for this sale
-                    estimated_broker_fee = 0
-                    if cogs > 0:
-                        estimated_broker_fee = _calculate_estimated_broker_fees(character, cogs, sale_value)
-
-                    daily_fees[day_label] += estimated_broker_fee
-                    accumulated_profit += sale_value - cogs - estimated_broker_fee
-
-            elif event_type == 'fee':
-                fee_amount = abs(data['amount'])
-                daily_fees[day_label] += fee_amount
-                accumulated_profit -= fee_amount
-
-            event_idx += 1
-
+        sales, fees, profit = daily_pnl.get(day_start, (0, 0, 0))
+        daily_sales[day_label] += sales
+        daily_fees[day_label] += fees
+        total_sales_value += sales
+        accumulated_profit += profit
         daily_cumulative_profit.append(accumulated_profit)
 
     # Calculate profit margin
@@ -3971,17 +5352,16 @@ def generate_all_time_chart(character_id: int):
     character = get_character_by_id(character_id)
     if not character: return None, None
 
-    inventory, events_in_period = _prepare_chart_data(character_id, datetime.min.replace(tzinfo=timezone.utc))
-    if not events_in_period: return None, None
+    start_of_history = datetime.min.replace(tzinfo=timezone.utc)
+    ensure_realized_sales(character)
+    monthly_pnl = get_pnl_series(character_id, start_of_history, 'month')
+    if not monthly_pnl: return None, None
 
     # --- Top Items Calculation ---
-    inventory_for_profit_calc = defaultdict(list)
-    for type_id, lots in inventory.items():
-        inventory_for_profit_calc[type_id] = [lot.copy() for lot in lots]
-    caption_suffix = _calculate_top_profitable_items(events_in_period, inventory_for_profit_calc, character_id)
+    caption_suffix = _calculate_top_profitable_items(character_id, start_of_history)
 
     # --- Data Preparation for Chart ---
-    start_date = events_in_period[0]['date']
+    start_date = min(monthly_pnl).astimezone(timezone.utc)
     end_date = datetime.now(timezone.utc)
     months = []
     current_month = start_date.replace(day=1)
@@ -3999,53 +5379,16 @@ def generate_all_time_chart(character_id: int):
     monthly_fees = {label: 0 for label in bar_labels}
     monthly_cumulative_profit = []
     accumulated_profit = 0
-    event_idx = 0
 
-    # --- Chronological Event Processing ---
+    # --- Monthly Accumulation ---
     total_sales_value = 0
     for month_start in months:
         month_label = month_start.strftime('%Y-%m')
-        next_month_start = (month_start.replace(day=28) + timedelta(days=4)).replace(day=1)
-
-        while event_idx < len(events_in_period) and events_in_period[event_idx]['date'] < next_month_start:
-            event = events_in_period[event_idx]
-            event_type = event['type']
-            data = event['data']
-
-            if event_type == 'tx':
-                if data.get('is_buy'):
-                    inventory[data['type_id']].append({'quantity': data['quantity'], 'price': data['unit_price']})
-                else: # Sale
-                    sale_value = data['quantity'] * data['unit_price']
-                    monthly_sales[month_label] += sale_value
-                    total_sales_value += sale_value
-                    cogs = 0
-                    remaining_to_sell = data['quantity']
-                    lots = inventory.get(data['type_id'], [])
-                    if lots:
-                        consumed_count = 0
-                        for lot in lots:
-                            if remaining_to_sell <= 0: break
-                            take = min(remaining_to_sell, lot['quantity'])
-                            cogs += take * lot['price']
-                            remaining_to_sell -= take
-                            lot['quantity'] -= take
-                            if lot['quantity'] == 0: consumed_count += 1
-                        inventory[data['type_id']] = lots[consumed_count:]
-                    # Estimate broker fees for this sale
-                    estimated_broker_fee = 0
-                    if cogs > 0:
-                        estimated_broker_fee = _calculate_estimated_broker_fees(character, cogs, sale_value)
-
-                    monthly_fees[month_label] += estimated_broker_fee
-                    accumulated_profit += sale_value - cogs - estimated_broker_fee
-            elif event_type == 'fee':
-                fee_amount = abs(data['amount'])
-                monthly_fees[month_label] += fee_amount
-                accumulated_profit -= fee_amount
-
-            event_idx += 1
-
+        sales, fees, profit = monthly_pnl.get(month_start, (0, 0, 0))
+        monthly_sales[month_label] += sales
+        monthly_fees[month_label] += fees
+        total_sales_value += sales
+        accumulated_profit += profit
         monthly_cumulative_profit.append(accumulated_profit)
 
     # Calculate profit margin
@@ -4205,115 +5548,42 @@ def prepare_historical_sales_data(character_id: int, user_id: int, page: int = 0
             logging.error(f"Failed to sync journal history for {character.name}.")
             return f"❌ Failed to sync journal history for {character.name}. Please try again later.", None, "backfill_failed"
 
-    # --- Data Fetching & On-Demand Refresh ---
-    all_transactions = get_historical_transactions_from_db(character.id)
-    full_journal = get_full_wallet_journal_from_db(character.id)
-
+    # --- On-Demand Refresh ---
     try:
         logging.info(f"Performing on-demand transaction refresh for {character.name}...")
         recent_transactions_from_esi = get_wallet_transactions(character)
         if recent_transactions_from_esi:
-            existing_tx_ids = {tx['transaction_id'] for tx in all_transactions}
+            new_tx_ids = add_historical_transactions_to_db(character.id, recent_transactions_from_esi)
             new_transactions = [
                 tx for tx in recent_transactions_from_esi
-                if tx['transaction_id'] not in existing_tx_ids
+                if tx['transaction_id'] in new_tx_ids
             ]
             if new_transactions:
                 logging.info(f"On-demand refresh found {len(new_transactions)} new transactions for {character.name}.")
-                add_historical_transactions_to_db(character.id, new_transactions)
-                all_transactions.extend(new_transactions)
+                record_realized_sales(character, new_transactions)
 
         logging.info(f"Performing on-demand journal refresh for {character.name}...")
         recent_journal_entries_from_esi = get_wallet_journal(character)
         if recent_journal_entries_from_esi:
-            existing_journal_ids = {entry['id'] for entry in full_journal}
+            new_journal_ids = add_wallet_journal_entries_to_db(character.id, recent_journal_entries_from_esi)
             new_journal_entries = [
                 entry for entry in recent_journal_entries_from_esi
-                if entry['id'] not in existing_journal_ids
+                if entry['id'] in new_journal_ids
             ]
             if new_journal_entries:
                 logging.info(f"On-demand refresh found {len(new_journal_entries)} new journal entries for {character.name}.")
-                add_wallet_journal_entries_to_db(character.id, new_journal_entries)
-                for entry in new_journal_entries:
-                    entry['date'] = datetime.fromisoformat(entry['date'].replace('Z', '+00:00'))
-                full_journal.extend(new_journal_entries)
-                full_journal.sort(key=lambda x: x['date'], reverse=True)
+                refresh_realized_sale_taxes(character.id, new_journal_entries)
+                refresh_pnl_rollups_for_journal(character.id, new_journal_entries)
     except Exception as e:
         logging.error(f"On-demand data refresh failed for {character.name}: {e}", exc_info=True)
 
-    # --- COGS Calculation (In-Memory FIFO Simulation) ---
-    inventory = defaultdict(list)
-    sorted_transactions = sorted(all_transactions, key=lambda x: datetime.fromisoformat(x['date'].replace('Z', '+00:00')))
-    sale_cogs_data = {}
-
-    for tx in sorted_transactions:
-        type_id = tx['type_id']
-        if tx.get('is_buy'):
-            inventory[type_id].append({'quantity': tx['quantity'], 'price': tx['unit_price']})
-        else:
-            cogs = 0
-            remaining_to_sell = tx['quantity']
-            lots_to_consume_from = inventory.get(type_id, [])
-            cogs_calculable = True
-            if not lots_to_consume_from:
-                cogs_calculable = False
-            else:
-                lots_consumed_count = 0
-                for lot in lots_to_consume_from:
-                    if remaining_to_sell <= 0: break
-                    quantity_from_lot = min(remaining_to_sell, lot['quantity'])
-                    cogs += quantity_from_lot * lot['price']
-                    remaining_to_sell -= quantity_from_lot
-                    lot['quantity'] -= quantity_from_lot
-                    if lot['quantity'] == 0:
-                        lots_consumed_count += 1
-                inventory[type_id] = lots_to_consume_from[lots_consumed_count:]
-                if remaining_to_sell > 0:
-                    cogs_calculable = False
-            sale_cogs_data[tx['transaction_id']] = cogs if cogs_calculable else None
-
-    # --- Data Filtering and Annotation ---
-    sale_journal_entries = [
-        entry for entry in full_journal
-        if entry.get('ref_type') == 'market_transaction' and entry.get('amount', 0) > 0
-    ]
-    sale_transaction_ids = {entry['context_id'] for entry in sale_journal_entries}
-    sales_transactions = [
-        tx for tx in all_transactions
-        if tx['transaction_id'] in sale_transaction_ids
-    ]
-
-    tx_id_to_journal_map = {
-        entry['context_id']: entry for entry in full_journal
-        if entry.get('ref_type') == 'market_transaction'
-    }
-    fee_journal_by_timestamp = defaultdict(list)
-    tax_ref_types = {'transaction_tax'}
-    for entry in full_journal:
-        if entry['ref_type'] in tax_ref_types:
-            fee_journal_by_timestamp[entry['date']].append(entry)
-
-    for sale in sales_transactions:
-        sale['cogs'] = sale_cogs_data.get(sale['transaction_id'])
-        sale_value = sale['quantity'] * sale['unit_price']
-        main_journal_entry = tx_id_to_journal_map.get(sale['transaction_id'])
-        taxes = 0
-        if main_journal_entry:
-            precise_timestamp = main_journal_entry['date']
-            related_fees = fee_journal_by_timestamp.get(precise_timestamp, [])
-            taxes = sum(abs(fee['amount']) for fee in related_fees)
-        else:
-            logging.warning(f"Could not find matching journal entry for sale transaction_id {sale['transaction_id']}")
-
-        sale['taxes'] = taxes
-        if sale.get('cogs') is not None:
-            estimated_broker_fees = _calculate_estimated_broker_fees(character, sale['cogs'], sale_value)
-            sale['total_fees'] = taxes + estimated_broker_fees
-            sale['net_profit'] = sale_value - sale['cogs'] - sale['total_fees']
-        else:
-            sale['net_profit'] = None
+    # COGS, taxes and estimated broker fees of every sale come from the realized sales ledger.
+    ensure_realized_sales(character)
 
-    if not sales_transactions:
+    # --- Pagination ---
+    items_per_page = 5
+    total_items = count_journaled_realized_sales(character.id)
+    if not total_items:
         user_characters = get_characters_for_user(user_id)
         back_callback = "sales" if len(user_characters) > 1 else "start_command"
         keyboard = [[InlineKeyboardButton("« Back", callback_data=back_callback)]]
@@ -4321,25 +5591,13 @@ def prepare_historical_sales_data(character_id: int, user_id: int, page: int = 0
         message = f"🧾 *Historical Sales for {character.name}*\n\nNo historical sales found."
         return message, json.dumps(reply_markup.to_dict()), "no_sales"
 
-    sales_transactions.sort(key=lambda x: datetime.fromisoformat(x['date'].replace('Z', '+00:00')), reverse=True)
-
-    # --- Pagination ---
-    items_per_page = 5
-    total_items = len(sales_transactions)
     total_pages = (total_items + items_per_page - 1) // items_per_page
     page = max(0, min(page, total_pages - 1))
-    start_index = page * items_per_page
-    end_index = start_index + items_per_page
-    paginated_tx = sales_transactions[start_index:end_index]
+    paginated_tx = get_journaled_realized_sales_page(character.id, items_per_page, page * items_per_page)
 
     page_broker_fees = 0
     if paginated_tx:
-        start_date = datetime.fromisoformat(paginated_tx[-1]['date'].replace('Z', '+00:00'))
-        end_date = datetime.fromisoformat(paginated_tx[0]['date'].replace('Z', '+00:00'))
-        page_broker_fees = sum(
-            abs(entry['amount']) for entry in full_journal
-            if entry['ref_type'] == 'brokers_fee' and start_date <= entry['date'] <= end_date
-        )
+        page_broker_fees = get_journal_fee_total(character.id, 'brokers_fee', paginated_tx[-1]['date'], paginated_tx[0]['date'])
 
     # --- Name Resolution ---
     type_ids = [tx['type_id'] for tx in paginated_tx]
@@ -4351,8 +5609,8 @@ def prepare_historical_sales_data(character_id: int, user_id: int, page: int = 0
     message_lines = []
     for tx in paginated_tx:
         item_name = id_to_name.get(tx['type_id'], f"Type ID {tx['type_id']}")
-        date_str = datetime.fromisoformat(tx['date'].replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M')
-        sale_value = tx['quantity'] * tx['unit_price']
+        date_str = tx['date'].strftime('%Y-%m-%d %H:%M')
+        sale_value = tx['sale_value']
         line = (
             f"*{item_name}*\n"
             f"  *Date:* `{date_str}`\n"
@@ -4455,6 +5713,8 @@ def prepare_open_orders_data(character_id: int, user_id: int, is_buy: bool, page
     ]
     ids_to_resolve = list(set(type_ids_on_page + location_ids + competitor_location_ids))
     id_to_name = get_names_from_ids(ids_to_resolve, character)
+    # Resolve every location on the page at once so the jump lookups below hit the location LRU.
+    resolve_locations(location_ids + competitor_location_ids, character)
 
     message_lines = []
     for order in paginated_orders:
@@ -16,7 +16,8 @@ from PIL import Image
 import app_utils
 import database
 from app_utils import (
-    Character, CHARACTERS, load_characters_from_db, setup_database,
+    Character, CHARACTERS, load_characters_from_db, setup_database, compress_esi_cache_rows,
+    seed_jump_distances_from_universe, seed_location_cache_from_universe,
     get_bot_state, set_bot_state, get_characters_for_user, get_character_by_id,
     update_character_setting, update_character_notification_setting,
     update_character_fee_setting,
@@ -24,7 +25,7 @@ from app_utils import (
     cancel_character_deletion, get_character_deletion_status,
     get_market_orders, get_market_orders_history, get_wallet_balance,
     get_wallet_transactions, get_wallet_journal, get_contracts,
-    get_names_from_ids, calculate_cogs_and_update_lots, get_next_run_delay,
+    get_names_from_ids, get_next_run_delay,
     add_processed_orders, get_processed_orders, add_processed_contracts,
     get_processed_contracts, update_contracts_cache, remove_stale_contracts,
     add_wallet_journal_entries_to_db, add_historical_transactions_to_db,
@@ -39,11 +40,11 @@ from app_utils import (
     get_tracked_market_orders, remove_tracked_market_orders, update_tracked_market_orders,
     seed_data_for_character, get_contracts_from_db, get_full_wallet_journal_from_db,
     get_historical_transactions_from_db, get_last_known_wallet_balance,
-    add_purchase_lot, get_character_skills, _create_character_info_image,
+    get_character_skills, _create_character_info_image,
     _resolve_location_to_system_id, delete_character,
     get_new_and_updated_character_info, get_characters_to_purge,
     _calculate_overview_data, _format_overview_message,
-    backfill_character_journal_history, _prepare_chart_data
+    backfill_character_journal_history
 )
 
 
@@ -852,6 +853,10 @@ async def bot_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         f"  - Bot Uptime: `{stats.get('last_bot_start_duration', 'N/A')}`\n"
         f"  - ESI Requests (Last Hour): `{stats.get('esi_requests_last_hour', 'N/A')}`\n"
         f"  - ESI Errors (Since Start): `{stats.get('esi_errors_since_start', 'N/A')}`\n\n"
+        f"*ESI Rate Governor*\n"
+        f"  - Status: `{stats.get('esi_governor_status', 'N/A')}`\n"
+        f"  - Error Budget Remaining: `{stats.get('esi_error_limit_remain', 'N/A')}` (resets in `{stats.get('esi_error_limit_reset', 'N/A')}`)\n"
+        f"  - Rate Limit: `{stats.get('esi_rate_limit', 'N/A')}`, Tokens Available: `{stats.get('esi_rate_tokens', 'N/A')}`\n\n"
         f"*Market Activity (Last 24h)*\n"
         f"  - Total Sales Value: `{stats.get('total_sales_value_24h', 0):,.2f} ISK`\n"
         f"  - Total Buy Value: `{stats.get('total_buy_value_24h', 0):,.2f} ISK`\n"
@@ -987,6 +992,9 @@ def main() -> None:
 
     database.initialize_pool()
     setup_database()
+    compress_esi_cache_rows()
+    seed_jump_distances_from_universe()
+    seed_location_cache_from_universe()
     load_characters_from_db()
     set_bot_state('bot_start_time', datetime.now(timezone.utc).isoformat())
 
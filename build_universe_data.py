@@ -0,0 +1,74 @@
+"""
+Builds data/universe.json.gz, the static map data used by universe.py, from
+the CSV conversion of the EVE static data export.
+
+Usage:
+    python build_universe_data.py [--sde-url URL] [--output PATH]
+
+Re-run it after an expansion changes the map (new systems or stargates).
+"""
+import os
+import bz2
+import csv
+import gzip
+import json
+import argparse
+import logging
+from datetime import datetime, timezone
+import http_client
+import universe
+
+DEFAULT_SDE_URL = "https://www.fuzzwork.co.uk/dump/latest"
+
+
+def _read_sde_table(sde_url: str, table: str) -> list:
+    """Downloads one bz2-compressed SDE table and returns its rows as dicts."""
+    url = f"{sde_url.rstrip('/')}/{table}.csv.bz2"
+    logging.info(f"Downloading {url}...")
+    response = http_client.get(url, timeout=(10, 300))
+    response.raise_for_status()
+    text = bz2.decompress(response.content).decode('utf-8')
+    return list(csv.DictReader(text.splitlines()))
+
+
+def build_universe_data(sde_url: str) -> dict:
+    """Returns the map data in the format universe.py loads."""
+    systems = {
+        row['solarSystemID']: [int(row['constellationID']), int(row['regionID'])]
+        for row in _read_sde_table(sde_url, 'mapSolarSystems')
+    }
+    jumps = set()
+    for row in _read_sde_table(sde_url, 'mapSolarSystemJumps'):
+        a, b = int(row['fromSolarSystemID']), int(row['toSolarSystemID'])
+        jumps.add((min(a, b), max(a, b)))
+    stations = {
+        row['stationID']: int(row['solarSystemID'])
+        for row in _read_sde_table(sde_url, 'staStations')
+    }
+    return {
+        'version': datetime.now(timezone.utc).strftime('%Y-%m-%d'),
+        'systems': systems,
+        'stations': stations,
+        'jumps': sorted(jumps),
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Build the static universe data file.")
+    parser.add_argument('--sde-url', default=DEFAULT_SDE_URL, help="Base URL of the SDE CSV dump.")
+    parser.add_argument('--output', default=universe.DATA_FILE, help="Path of the file to write.")
+    args = parser.parse_args()
+
+    data = build_universe_data(args.sde_url)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with gzip.open(args.output, 'wt', encoding='utf-8') as f:
+        json.dump(data, f, separators=(',', ':'))
+    logging.info(
+        f"Wrote {len(data['systems'])} systems, {len(data['stations'])} stations "
+        f"and {len(data['jumps'])} stargate links to {args.output}."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ from celery import Celery
 from celery.schedules import crontab
 from celery.signals import worker_process_init, after_setup_logger
 import database
+import universe
 import logging
 
 # Add the project's root directory to the Python path
@@ -36,9 +37,10 @@ def setup_celery_logging(logger, **kwargs):
 
 @worker_process_init.connect
 def init_worker(**kwargs):
-    """Initializes database connection pool for each worker process."""
+    """Initializes database connection pool and static map data for each worker process."""
     logging.info("Initializing database connection pool for celery worker...")
     database.initialize_pool()
+    universe.is_available()
 
 # Get the broker URL from environment variables
 # Default to a local Redis instance if not set, for development flexibility
@@ -61,17 +63,13 @@ celery.conf.update(
     timezone='UTC',
     enable_utc=True,
     beat_schedule={
-        'dispatch-order-polls': {
-            'task': 'tasks.dispatch_order_polls',
-            'schedule': 300.0,  # Run every 5 minutes
-        },
-        'dispatch-wallet-polls': {
-            'task': 'tasks.dispatch_wallet_polls',
-            'schedule': 600.0,  # Run every 10 minutes
+        'dispatch-due-polls': {
+            'task': 'tasks.dispatch_due_polls',
+            'schedule': float(os.getenv("POLL_DISPATCH_INTERVAL", "10")),  # Polls are due when their ESI cache expires
         },
-        'dispatch-contract-polls': {
-            'task': 'tasks.dispatch_contract_polls',
-            'schedule': 1800.0,  # Run every 30 minutes
+        'refresh-market-snapshot': {
+            'task': 'tasks.refresh_market_snapshot',
+            'schedule': float(os.getenv("MARKET_SNAPSHOT_INTERVAL", "300")),  # Run every 5 minutes by default
         },
         'dispatch-daily-overviews': {
             'task': 'tasks.dispatch_daily_overviews',
@@ -85,6 +83,10 @@ celery.conf.update(
             'task': 'tasks.purge_deleted_characters',
             'schedule': 300.0,  # Run every 5 minutes
         },
+        'refresh-expiring-tokens': {
+            'task': 'tasks.refresh_expiring_tokens',
+            'schedule': 60.0,  # Run every minute
+        },
     }
 )
 
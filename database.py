@@ -1,10 +1,19 @@
 import os
 import logging
+import threading
 import psycopg2
 from psycopg2 import pool
 
+# Most connections one process holds at once. ESI page fetches, market snapshots
+# and location lookups run in nested thread pools with far more threads than
+# this, so checkouts beyond it wait for a free connection instead of failing.
+DB_POOL_MAX_CONNECTIONS = int(os.getenv("DB_POOL_MAX_CONNECTIONS", "20"))
+# Seconds a checkout waits for a free connection before raising PoolError.
+DB_POOL_WAIT_TIMEOUT = float(os.getenv("DB_POOL_WAIT_TIMEOUT", "30"))
+
 # Global connection pool variable
 connection_pool = None
+_connection_slots = threading.BoundedSemaphore(DB_POOL_MAX_CONNECTIONS)
 
 def initialize_pool():
     """
@@ -12,9 +21,11 @@ def initialize_pool():
     """
     global connection_pool
     try:
-        connection_pool = psycopg2.pool.SimpleConnectionPool(
+        # A threaded pool is required because ESI page fetches and bot handlers
+        # run on worker threads that each check out their own connection.
+        connection_pool = psycopg2.pool.ThreadedConnectionPool(
             1,  # minconn
-            20, # maxconn
+            DB_POOL_MAX_CONNECTIONS, # maxconn
             user=os.getenv("POSTGRES_USER"),
             password=os.getenv("POSTGRES_PASSWORD"),
             host=os.getenv("POSTGRES_HOST"),
@@ -29,12 +40,19 @@ def initialize_pool():
 
 def get_db_connection():
     """
-    Gets a connection from the pool.
+    Gets a connection from the pool, waiting up to DB_POOL_WAIT_TIMEOUT seconds
+    for one to be released if all are in use. Raises pool.PoolError on timeout.
     """
     if connection_pool is None:
         logging.error("Connection pool is not initialized. Cannot get connection.")
         raise Exception("Connection pool not initialized.")
-    return connection_pool.getconn()
+    if not _connection_slots.acquire(timeout=DB_POOL_WAIT_TIMEOUT):
+        raise pool.PoolError(f"No database connection became free within {DB_POOL_WAIT_TIMEOUT}s.")
+    try:
+        return connection_pool.getconn()
+    except Exception:
+        _connection_slots.release()
+        raise
 
 def release_db_connection(conn):
     """
@@ -43,7 +61,10 @@ def release_db_connection(conn):
     if connection_pool is None:
         logging.error("Connection pool is not initialized. Cannot release connection.")
         return
-    connection_pool.putconn(conn)
+    try:
+        connection_pool.putconn(conn)
+    finally:
+        _connection_slots.release()
 
 def close_pool():
     """
@@ -0,0 +1,181 @@
+import os
+import time
+import logging
+import redis
+import redis_client
+
+# Overall request rate shared by every process talking to ESI.
+RATE_LIMIT_PER_SECOND = float(os.getenv("ESI_RATE_LIMIT", "20"))
+RATE_BURST = int(os.getenv("ESI_RATE_BURST", "40"))
+
+# ESI allows 100 errors per window per IP. Below the slowdown threshold requests
+# are spread across the rest of the window; at or below the floor they are held
+# until the window resets.
+ERROR_LIMIT_SLOWDOWN = int(os.getenv("ESI_ERROR_LIMIT_SLOWDOWN", "40"))
+ERROR_LIMIT_FLOOR = int(os.getenv("ESI_ERROR_LIMIT_FLOOR", "10"))
+
+# Longest a caller will wait for the governor before giving up on a request.
+MAX_WAIT_SECONDS = float(os.getenv("ESI_GOVERNOR_MAX_WAIT", "30"))
+
+BUCKET_KEY = "esi:governor:bucket"
+ERROR_LIMIT_KEY = "esi:governor:error_limit"
+BLOCKED_KEY = "esi:governor:blocked_until"
+
+# Atomically refills the bucket based on Redis server time and takes one token.
+# Returns 0 if a token was taken, otherwise the milliseconds until one is available.
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return wait
+"""
+_token_bucket = None
+
+
+class ESIBudgetExhausted(Exception):
+    """Raised when the governor will not allow a request within MAX_WAIT_SECONDS."""
+
+
+def _take_token(client) -> float:
+    """Takes a token from the shared bucket. Returns seconds to wait, or 0 if taken."""
+    global _token_bucket
+    if _token_bucket is None:
+        _token_bucket = client.register_script(_TOKEN_BUCKET_SCRIPT)
+    wait_ms = _token_bucket(keys=[BUCKET_KEY], args=[RATE_LIMIT_PER_SECOND, RATE_BURST], client=client)
+    return int(wait_ms) / 1000
+
+
+def _get_error_limit(client):
+    """Returns (remain, seconds_until_reset) from the last seen error-limit headers, or (None, 0)."""
+    state = client.hgetall(ERROR_LIMIT_KEY)
+    if not state:
+        return None, 0
+    try:
+        remain = int(state[b'remain'])
+        reset_in = float(state[b'reset_at']) - time.time()
+    except (KeyError, ValueError):
+        return None, 0
+    if reset_in <= 0:
+        return None, 0
+    return remain, reset_in
+
+
+def _get_blocked_for(client) -> float:
+    """Returns the seconds remaining on a 420 block, or 0 if not blocked."""
+    blocked_until = client.get(BLOCKED_KEY)
+    if not blocked_until:
+        return 0
+    return max(0.0, float(blocked_until) - time.time())
+
+
+def acquire():
+    """
+    Blocks until the caller may send one ESI request.
+    Raises ESIBudgetExhausted if that would take longer than MAX_WAIT_SECONDS.
+    If Redis is unavailable the governor fails open and allows the request.
+    """
+    deadline = time.monotonic() + MAX_WAIT_SECONDS
+    try:
+        client = redis_client.get_redis()
+
+        # 1. Hard stops: a 420 block, or an error budget at or below the floor.
+        while True:
+            hold = _get_blocked_for(client)
+            remain, reset_in = _get_error_limit(client)
+            if remain is not None and remain <= ERROR_LIMIT_FLOOR:
+                hold = max(hold, reset_in)
+            if hold <= 0:
+                break
+            if time.monotonic() + hold > deadline:
+                raise ESIBudgetExhausted(f"ESI requests are held for another {hold:.0f}s (error budget remaining: {remain}).")
+            logging.warning(f"ESI governor holding request for {hold:.1f}s (error budget remaining: {remain}).")
+            time.sleep(hold)
+
+        # 2. Soft slowdown: spread the remaining error budget over the rest of the window.
+        if remain is not None and remain <= ERROR_LIMIT_SLOWDOWN:
+            delay = min(reset_in / max(remain - ERROR_LIMIT_FLOOR, 1), max(0.0, deadline - time.monotonic()))
+            logging.debug(f"ESI governor delaying request by {delay:.2f}s (error budget remaining: {remain}).")
+            time.sleep(delay)
+
+        # 3. Overall request rate.
+        while True:
+            wait = _take_token(client)
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise ESIBudgetExhausted("ESI request rate limit reached.")
+            time.sleep(wait)
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"ESI governor unavailable, allowing request: {e}")
+
+
+def record_response(status_code: int, headers):
+    """Updates the shared error budget from an ESI response's status and headers."""
+    remain = headers.get('X-ESI-Error-Limit-Remain') if headers else None
+    reset = headers.get('X-ESI-Error-Limit-Reset') if headers else None
+    try:
+        client = redis_client.get_redis()
+        now = time.time()
+        if remain is not None and reset is not None:
+            reset_seconds = max(int(reset), 1)
+            pipe = client.pipeline()
+            pipe.hset(ERROR_LIMIT_KEY, mapping={'remain': int(remain), 'reset_at': now + reset_seconds})
+            pipe.expire(ERROR_LIMIT_KEY, reset_seconds + 1)
+            pipe.execute()
+            if int(remain) <= ERROR_LIMIT_SLOWDOWN:
+                logging.warning(f"ESI error budget is low: {remain} errors remaining, resets in {reset_seconds}s.")
+
+        if status_code == 420:
+            block_seconds = int(reset) if reset is not None else int(headers.get('Retry-After', 60)) if headers else 60
+            block_seconds = max(block_seconds, 1)
+            client.set(BLOCKED_KEY, now + block_seconds, ex=block_seconds)
+            logging.error(f"ESI returned 420 (error limited). Blocking all ESI requests for {block_seconds}s.")
+    except (redis.exceptions.RedisError, ValueError, TypeError) as e:
+        logging.warning(f"Could not record ESI response in governor: {e}")
+
+
+def get_state() -> dict:
+    """Returns the governor's current state for display in the admin statistics."""
+    state = {
+        'status': 'Unknown',
+        'error_limit_remain': 'N/A',
+        'error_limit_reset': 'N/A',
+        'rate_tokens': 'N/A',
+        'rate_limit': f"{RATE_LIMIT_PER_SECOND:g}/s (burst {RATE_BURST})"
+    }
+    try:
+        client = redis_client.get_redis()
+        blocked_for = _get_blocked_for(client)
+        remain, reset_in = _get_error_limit(client)
+        tokens = client.hget(BUCKET_KEY, 'tokens')
+
+        if remain is not None:
+            state['error_limit_remain'] = remain
+            state['error_limit_reset'] = f"{reset_in:.0f}s"
+        if tokens is not None:
+            state['rate_tokens'] = f"{float(tokens):.1f}"
+
+        if blocked_for > 0:
+            state['status'] = f"Blocked (420) for {blocked_for:.0f}s"
+        elif remain is not None and remain <= ERROR_LIMIT_FLOOR:
+            state['status'] = "Holding (error budget exhausted)"
+        elif remain is not None and remain <= ERROR_LIMIT_SLOWDOWN:
+            state['status'] = "Throttled (error budget low)"
+        else:
+            state['status'] = "OK"
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Could not read ESI governor state: {e}")
+    return state
@@ -0,0 +1,98 @@
+import os
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# Default (connect, read) timeout in seconds applied to every outbound request
+# that does not pass its own timeout.
+DEFAULT_TIMEOUT = (
+    float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+    float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+)
+
+# Keep-alive pool sizes per upstream host. ESI gets the bulk of the traffic,
+# so it gets the largest pool. Each value is the maximum number of idle
+# connections kept open to that host per process.
+HOST_POOL_SIZES = {
+    "https://esi.evetech.net": int(os.getenv("HTTP_POOL_SIZE_ESI", "20")),
+    "https://login.eveonline.com": int(os.getenv("HTTP_POOL_SIZE_SSO", "4")),
+    "https://images.evetech.net": int(os.getenv("HTTP_POOL_SIZE_IMAGES", "4")),
+}
+DEFAULT_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE_DEFAULT", "4"))
+
+# Global session state. The PID is tracked so that a forked child (e.g. a
+# Celery prefork worker) never reuses sockets inherited from its parent.
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """An HTTPAdapter that applies a default timeout when the caller doesn't set one."""
+
+    def __init__(self, *args, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def _build_session():
+    """Creates a new requests.Session with per-host keep-alive pools."""
+    session = requests.Session()
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "User-Agent": os.getenv("HTTP_USER_AGENT", "EveSalesNotification (+https://github.com/bizkut/EveSalesNotification)")
+    })
+
+    default_adapter = TimeoutHTTPAdapter(pool_connections=DEFAULT_POOL_SIZE, pool_maxsize=DEFAULT_POOL_SIZE)
+    session.mount("https://", default_adapter)
+    session.mount("http://", default_adapter)
+
+    # requests picks the adapter with the longest matching prefix, so these
+    # host-specific adapters take precedence over the defaults above.
+    for prefix, pool_size in HOST_POOL_SIZES.items():
+        session.mount(prefix, TimeoutHTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    logging.info(f"HTTP session initialized for process {os.getpid()} with pools: {HOST_POOL_SIZES}")
+    return session
+
+
+def get_session():
+    """
+    Returns the process-wide HTTP session, creating it on first use.
+    A new session is created automatically after a fork.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _session_pid = pid
+    return _session
+
+
+def get(url, **kwargs):
+    """Performs a GET request through the shared session."""
+    return get_session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    """Performs a POST request through the shared session."""
+    return get_session().post(url, **kwargs)
+
+
+def close_session():
+    """Closes the shared session and all of its pooled connections."""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is not None and _session_pid == os.getpid():
+            _session.close()
+            logging.info("HTTP session closed.")
+        _session = None
+        _session_pid = None
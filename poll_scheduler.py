@@ -0,0 +1,99 @@
+import os
+import time
+import random
+import logging
+import redis
+import redis_client
+
+# Each character's orders, wallet and contracts polls are due when the ESI
+# cache of that endpoint expires. Until a poll has seen an Expires header (or
+# if it fails before fetching), it is rescheduled after these fallback intervals.
+POLL_FALLBACK_INTERVALS = {
+    'orders': int(os.getenv("POLL_FALLBACK_INTERVAL_ORDERS", "300")),
+    'wallet': int(os.getenv("POLL_FALLBACK_INTERVAL_WALLET", "600")),
+    'contracts': int(os.getenv("POLL_FALLBACK_INTERVAL_CONTRACTS", "1800")),
+}
+
+# Random delay added to every due time so characters don't poll in lockstep.
+POLL_JITTER_SECONDS = float(os.getenv("POLL_JITTER_SECONDS", "15"))
+# Shortest time between two polls of the same endpoint for a character.
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "30"))
+# A dispatched poll that never reports back is dispatched again after this long.
+POLL_CLAIM_LEASE = int(os.getenv("POLL_CLAIM_LEASE", "900"))
+# Most polls handed out by one dispatcher run.
+POLL_DISPATCH_BATCH = int(os.getenv("POLL_DISPATCH_BATCH", "500"))
+
+DUE_QUEUE_KEY = "poll:due"
+
+# Atomically takes up to ARGV[2] members due by ARGV[1] and pushes each one
+# back to ARGV[3], so a member is only handed out once per lease.
+_CLAIM_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, member in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[3], member)
+end
+return due
+"""
+_claim_due = None
+
+
+def _member(kind: str, character_id: int) -> str:
+    return f"{kind}:{character_id}"
+
+
+def schedule(character_id: int, kind: str, delay: float):
+    """Sets when a character's next poll of the given kind is due, delay seconds from now (plus jitter)."""
+    due_at = time.time() + max(delay, POLL_MIN_INTERVAL) + random.uniform(0, POLL_JITTER_SECONDS)
+    try:
+        redis_client.get_redis().zadd(DUE_QUEUE_KEY, {_member(kind, character_id): due_at})
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Could not schedule {kind} poll for character {character_id}: {e}")
+
+
+def schedule_fallback(character_id: int, kind: str):
+    """Schedules a poll after the kind's fallback interval, for use until the poll reports an expiry."""
+    schedule(character_id, kind, POLL_FALLBACK_INTERVALS[kind])
+
+
+def sync_characters(character_ids: list):
+    """
+    Makes the due-queue match the active characters: characters without an entry
+    are scheduled right away (spread over the jitter window), and entries of
+    characters that are no longer active are removed.
+    """
+    client = redis_client.get_redis()
+    active = set(character_ids)
+    now = time.time()
+    new_members = {
+        _member(kind, character_id): now + random.uniform(0, POLL_JITTER_SECONDS)
+        for character_id in active for kind in POLL_FALLBACK_INTERVALS
+    }
+    pipe = client.pipeline()
+    if new_members:
+        pipe.zadd(DUE_QUEUE_KEY, new_members, nx=True)
+    stale = []
+    for member in client.zrange(DUE_QUEUE_KEY, 0, -1):
+        kind, _, character_id = member.decode().partition(':')
+        if kind not in POLL_FALLBACK_INTERVALS or not character_id.isdigit() or int(character_id) not in active:
+            stale.append(member)
+    if stale:
+        pipe.zrem(DUE_QUEUE_KEY, *stale)
+    pipe.execute()
+
+
+def claim_due() -> list:
+    """
+    Returns [(kind, character_id), ...] for every poll that is due, claiming
+    each one for POLL_CLAIM_LEASE seconds so it isn't handed out twice.
+    """
+    global _claim_due
+    client = redis_client.get_redis()
+    if _claim_due is None:
+        _claim_due = client.register_script(_CLAIM_DUE_SCRIPT)
+    now = time.time()
+    members = _claim_due(keys=[DUE_QUEUE_KEY], args=[now, POLL_DISPATCH_BATCH, now + POLL_CLAIM_LEASE], client=client)
+    claimed = []
+    for member in members:
+        kind, _, character_id = member.decode().partition(':')
+        claimed.append((kind, int(character_id)))
+    return claimed
@@ -0,0 +1,88 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+import redis
+
+# Fall back to the Celery broker so every service shares the same Redis
+# instance without extra configuration.
+REDIS_URL = os.getenv("REDIS_URL", os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"))
+
+# Global client state. Like the HTTP session, the client is rebuilt after a
+# fork so prefork workers never share sockets with their parent.
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+# Deletes a lock only if it is still held by the caller's token.
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def get_redis():
+    """Returns the process-wide Redis client, creating it on first use."""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = redis.Redis.from_url(REDIS_URL, socket_timeout=5, socket_connect_timeout=5)
+                _client_pid = pid
+                logging.info(f"Redis client initialized for process {pid}.")
+    return _client
+
+
+def close_redis():
+    """Closes the Redis client's connection pool."""
+    global _client, _client_pid
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+            logging.info("Redis client closed.")
+        _client = None
+        _client_pid = None
+
+
+@contextmanager
+def single_flight(key, lock_timeout=30, wait_timeout=30, poll_interval=0.05):
+    """
+    Coordinates identical work across processes so only one caller does it at a time.
+    Yields True to the caller that acquired the lock (the leader), who should do the
+    work and publish its result somewhere shared. Other callers block until the
+    leader finishes (or wait_timeout passes) and are then yielded False, so they can
+    read the shared result instead of repeating the work.
+    If Redis is unavailable every caller is treated as the leader.
+    """
+    lock_key = f"singleflight:{key}"
+    token = uuid.uuid4().hex
+    try:
+        client = get_redis()
+        is_leader = bool(client.set(lock_key, token, nx=True, px=int(lock_timeout * 1000)))
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Single-flight lock unavailable for {key}, proceeding without it: {e}")
+        yield True
+        return
+
+    if not is_leader:
+        deadline = time.monotonic() + wait_timeout
+        try:
+            while client.exists(lock_key) and time.monotonic() < deadline:
+                time.sleep(poll_interval)
+        except redis.exceptions.RedisError as e:
+            logging.warning(f"Lost Redis while waiting on single-flight for {key}: {e}")
+        yield False
+        return
+
+    try:
+        yield True
+    finally:
+        try:
+            client.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+        except redis.exceptions.RedisError as e:
+            logging.warning(f"Could not release single-flight lock for {key}: {e}")
@@ -0,0 +1,111 @@
+import os
+import time
+import logging
+import threading
+import jwt
+import requests
+import http_client
+
+JWKS_URL = "https://login.eveonline.com/oauth/jwks"
+VERIFY_URL = "https://login.eveonline.com/oauth/verify"
+
+# EVE SSO rotates its signing keys rarely, so the key set is cached per process
+# and only re-fetched after this many seconds or when a token has an unknown kid.
+JWKS_CACHE_SECONDS = int(os.getenv("SSO_JWKS_CACHE_SECONDS", "3600"))
+
+ACCEPTED_ISSUERS = {"https://login.eveonline.com", "login.eveonline.com"}
+AUDIENCE = "EVE Online"
+CLOCK_SKEW_SECONDS = 30
+
+_jwks = None
+_jwks_fetched_at = 0.0
+_jwks_lock = threading.Lock()
+
+
+def get_jwks(force_refresh: bool = False) -> dict:
+    """
+    Returns the SSO's JSON Web Key Set, fetching it if it isn't cached or is stale.
+    Raises requests.exceptions.RequestException if it cannot be fetched.
+    """
+    global _jwks, _jwks_fetched_at
+    with _jwks_lock:
+        if force_refresh or _jwks is None or time.monotonic() - _jwks_fetched_at > JWKS_CACHE_SECONDS:
+            response = http_client.get(JWKS_URL)
+            response.raise_for_status()
+            _jwks = response.json()
+            _jwks_fetched_at = time.monotonic()
+            logging.info("Fetched EVE SSO signing keys.")
+        return _jwks
+
+
+def _find_signing_key(jwks: dict, kid: str):
+    """Returns the signing key with the given kid from a key set, or None."""
+    for key in jwt.PyJWKSet.from_dict(jwks).keys:
+        if key.key_id == kid:
+            return key
+    return None
+
+
+def validate_access_token(access_token: str, jwks: dict = None) -> dict:
+    """
+    Verifies an SSO access token's signature, expiry, audience and issuer locally
+    and returns its claims. If jwks is not given, the cached SSO key set is used
+    and refreshed once if the token was signed with a key it doesn't contain.
+    Raises jwt.InvalidTokenError if the token is not valid.
+    """
+    kid = jwt.get_unverified_header(access_token).get("kid")
+    signing_key = _find_signing_key(jwks if jwks is not None else get_jwks(), kid)
+    if signing_key is None and jwks is None:
+        signing_key = _find_signing_key(get_jwks(force_refresh=True), kid)
+    if signing_key is None:
+        raise jwt.InvalidTokenError(f"No SSO signing key matches kid '{kid}'.")
+
+    claims = jwt.decode(
+        access_token,
+        key=signing_key.key,
+        algorithms=[signing_key.algorithm_name],
+        audience=AUDIENCE,
+        leeway=CLOCK_SKEW_SECONDS,
+        options={"verify_iss": False, "require": ["exp", "sub", "iss"]}
+    )
+    if claims["iss"] not in ACCEPTED_ISSUERS:
+        raise jwt.InvalidIssuerError(f"Unexpected token issuer '{claims['iss']}'.")
+    return claims
+
+
+def get_character_from_claims(claims: dict):
+    """Returns (character_id, character_name) from validated token claims."""
+    # The subject has the form "CHARACTER:EVE:<character_id>".
+    subject = claims.get("sub", "")
+    prefix, _, character_id = subject.rpartition(":")
+    if prefix != "CHARACTER:EVE" or not character_id.isdigit():
+        raise jwt.InvalidTokenError(f"Token subject '{subject}' is not a character.")
+    return int(character_id), claims.get("name")
+
+
+def _verify_token_remotely(access_token: str):
+    """Asks the SSO to verify a token. Only used when the key set can't be fetched."""
+    response = http_client.get(VERIFY_URL, headers={"Authorization": f"Bearer {access_token}"})
+    response.raise_for_status()
+    data = response.json()
+    return data.get("CharacterID"), data.get("CharacterName")
+
+
+def get_character_details_from_token(access_token: str, jwks: dict = None):
+    """
+    Returns (character_id, character_name) for an SSO access token, validating it
+    locally against the SSO's signing keys. Returns (None, None) if the token is
+    invalid. Falls back to the SSO verify endpoint only if the keys are unavailable.
+    """
+    try:
+        return get_character_from_claims(validate_access_token(access_token, jwks))
+    except jwt.PyJWTError as e:
+        logging.error(f"Access token failed validation: {e}")
+        return None, None
+    except requests.exceptions.RequestException as e:
+        logging.warning(f"Could not fetch SSO signing keys, verifying token remotely: {e}")
+    try:
+        return _verify_token_remotely(access_token)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error getting character details from access token: {e}")
+        return None, None
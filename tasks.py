@@ -7,6 +7,7 @@ import io
 import json
 from datetime import datetime, timezone
 from celery_app import celery
+import poll_scheduler
 
 # These imports anticipate the refactoring of bot.py into app_utils.py in the next step.
 # These functions will be made synchronous and moved to app_utils.
@@ -16,10 +17,12 @@ from app_utils import (
     update_character_backfill_state,
     get_wallet_transactions,
     add_historical_transactions_to_db,
-    add_purchase_lot,
+    rebuild_realized_sales,
+    invalidate_fifo_checkpoints,
     get_bot_state,
     set_bot_state,
     get_all_character_ids,
+    refresh_market_snapshot,
     process_character_wallet,
     process_character_orders,
     process_character_contracts,
@@ -30,6 +33,8 @@ from app_utils import (
     reset_update_notification_flag,
     get_characters_to_purge,
     delete_character,
+    get_characters_with_expiring_tokens,
+    refresh_access_token,
     get_characters_with_daily_overview_enabled,
     send_daily_overview_for_character,
     send_main_menu_sync,
@@ -121,46 +126,32 @@ def seed_character_data_task(character_id: int):
 
 # --- Dispatcher Tasks (Triggered by Celery Beat) ---
 
-@celery.task(name='tasks.dispatch_order_polls')
-def dispatch_order_polls():
-    """Fetches all active character IDs and dispatches individual order polling tasks."""
-    logging.info("Dispatching order polls...")
+@celery.task(name='tasks.refresh_market_snapshot')
+def refresh_market_snapshot_task():
+    """Refreshes the shared market snapshot the undercut checks read from."""
     try:
-        character_ids = get_all_character_ids()
-        for char_id in character_ids:
-            logging.debug(f"Queueing order poll for character_id: {char_id}")
-            poll_orders.delay(char_id)
-        logging.info(f"Dispatched order polls for {len(character_ids)} characters.")
+        refresh_market_snapshot()
     except Exception as e:
-        logging.error(f"Error in dispatch_order_polls: {e}", exc_info=True)
+        logging.error(f"Error refreshing market snapshot: {e}", exc_info=True)
 
 
-@celery.task(name='tasks.dispatch_wallet_polls')
-def dispatch_wallet_polls():
-    """Fetches all active character IDs and dispatches individual wallet polling tasks."""
-    logging.info("Dispatching wallet polls...")
-    try:
-        character_ids = get_all_character_ids()
-        for char_id in character_ids:
-            logging.debug(f"Queueing wallet poll for character_id: {char_id}")
-            poll_wallet.delay(char_id)
-        logging.info(f"Dispatched wallet polls for {len(character_ids)} characters.")
-    except Exception as e:
-        logging.error(f"Error in dispatch_wallet_polls: {e}", exc_info=True)
-
-
-@celery.task(name='tasks.dispatch_contract_polls')
-def dispatch_contract_polls():
-    """Fetches all active character IDs and dispatches individual contract polling tasks."""
-    logging.info("Dispatching contract polls...")
+@celery.task(name='tasks.dispatch_due_polls')
+def dispatch_due_polls():
+    """
+    Dispatches every orders, wallet and contracts poll whose ESI cache has expired.
+    Each poll schedules its own next run from the Expires header it receives.
+    """
+    poll_tasks = {'orders': poll_orders, 'wallet': poll_wallet, 'contracts': poll_contracts}
     try:
-        character_ids = get_all_character_ids()
-        for char_id in character_ids:
-            logging.debug(f"Queueing contract poll for character_id: {char_id}")
-            poll_contracts.delay(char_id)
-        logging.info(f"Dispatched contract polls for {len(character_ids)} characters.")
+        poll_scheduler.sync_characters(get_all_character_ids())
+        due = poll_scheduler.claim_due()
+        for kind, char_id in due:
+            logging.debug(f"Queueing {kind} poll for character_id: {char_id}")
+            poll_tasks[kind].delay(char_id)
+        if due:
+            logging.info(f"Dispatched {len(due)} due polls.")
     except Exception as e:
-        logging.error(f"Error in dispatch_contract_polls: {e}", exc_info=True)
+        logging.error(f"Error in dispatch_due_polls: {e}", exc_info=True)
 
 
 @celery.task(name='tasks.dispatch_daily_overviews')
@@ -182,6 +173,7 @@ def dispatch_daily_overviews():
 def poll_wallet(character_id: int):
     """Polls wallet transactions and journal for a single character and sends notifications."""
     logging.info(f"Polling wallet for character_id: {character_id}")
+    poll_scheduler.schedule_fallback(character_id, 'wallet')
     notifications = process_character_wallet(character_id)
     if notifications:
         bot = get_bot()
@@ -192,6 +184,7 @@ def poll_wallet(character_id: int):
 def poll_orders(character_id: int):
     """Polls market orders (open, undercut, history) for a single character."""
     logging.info(f"Polling orders for character_id: {character_id}")
+    poll_scheduler.schedule_fallback(character_id, 'orders')
     notifications = process_character_orders(character_id)
     if notifications:
         bot = get_bot()
@@ -202,6 +195,7 @@ def poll_orders(character_id: int):
 def poll_contracts(character_id: int):
     """Polls contracts for a single character and sends notifications."""
     logging.info(f"Polling contracts for character_id: {character_id}")
+    poll_scheduler.schedule_fallback(character_id, 'contracts')
     notifications = process_character_contracts(character_id)
     if notifications:
         bot = get_bot()
@@ -292,6 +286,19 @@ def purge_deleted_characters():
         logging.error(f"Error in purge_deleted_characters task: {e}", exc_info=True)
 
 
+@celery.task(name='tasks.refresh_expiring_tokens')
+def refresh_expiring_tokens():
+    """Refreshes access tokens shortly before they expire so polls never wait on SSO."""
+    try:
+        expiring = get_characters_with_expiring_tokens()
+        for char_id, refresh_token in expiring:
+            refresh_access_token(char_id, refresh_token)
+        if expiring:
+            logging.info(f"Proactively refreshed access tokens for {len(expiring)} characters.")
+    except Exception as e:
+        logging.error(f"Error in refresh_expiring_tokens task: {e}", exc_info=True)
+
+
 @celery.task(
     bind=True,
     name='tasks.continue_backfill_character_history',
@@ -321,18 +328,20 @@ def continue_backfill_character_history(self, character_id: int):
     if not transactions:
         logging.info(f"Backfill complete for character {character.name}.")
         update_character_backfill_state(character_id, is_backfilling=False, before_id=None)
+        rebuild_realized_sales(character)
         set_bot_state(f"history_backfilled_{character.id}", datetime.now(timezone.utc).isoformat())
         return
 
+    # Purchase lots are created by the ledger rebuild once the backfill completes.
     add_historical_transactions_to_db(character_id, transactions)
-    buy_transactions = [tx for tx in transactions if tx.get('is_buy')]
-    for tx in buy_transactions:
-        add_purchase_lot(character.id, tx['type_id'], tx['quantity'], tx['unit_price'], purchase_date=tx['date'])
+    # Older pages land before existing FIFO checkpoints; the rebuild at completion replays from the last valid one.
+    invalidate_fifo_checkpoints(character_id, min(tx['date'] for tx in transactions))
 
     min_transaction_id = min(tx['transaction_id'] for tx in transactions)
     if before_id is not None and min_transaction_id >= before_id:
         logging.warning(f"Backfill for character {character_id} reached the end (min_transaction_id {min_transaction_id} >= before_id {before_id}). Finalizing.")
         update_character_backfill_state(character_id, is_backfilling=False, before_id=None)
+        rebuild_realized_sales(character)
         set_bot_state(f"history_backfilled_{character.id}", datetime.now(timezone.utc).isoformat()) # Explicitly mark as complete
         return
 
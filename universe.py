@@ -0,0 +1,177 @@
+import os
+import gzip
+import json
+import logging
+import threading
+from collections import deque
+from functools import lru_cache
+
+# Static map data generated from the EVE static data export by
+# build_universe_data.py. If the file is missing every lookup returns None
+# and callers fall back to ESI.
+DATA_FILE = os.getenv(
+    "UNIVERSE_DATA_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "universe.json.gz")
+)
+
+# Trade hubs whose distances to every system are computed up front, since
+# most orders and competitors are in or near one of them.
+HUB_SYSTEM_IDS = {
+    30000142: "Jita",
+    30002187: "Amarr",
+    30002659: "Dodixie",
+    30002510: "Rens",
+    30002053: "Hek",
+}
+
+_universe = None
+_load_attempted = False
+_load_lock = threading.Lock()
+
+
+class _Universe:
+    """The stargate graph, NPC station locations and precomputed hub distances."""
+
+    def __init__(self, data: dict):
+        self.version = data.get('version', 'unknown')
+        # system_id -> (constellation_id, region_id)
+        self.systems = {int(system_id): tuple(parents) for system_id, parents in data.get('systems', {}).items()}
+        # station_id -> system_id
+        self.stations = {int(station_id): system_id for station_id, system_id in data.get('stations', {}).items()}
+        self.neighbours = {system_id: [] for system_id in self.systems}
+        for a, b in data.get('jumps', []):
+            self.neighbours.setdefault(a, []).append(b)
+            self.neighbours.setdefault(b, []).append(a)
+        self.hub_distances = {
+            hub_id: self.distances_from(hub_id) for hub_id in HUB_SYSTEM_IDS if hub_id in self.neighbours
+        }
+
+    def distances_from(self, origin_system_id: int) -> dict:
+        """Returns {system_id: jumps} for every system reachable from the origin."""
+        distances = {origin_system_id: 0}
+        queue = deque([origin_system_id])
+        while queue:
+            system_id = queue.popleft()
+            next_distance = distances[system_id] + 1
+            for neighbour in self.neighbours.get(system_id, ()):
+                if neighbour not in distances:
+                    distances[neighbour] = next_distance
+                    queue.append(neighbour)
+        return distances
+
+    def jump_distance(self, origin_system_id: int, destination_system_id: int) -> int | None:
+        """Returns the shortest number of jumps between two systems, or None if unreachable."""
+        if origin_system_id == destination_system_id:
+            return 0
+        for hub_id, other_id in ((origin_system_id, destination_system_id), (destination_system_id, origin_system_id)):
+            if hub_id in self.hub_distances:
+                return self.hub_distances[hub_id].get(other_id)
+        if origin_system_id not in self.neighbours or destination_system_id not in self.neighbours:
+            return None
+
+        # Bidirectional BFS, always expanding the smaller frontier.
+        seen_from = ({origin_system_id: 0}, {destination_system_id: 0})
+        frontiers = ([origin_system_id], [destination_system_id])
+        while frontiers[0] and frontiers[1]:
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            seen, other_seen = seen_from[side], seen_from[1 - side]
+            next_frontier = []
+            for system_id in frontiers[side]:
+                distance = seen[system_id] + 1
+                for neighbour in self.neighbours.get(system_id, ()):
+                    if neighbour in other_seen:
+                        return distance + other_seen[neighbour]
+                    if neighbour not in seen:
+                        seen[neighbour] = distance
+                        next_frontier.append(neighbour)
+            frontiers = (next_frontier, frontiers[1]) if side == 0 else (frontiers[0], next_frontier)
+        return None
+
+
+def _get_universe():
+    """Loads the static map data on first use. Returns None if it is unavailable."""
+    global _universe, _load_attempted
+    if not _load_attempted:
+        with _load_lock:
+            if not _load_attempted:
+                try:
+                    with gzip.open(DATA_FILE, 'rt', encoding='utf-8') as f:
+                        _universe = _Universe(json.load(f))
+                    logging.info(
+                        f"Loaded universe data version {_universe.version}: "
+                        f"{len(_universe.systems)} systems, {len(_universe.stations)} stations."
+                    )
+                except FileNotFoundError:
+                    logging.warning(f"Universe data file {DATA_FILE} not found. Jump distances and locations will use ESI.")
+                except (OSError, ValueError, TypeError) as e:
+                    logging.error(f"Could not load universe data from {DATA_FILE}: {e}")
+                _load_attempted = True
+    return _universe
+
+
+def is_available() -> bool:
+    """Returns True if the static map data is loaded."""
+    return _get_universe() is not None
+
+
+def get_data_version() -> str | None:
+    """Returns the version string of the loaded map data, or None."""
+    universe = _get_universe()
+    return universe.version if universe else None
+
+
+def get_region_id(system_id: int) -> int | None:
+    """Returns the region a solar system belongs to, or None if unknown."""
+    universe = _get_universe()
+    if universe is None or system_id not in universe.systems:
+        return None
+    return universe.systems[system_id][1]
+
+
+def resolve_location(location_id: int) -> dict | None:
+    """
+    Resolves an NPC station or solar system ID to {'system_id', 'region_id'}
+    from the static map data. Returns None for player structures and unknown IDs.
+    """
+    universe = _get_universe()
+    if universe is None:
+        return None
+    system_id = universe.stations.get(location_id)
+    if system_id is None and location_id in universe.systems:
+        system_id = location_id
+    if system_id is None or system_id not in universe.systems:
+        return None
+    return {'system_id': system_id, 'region_id': universe.systems[system_id][1]}
+
+
+def iter_station_locations():
+    """Yields (station_id, system_id, region_id) for every NPC station."""
+    universe = _get_universe()
+    if universe is None:
+        return
+    for station_id, system_id in universe.stations.items():
+        if system_id in universe.systems:
+            yield station_id, system_id, universe.systems[system_id][1]
+
+
+@lru_cache(maxsize=65536)
+def get_jump_distance(origin_system_id: int, destination_system_id: int) -> int | None:
+    """
+    Returns the shortest number of stargate jumps between two solar systems,
+    or None if the map data is unavailable or no route exists.
+    """
+    universe = _get_universe()
+    if universe is None:
+        return None
+    return universe.jump_distance(origin_system_id, destination_system_id)
+
+
+def iter_hub_distances():
+    """Yields (hub_system_id, system_id, jumps) for every system reachable from each trade hub."""
+    universe = _get_universe()
+    if universe is None:
+        return
+    for hub_id, distances in universe.hub_distances.items():
+        for system_id, jumps in distances.items():
+            if system_id != hub_id:
+                yield hub_id, system_id, jumps
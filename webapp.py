@@ -1,5 +1,7 @@
 import os
 import database
+import http_client
+import sso
 import logging
 import requests
 from flask import Flask, request, redirect, render_template_string
@@ -69,7 +71,7 @@ def get_token_from_code(auth_code):
         "client_secret": os.getenv("ESI_SECRET_KEY")
     }
     try:
-        response = requests.post(url, headers=headers, data=data)
+        response = http_client.post(url, headers=headers, data=data)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -77,17 +79,8 @@ def get_token_from_code(auth_code):
         return None
 
 def get_character_details_from_token(access_token):
-    """Gets character details from an access token."""
-    url = "https://login.eveonline.com/oauth/verify"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        return data.get("CharacterID"), data.get("CharacterName")
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error getting character details from access token: {e}")
-        return None, None
+    """Gets character details from an access token by validating it locally as a JWT."""
+    return sso.get_character_details_from_token(access_token)
 
 
 # --- Database Initialization ---